@@ -0,0 +1,37 @@
+import sys
+import json
+import argparse
+
+from main import apply_graph_batch, load_admins, record_action
+
+def main():
+    parser = argparse.ArgumentParser(description="批量执行节点连线调整（move / link / unlink）")
+    parser.add_argument("file", help="操作列表 JSON 文件，例如 [{\"op\": \"move\", \"node\": 47, \"parent\": 1000}]")
+    parser.add_argument("--user", default=None, help="记录到历史中的管理员 id（默认取管理员列表中的第一个）")
+    parser.add_argument("--nickname", default="批量脚本")
+    parser.add_argument("--dry-run", action="store_true", help="只校验并打印结果，不写入文件")
+    args = parser.parse_args()
+
+    with open(args.file, "r", encoding="utf-8") as f:
+        operations = json.load(f)
+
+    try:
+        changed = apply_graph_batch(operations, dry_run=args.dry_run)
+    except ValueError as e:
+        print(f"校验失败，未做任何修改: {e}")
+        sys.exit(1)
+
+    if args.dry_run:
+        print(f"校验通过，共 {len(operations)} 条操作，将修改 {len(changed)} 个节点: {[n['id'] for n in changed]}")
+        return
+
+    if changed:
+        user_id = args.user or load_admins()[0]
+        record_action(
+            user_id, "edit", 0, f"批量调整连线（{len(changed)}个节点）", args.nickname,
+            details={"operations": len(operations), "nodes": [n["id"] for n in changed]}
+        )
+    print(f"已完成 {len(operations)} 条操作，修改了 {len(changed)} 个节点。")
+
+if __name__ == "__main__":
+    main()
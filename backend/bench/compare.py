@@ -0,0 +1,55 @@
+import sys
+import json
+import argparse
+
+
+def compare(baseline: dict, current: dict, tolerance: float, min_ms: float):
+    """逐个路由比较 p50/p99 与文件读写量，返回 (表格行, 回退列表)。"""
+    rows, regressions = [], []
+    for mode, run in current["runs"].items():
+        base_run = baseline.get("runs", {}).get(mode)
+        if not base_run:
+            continue
+        for workload, result in run["workloads"].items():
+            base_routes = base_run["workloads"].get(workload, {}).get("routes", {})
+            for route, stats in result["routes"].items():
+                base = base_routes.get(route)
+                if not base:
+                    continue
+                for key in ("p50_ms", "p99_ms", "files_per_request"):
+                    old, new = base.get(key, 0), stats.get(key, 0)
+                    change = (new - old) / old if old else 0.0
+                    rows.append(f"{mode:<10} {workload:<13} {route:<40} {key:<18} {old:>10} -> {new:<10} {change:+.0%}")
+                    # 过小的延迟波动不计入回退
+                    if change > tolerance and (key == "files_per_request" or new - old >= min_ms):
+                        regressions.append(f"{mode} {workload} {route} {key}: {old} -> {new}")
+    return rows, regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="比较两次基准测试结果，发现回退时以状态码 1 退出")
+    parser.add_argument("baseline", help="基准结果 JSON（通常来自上一个提交）")
+    parser.add_argument("current", help="当前结果 JSON")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="允许的相对增长，默认 20%%")
+    parser.add_argument("--min-ms", type=float, default=1.0, help="低于该绝对增长（毫秒）的延迟变化忽略不计")
+    args = parser.parse_args()
+
+    with open(args.baseline, "r", encoding="utf-8") as f:
+        baseline = json.load(f)
+    with open(args.current, "r", encoding="utf-8") as f:
+        current = json.load(f)
+    if baseline.get("size") != current.get("size"):
+        print(f"警告：两次结果的节点数不同（{baseline.get('size')} / {current.get('size')}）")
+
+    rows, regressions = compare(baseline, current, args.tolerance, args.min_ms)
+    print(f"{baseline.get('commit')} -> {current.get('commit')}")
+    print("\n".join(rows))
+    if regressions:
+        print(f"\n发现 {len(regressions)} 处回退：")
+        print("\n".join(regressions))
+        sys.exit(1)
+    print("\n未发现回退")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,238 @@
+"""
+后端基准测试。在 backend 目录下运行：
+
+    python -m bench.run --size 10k --mode both --output bench-10k.json
+    python -m bench.compare bench-old.json bench-10k.json
+
+结果包含每个负载的吞吐量，以及每个路由的 p50/p99 延迟和平均每个请求打开的文件数、读写字节数。
+相同的 --size 与 --seed 会生成相同的数据，不同提交之间的结果可以直接比较。
+"""
+import os
+import re
+import sys
+import json
+import math
+import time
+import shutil
+import socket
+import secrets
+import platform
+import tempfile
+import argparse
+import datetime
+import subprocess
+from concurrent.futures import ThreadPoolExecutor
+
+import httpx
+
+from bench.universe import BACKEND_DIR, BENCH_ADMIN, generate_universe, parse_size
+from bench.workloads import WORKLOADS, BenchContext
+
+METRIC_LINE = re.compile(r'^(\w+)\{(.*)\} (\S+)$')
+LABEL = re.compile(r'(\w+)="((?:[^"\\]|\\.)*)"')
+IO_METRICS = {
+    "http_request_files_opened_sum": "files",
+    "http_request_bytes_read_sum": "bytes_read",
+    "http_request_bytes_written_sum": "bytes_written"
+}
+
+
+def percentile(sorted_values: list, p: float):
+    if not sorted_values:
+        return 0.0
+    index = max(0, math.ceil(p / 100 * len(sorted_values)) - 1)
+    return sorted_values[index]
+
+
+def scrape_io(client):
+    """从 /metrics 读取每个路由累计的文件读写量，键为 "方法 路由"。"""
+    totals = {}
+    for line in client.get("/metrics").text.splitlines():
+        match = METRIC_LINE.match(line)
+        if not match or match.group(1) not in IO_METRICS:
+            continue
+        labels = dict(LABEL.findall(match.group(2)))
+        key = f"{labels.get('method')} {labels.get('route')}"
+        totals.setdefault(key, {})[IO_METRICS[match.group(1)]] = float(match.group(3))
+    return totals
+
+
+def run_workload(client, requests: list, concurrency: int):
+    def send(spec):
+        label, method, url, kwargs = spec
+        start = time.perf_counter()
+        try:
+            response = client.request(method, url, **kwargs)
+            ok = response.status_code < 400
+        except httpx.HTTPError:
+            ok = False
+        return label, time.perf_counter() - start, ok
+
+    before = scrape_io(client)
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        results = list(pool.map(send, requests))
+    wall = time.perf_counter() - start
+    after = scrape_io(client)
+
+    routes = {}
+    for label, elapsed, ok in results:
+        route = routes.setdefault(label, {"latencies": [], "errors": 0})
+        route["latencies"].append(elapsed)
+        if not ok:
+            route["errors"] += 1
+
+    summary = {}
+    for label, route in sorted(routes.items()):
+        latencies = sorted(route["latencies"])
+        count = len(latencies)
+        io_after, io_before = after.get(label, {}), before.get(label, {})
+        summary[label] = {
+            "count": count,
+            "errors": route["errors"],
+            "p50_ms": round(percentile(latencies, 50) * 1000, 3),
+            "p99_ms": round(percentile(latencies, 99) * 1000, 3),
+            "mean_ms": round(sum(latencies) / count * 1000, 3),
+            "max_ms": round(latencies[-1] * 1000, 3),
+            **{f"{k}_per_request": round((io_after.get(k, 0) - io_before.get(k, 0)) / count, 2)
+               for k in IO_METRICS.values()}
+        }
+    return {
+        "requests": len(requests),
+        "wall_seconds": round(wall, 3),
+        "throughput_rps": round(len(requests) / wall, 1) if wall else 0.0,
+        "routes": summary
+    }
+
+
+def run_suite(client, workloads: list, n: int, concurrency: int, seed: int):
+    start = time.perf_counter()
+    nodes = client.get("/api/nodes").json()["nodes"]
+    result = {"cold_start_ms": round((time.perf_counter() - start) * 1000, 3), "workloads": {}}
+    ctx = BenchContext(nodes, seed)
+    for name in workloads:
+        requests = WORKLOADS[name](ctx, n)
+        # 只读负载按给定并发执行，写入负载串行执行以保证结果可复现
+        workers = concurrency if name == "read_graph" else 1
+        result["workloads"][name] = run_workload(client, requests, workers)
+        print(f"  {name}: {result['workloads'][name]['throughput_rps']} req/s", file=sys.stderr)
+    return result
+
+
+def admin_headers(root: str):
+    """以 BENCH_ADMIN 身份签发会话令牌，写入类接口只接受带令牌的请求。"""
+    # main 在导入时读取 DATA_ROOT，所以必须在导入之前设置；各模式的数据副本中 admins.json 相同，
+    # 签名密钥由 main() 固定在 SESSION_SECRET 中，所以同一个令牌对两种模式的服务端都有效
+    os.environ.setdefault("DATA_ROOT", root)
+    import main
+    return {"Authorization": f"Bearer {main.issue_session_token(BENCH_ADMIN)}"}
+
+
+def run_inprocess(root: str, args):
+    os.environ["DATA_ROOT"] = root
+    from fastapi.testclient import TestClient
+    import main
+    with TestClient(main.app, headers=admin_headers(root)) as client:
+        return run_suite(client, args.workloads, args.requests, args.concurrency, args.seed)
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def run_uvicorn(root: str, args):
+    port = free_port()
+    command = [sys.executable, "-m", "uvicorn", "main:app", "--host", "127.0.0.1", "--port", str(port),
+               "--workers", str(args.uvicorn_workers), "--log-level", "warning"]
+    server = subprocess.Popen(command, cwd=BACKEND_DIR, env={**os.environ, "DATA_ROOT": root})
+    base_url = f"http://127.0.0.1:{port}"
+    try:
+        deadline = time.time() + 60
+        while True:
+            try:
+                if httpx.get(f"{base_url}/metrics", timeout=1).status_code == 200:
+                    break
+            except httpx.HTTPError:
+                pass
+            if server.poll() is not None or time.time() > deadline:
+                raise RuntimeError("uvicorn 启动失败")
+            time.sleep(0.2)
+        limits = httpx.Limits(max_connections=args.concurrency, max_keepalive_connections=args.concurrency)
+        with httpx.Client(base_url=base_url, timeout=120, limits=limits, headers=admin_headers(root)) as client:
+            return run_suite(client, args.workloads, args.requests, args.concurrency, args.seed)
+    finally:
+        server.terminate()
+        server.wait(timeout=30)
+
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=BACKEND_DIR,
+                              capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description="在合成数据上运行后端基准测试，并将每个路由的延迟与文件读写量写入 JSON")
+    parser.add_argument("--size", default="1k", help="节点数：1k / 10k / 100k 或任意整数")
+    parser.add_argument("--mode", choices=["inprocess", "uvicorn", "both"], default="inprocess")
+    parser.add_argument("--workloads", default=",".join(WORKLOADS), help=f"逗号分隔，可选：{', '.join(WORKLOADS)}")
+    parser.add_argument("--requests", type=int, default=200, help="每个负载的请求数")
+    parser.add_argument("--concurrency", type=int, default=8, help="只读负载的并发数")
+    parser.add_argument("--uvicorn-workers", type=int, default=1)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", default=None, help="结果 JSON 路径，默认输出到标准输出")
+    parser.add_argument("--keep", action="store_true", help="保留生成的数据目录")
+    args = parser.parse_args()
+    args.workloads = [w for w in args.workloads.split(",") if w]
+    unknown = [w for w in args.workloads if w not in WORKLOADS]
+    if unknown:
+        parser.error(f"未知的负载: {', '.join(unknown)}")
+
+    size = parse_size(args.size)
+    os.environ.setdefault("SESSION_SECRET", secrets.token_hex(32))
+    workdir = tempfile.mkdtemp(prefix="bench-")
+    template = os.path.join(workdir, "template")
+    start = time.perf_counter()
+    generate_universe(template, size, seed=args.seed)
+    report = {
+        "commit": git_commit(),
+        "time": datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "size": size,
+        "seed": args.seed,
+        "requests_per_workload": args.requests,
+        "concurrency": args.concurrency,
+        "generate_seconds": round(time.perf_counter() - start, 3),
+        "runs": {}
+    }
+    print(f"已生成 {size} 个节点: {template}", file=sys.stderr)
+
+    modes = ["inprocess", "uvicorn"] if args.mode == "both" else [args.mode]
+    try:
+        for mode in modes:
+            # 每种模式都在一份全新的数据副本上运行
+            root = os.path.join(workdir, mode)
+            shutil.copytree(template, root)
+            print(f"[{mode}]", file=sys.stderr)
+            runner = run_inprocess if mode == "inprocess" else run_uvicorn
+            report["runs"][mode] = runner(root, args)
+    finally:
+        if not args.keep:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    text = json.dumps(report, ensure_ascii=False, indent=2)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            f.write(text)
+        print(f"结果已写入 {args.output}", file=sys.stderr)
+    else:
+        print(text)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,147 @@
+import os
+import io
+import json
+import random
+import datetime
+import argparse
+
+from PIL import Image
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+BENCH_ADMIN = "bench-admin"
+BENCH_USER = "bench-user"
+SIZES = {"1k": 1000, "10k": 10000, "100k": 100000}
+
+
+def parse_size(text: str):
+    return SIZES.get(text) or int(text)
+
+
+def load_templates():
+    """从 data 文件夹（或 data_default.json）中取出节点作为生成模板。"""
+    templates = []
+    data_dir = os.path.join(BACKEND_DIR, "data")
+    if os.path.isdir(data_dir):
+        for filename in sorted(os.listdir(data_dir)):
+            if filename.endswith(".json"):
+                with open(os.path.join(data_dir, filename), "r", encoding="utf-8") as f:
+                    templates.append(json.load(f))
+    if not templates:
+        with open(os.path.join(BACKEND_DIR, "data_default.json"), "r", encoding="utf-8") as f:
+            templates = json.load(f)["nodes"]
+    return templates
+
+
+def thumbnail_bytes(seed: int):
+    buf = io.BytesIO()
+    color = (seed * 37 % 256, seed * 91 % 256, seed * 53 % 256)
+    Image.new("RGB", (32, 32), color).save(buf, "WEBP")
+    return buf.getvalue()
+
+
+def generate_universe(root: str, size: int, seed: int = 0, depth_window: int = 8, cross_link_ratio: float = 0.02):
+    """
+    在 root 下生成 size 个节点的完整数据目录（data、images、users 以及各个 json 文件）。
+    每个新节点挂在最近 depth_window 个节点之一的下面，从而形成很深的 extension 树；
+    另有 cross_link_ratio 比例的节点被第二个父节点引用。
+    相同的 size 与 seed 总是生成相同的数据，便于跨提交比较。
+    """
+    rng = random.Random(seed)
+    templates = load_templates()
+    data_dir = os.path.join(root, "data")
+    images_dir = os.path.join(root, "images")
+    users_dir = os.path.join(root, "users")
+    for path in (data_dir, images_dir, users_dir):
+        os.makedirs(path, exist_ok=True)
+
+    palette = [thumbnail_bytes(i) for i in range(16)]
+    nodes = {}
+    for node_id in range(1, size + 1):
+        template = templates[rng.randrange(len(templates))]
+        image_name = f"bench-{node_id}.webp"
+        with open(os.path.join(images_dir, image_name), "wb") as f:
+            f.write(palette[node_id % len(palette)])
+        nodes[node_id] = {
+            "id": node_id,
+            "name": f"{template.get('name', '爱音')} #{node_id}",
+            "image": f"/images/{image_name}",
+            "source": template.get("source", {}),
+            "related": template.get("related", []),
+            "tags": template.get("tags", []),
+            "extension": [],
+            "x": 0.0,
+            "y": 0.0,
+            "introduction": template.get("introduction", ""),
+            "time": "2024-01-01"
+        }
+        if node_id > 1:
+            parent_id = rng.randint(max(1, node_id - depth_window), node_id - 1)
+            parent = nodes[parent_id]
+            parent["extension"].append(node_id)
+            nodes[node_id]["x"] = parent["x"] + rng.uniform(-200, 200)
+            nodes[node_id]["y"] = parent["y"] + rng.uniform(50, 200)
+            if rng.random() < cross_link_ratio:
+                other_id = rng.randint(1, node_id - 1)
+                if other_id != parent_id:
+                    nodes[other_id]["extension"].append(node_id)
+
+    for node in nodes.values():
+        with open(os.path.join(data_dir, f"{node['id']}.json"), "w", encoding="utf-8") as f:
+            json.dump(node, f, ensure_ascii=False, indent=2)
+
+    now = datetime.datetime.now()
+    history = [{
+        "user_id": BENCH_ADMIN,
+        "nickname": "bench",
+        "role": "admin",
+        "action": "edit",
+        "node_id": rng.randint(1, size),
+        "node_name": "bench",
+        "time": (now - datetime.timedelta(minutes=i)).strftime("%Y-%m-%d %H:%M:%S")
+    } for i in range(50, 0, -1)]
+    mailbox = [{
+        "id": f"bench-mail-{i}",
+        "user_id": BENCH_USER,
+        "nickname": "bench",
+        "content": f"测试信件 {i}",
+        "time": (now - datetime.timedelta(minutes=i)).strftime("%Y-%m-%d %H:%M:%S"),
+        "status": "unprocessed"
+    } for i in range(200)]
+    today = str(datetime.date.today())
+    files = {
+        "admins.json": [BENCH_ADMIN],
+        "banned.json": [],
+        "history.json": history,
+        "historyarchive.json": [],
+        "mailbox.json": mailbox,
+        "mailhistory.json": [],
+        "applications.json": [],
+        os.path.join("users", f"{BENCH_ADMIN}.json"): {
+            "last_date": today, "adds": 0, "edits": 0, "deletes": 0, "applies": 0, "messages": 0, "notifications": []
+        },
+        os.path.join("users", f"{BENCH_USER}.json"): {
+            "last_date": today, "adds": 0, "edits": 0, "deletes": 0, "applies": 0, "messages": 0, "notifications": []
+        }
+    }
+    for name, content in files.items():
+        with open(os.path.join(root, name), "w", encoding="utf-8") as f:
+            json.dump(content, f, ensure_ascii=False, indent=2)
+    # 提前创建当天的备份锁，避免测试过程中触发全量备份
+    os.makedirs(os.path.join(root, "backups"), exist_ok=True)
+    with open(os.path.join(root, "backups", f".backup_done_{today}"), "w") as f:
+        f.write("bench")
+    return size
+
+
+def main():
+    parser = argparse.ArgumentParser(description="生成用于基准测试的合成数据目录")
+    parser.add_argument("root", help="输出目录")
+    parser.add_argument("--size", default="1k", help="节点数：1k / 10k / 100k 或任意整数")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+    size = generate_universe(args.root, parse_size(args.size), seed=args.seed)
+    print(f"已在 {args.root} 生成 {size} 个节点")
+
+
+if __name__ == "__main__":
+    main()
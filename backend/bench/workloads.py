@@ -0,0 +1,135 @@
+import io
+import json
+import random
+
+from PIL import Image
+
+from bench.universe import BENCH_ADMIN
+
+
+class BenchContext:
+    """各个负载共享的状态：当前节点 id、叶子节点 id 与随机数种子。"""
+
+    def __init__(self, nodes: list, seed: int = 0):
+        self.rng = random.Random(seed)
+        self.node_ids = [n["id"] for n in nodes]
+        self.nodes = {n["id"]: n for n in nodes}
+        self.leaf_ids = [n["id"] for n in nodes if not n.get("extension") and n["id"] != 1]
+        buf = io.BytesIO()
+        Image.new("RGB", (256, 256), (255, 136, 170)).save(buf, "PNG")
+        self.image = buf.getvalue()
+
+    def pick(self):
+        return self.rng.choice(self.node_ids)
+
+
+# 每个负载返回 (标签, 方法, 路径, 请求参数) 的列表；标签与 /metrics 中的路由模板一致，便于对齐文件读写统计
+
+def read_graph(ctx: BenchContext, n: int):
+    requests = []
+    for i in range(n):
+        kind = i % 4
+        if kind == 0:
+            requests.append(("GET /api/nodes", "GET", "/api/nodes", {}))
+        elif kind == 1:
+            node_id = ctx.pick()
+            requests.append(("GET /api/nodes/{node_id}/lineage", "GET", f"/api/nodes/{node_id}/lineage", {}))
+        elif kind == 2:
+            requests.append(("GET /api/clusters", "GET", "/api/clusters", {"params": {"zoom": 0.2}}))
+        else:
+            requests.append(("GET /api/history", "GET", "/api/history", {}))
+    return requests
+
+
+def edit_storm(ctx: BenchContext, n: int):
+    requests = []
+    for i in range(n):
+        node_id = ctx.pick()
+        node = ctx.nodes[node_id]
+        if i % 3 == 0:
+            form = {
+                "name": node["name"],
+                "source": json.dumps(node.get("source", {}), ensure_ascii=False),
+                "related": json.dumps(node.get("related", []), ensure_ascii=False),
+                "tags": json.dumps(node.get("tags", []), ensure_ascii=False),
+                "extension": json.dumps(node.get("extension", [])),
+                "introduction": f"{node.get('introduction', '')} (edit {i})",
+                "user_id": BENCH_ADMIN,
+                "nickname": "bench"
+            }
+            requests.append(("PUT /api/nodes/{node_id}", "PUT", f"/api/nodes/{node_id}", {"data": form}))
+        elif i % 3 == 1:
+            form = {"x": ctx.rng.uniform(-5000, 5000), "y": ctx.rng.uniform(-5000, 5000), "user_id": BENCH_ADMIN, "nickname": "bench"}
+            requests.append(("PATCH /api/nodes/{node_id}/position", "PATCH", f"/api/nodes/{node_id}/position", {"data": form}))
+        else:
+            positions = [{"id": ctx.pick(), "x": ctx.rng.uniform(-5000, 5000), "y": ctx.rng.uniform(-5000, 5000)} for _ in range(20)]
+            form = {"positions": json.dumps(positions), "user_id": BENCH_ADMIN, "nickname": "bench"}
+            requests.append(("PATCH /api/nodes/positions", "PATCH", "/api/nodes/positions", {"data": form}))
+    return requests
+
+
+def delete_leaves(ctx: BenchContext, n: int):
+    leaves = ctx.leaf_ids[:]
+    ctx.rng.shuffle(leaves)
+    requests = []
+    for node_id in leaves[:n]:
+        params = {"user_id": BENCH_ADMIN, "nickname": "bench"}
+        requests.append(("DELETE /api/nodes/{node_id}", "DELETE", f"/api/nodes/{node_id}", {"params": params}))
+        ctx.node_ids.remove(node_id)
+    return requests
+
+
+def image_uploads(ctx: BenchContext, n: int):
+    requests = []
+    for i in range(n):
+        form = {
+            "name": f"bench upload {i}",
+            "source": json.dumps({"name": "bench", "link": "", "type": "其他"}),
+            "related": "[]",
+            "tags": json.dumps(["bench"]),
+            "extension": "[]",
+            "introduction": "",
+            "parent_id": str(ctx.pick()),
+            "user_id": BENCH_ADMIN,
+            "nickname": "bench"
+        }
+        files = {"image": ("bench.png", ctx.image, "image/png")}
+        requests.append(("POST /api/nodes", "POST", "/api/nodes", {"data": form, "files": files}))
+    return requests
+
+
+def mailbox(ctx: BenchContext, n: int):
+    requests = []
+    for i in range(n):
+        kind = i % 3
+        if kind == 0:
+            form = {"content": f"基准测试信件 {i}", "user_id": BENCH_ADMIN, "nickname": "bench"}
+            requests.append(("POST /api/mailbox", "POST", "/api/mailbox", {"data": form}))
+        elif kind == 1:
+            params = {"user_id": BENCH_ADMIN, "status": "unprocessed", "limit": 20}
+            requests.append(("GET /api/mailbox", "GET", "/api/mailbox", {"params": params}))
+        else:
+            form = {"action": "process", "feedback": "ok", "user_id": BENCH_ADMIN, "nickname": "bench"}
+            msg_id = f"bench-mail-{i // 3}"
+            requests.append(("POST /api/mailbox/{msg_id}/process", "POST", f"/api/mailbox/{msg_id}/process", {"data": form}))
+    return requests
+
+
+def history(ctx: BenchContext, n: int):
+    requests = []
+    for i in range(n):
+        if i % 2:
+            requests.append(("GET /api/history", "GET", "/api/history", {"params": {"node_id": ctx.pick()}}))
+        else:
+            requests.append(("GET /api/history", "GET", "/api/history", {}))
+    return requests
+
+
+WORKLOADS = {
+    "read_graph": read_graph,
+    "edit_storm": edit_storm,
+    "delete": delete_leaves,
+    "image_upload": image_uploads,
+    "mailbox": mailbox,
+    "history": history
+}
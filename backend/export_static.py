@@ -0,0 +1,37 @@
+"""
+把只读接口导出为静态文件，由 nginx 或 CDN 直接提供，后端只需处理登录后的写入。
+
+    python export_static.py /var/www/anon-static
+
+也可以设置环境变量 STATIC_EXPORT_DIR 启动后端，每次写入后会在后台自动重新导出。
+前端构建时设置 VITE_STATIC_BASE 为该目录对外的地址，即可从静态文件读取图谱、节点详情与历史。
+
+nginx 示例（导出到 /var/www/anon-static）：
+
+    location /anon-static/ {
+        root /var/www;
+        gzip_static on;
+        add_header Cache-Control "no-cache";
+    }
+    location /anon-static/static/ {
+        root /var/www;
+        gzip_static on;
+        add_header Cache-Control "public, max-age=31536000, immutable";
+    }
+"""
+import argparse
+
+from main import export_static_site
+
+def main():
+    parser = argparse.ArgumentParser(description="将图谱、节点详情、最近历史与缩略图导出为带内容哈希的静态文件")
+    parser.add_argument("output", help="导出目录")
+    args = parser.parse_args()
+
+    result = export_static_site(args.output)
+    manifest = result["manifest"]
+    print(f"已导出 {len(manifest['node_detail'])} 个节点、{len(manifest['thumbnails'])} 张缩略图，"
+          f"新写出 {result['written']} 个文件，清理 {result['removed']} 个旧文件")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,33 @@
+import sys
+import json
+import argparse
+
+from main import run_fsck, apply_fsck_repairs
+
+def main():
+    parser = argparse.ArgumentParser(description="检查 data 文件夹中节点数据的完整性，并可选择自动修复")
+    parser.add_argument("--repair", action="store_true", help="自动修复可修复的问题（悬空引用、重复引用、自引用、缺失字段）")
+    parser.add_argument("--workers", type=int, default=None, help="并行检查的进程数（默认等于 CPU 核数）")
+    parser.add_argument("--output", default=None, help="将 JSON 报告写入文件，默认输出到标准输出")
+    args = parser.parse_args()
+
+    report = run_fsck(workers=args.workers)
+    if args.repair and report["repairable"]:
+        report["repaired"] = apply_fsck_repairs(report)
+        remaining = run_fsck(workers=args.workers)
+        report["remaining"] = remaining["summary"]
+        unresolved = len(remaining["issues"])
+    else:
+        unresolved = len(report["issues"])
+
+    text = json.dumps(report, ensure_ascii=False, indent=2)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            f.write(text)
+        print(f"共检查 {report['checked']} 个文件，发现 {len(report['issues'])} 个问题: {report['summary']}")
+    else:
+        print(text)
+    sys.exit(1 if unresolved else 0)
+
+if __name__ == "__main__":
+    main()
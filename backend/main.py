@@ -1,40 +1,109 @@
-from fastapi import FastAPI, HTTPException, UploadFile, File, Form, Response
-from fastapi.middleware.cors import CORSMiddleware
-from fastapi.staticfiles import StaticFiles
-from pydantic import BaseModel
-from typing import List, Optional
-import json
-import os
-import shutil
-import uuid
-import datetime
+from fastapi import FastAPI, HTTPException, UploadFile, File, Form, Response, Request
+from fastapi.responses import JSONResponse, FileResponse
+from fastapi.routing import APIRoute
+from fastapi.middleware.cors import CORSMiddleware
+from fastapi.staticfiles import StaticFiles
+from fastapi.concurrency import run_in_threadpool
+from pydantic import BaseModel
+from typing import List, Optional
+import json
+import os
+import shutil
+import uuid
+import datetime
+import threading
+import asyncio
+import bisect
+import heapq
+import itertools
+import time
+import copy
+import hmac
+import base64
+import hashlib
+import secrets
+import binascii
+import contextvars
+import functools
+import array
+import struct
+import math
+import multiprocessing
+import mmap
+import zlib
+import gzip
+import cProfile
+import pstats
+import io
+import re
+import sys
 import httpx
 import urllib.parse
+from collections import deque, OrderedDict
+from contextlib import asynccontextmanager, contextmanager
+from concurrent.futures import ProcessPoolExecutor
 from PIL import Image
 
 BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+# 数据文件的根目录，默认与 main.py 同级；基准测试等场景可通过 DATA_ROOT 指向其他目录
+DATA_ROOT = os.getenv("DATA_ROOT", BASE_DIR)
 
 
 def backend_path(*parts):
-    return os.path.join(BASE_DIR, *parts)
-
-
-app = FastAPI()
-
-# Allow CORS for frontend
-app.add_middleware(
-    CORSMiddleware,
-    allow_origins=["*"],
-    allow_credentials=True,
-    allow_methods=["*"],
-    allow_headers=["*"],
-)
-
-# Bangumi OAuth Config
-BGM_CLIENT_ID = os.getenv("BGM_CLIENT_ID", "default_id")
-BGM_CLIENT_SECRET = os.getenv("BGM_CLIENT_SECRET", "default_secret")
-BGM_REDIRECT_URI = os.getenv("BGM_REDIRECT_URI", "http://localhost:8000/api/auth/callback")
-
+    return os.path.join(DATA_ROOT, *parts)
+
+
+# 后台信箱归档的执行间隔（秒）
+MAIL_ARCHIVE_INTERVAL = 3600
+
+
+async def mail_archive_loop():
+    while True:
+        try:
+            await run_in_threadpool(archive_old_mail)
+        except Exception as e:
+            print(f"Mail archive failed: {e}")
+        await asyncio.sleep(MAIL_ARCHIVE_INTERVAL)
+
+
+@asynccontextmanager
+async def lifespan(app):
+    archive_task = asyncio.create_task(mail_archive_loop())
+    yield
+    archive_task.cancel()
+    await close_bgm_client()
+
+
+app = FastAPI(lifespan=lifespan)
+
+
+@app.middleware("http")
+async def session_middleware(request: Request, call_next):
+    return await authenticate_request(request, call_next)
+
+# Allow CORS for frontend
+app.add_middleware(
+    CORSMiddleware,
+    allow_origins=["*"],
+    allow_credentials=True,
+    allow_methods=["*"],
+    allow_headers=["*"],
+)
+
+# Bangumi OAuth Config
+BGM_CLIENT_ID = os.getenv("BGM_CLIENT_ID", "default_id")
+BGM_CLIENT_SECRET = os.getenv("BGM_CLIENT_SECRET", "default_secret")
+BGM_REDIRECT_URI = os.getenv("BGM_REDIRECT_URI", "http://localhost:8000/api/auth/callback")
+# 可指向本地模拟的 OAuth 服务器进行测试
+BGM_OAUTH_BASE = os.getenv("BGM_OAUTH_BASE", "https://bgm.tv")
+BGM_API_BASE = os.getenv("BGM_API_BASE", "https://api.bgm.tv")
+BGM_HTTP2 = os.getenv("BGM_HTTP2", "1") == "1"
+BGM_TIMEOUT = httpx.Timeout(connect=5.0, read=15.0, write=10.0, pool=5.0)
+BGM_RETRIES = 2
+# /v0/me 昵称缓存的有效期（秒）与容量
+NICKNAME_CACHE_TTL = 3600
+NICKNAME_CACHE_SIZE = 10000
+
 DATA_DIR = backend_path("data")
 IMAGES_DIR = backend_path("images")
 USERS_DIR = backend_path("users")
@@ -46,487 +115,3049 @@ MAILBOX_FILE = backend_path("mailbox.json")
 MAILBOX_HISTORY_FILE = backend_path("mailhistory.json")
 HISTORY_ARCHIVE_FILE = backend_path("historyarchive.json")
 BACKUP_DIR = backend_path("backups")
+PROFILES_DIR = backend_path("profiles")
+SNAPSHOT_FILE = backend_path("graph.snapshot")
+JOURNAL_FILE = backend_path("graph.journal")
+JOURNAL_LOCK_FILE = backend_path("graph.journal.lock")
+STATS_FILE = backend_path("stats.json")
+STATS_LOCK_FILE = backend_path("stats.json.lock")
+NOTIFICATIONS_LOCK_FILE = backend_path("notifications.lock")
+MAILBOX_LOCK_FILE = backend_path("mailbox.json.lock")
+APPLICATIONS_LOCK_FILE = backend_path("applications.json.lock")
+
+
+def image_storage_path(image_url: str):
+    if not image_url or not image_url.startswith("/images/"):
+        return None
+    return os.path.join(IMAGES_DIR, os.path.basename(image_url))
+
+# Ensure data directory exists
+os.makedirs(DATA_DIR, exist_ok=True)
+os.makedirs(USERS_DIR, exist_ok=True)
+os.makedirs(BACKUP_DIR, exist_ok=True)
+
+
+# --- 运行指标（Prometheus 文本格式） ---
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+SIZE_BUCKETS = (256, 1024, 4096, 16384, 65536, 262144, 1048576, 4194304, 16777216)
+COUNT_BUCKETS = (0, 1, 2, 5, 10, 50, 100, 1000, 10000)
+
+
+def _escape_label(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_labels(names, values, extra=""):
+    pairs = [f'{n}="{_escape_label(v)}"' for n, v in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+class Metric:
+    def __init__(self, name: str, help_text: str, labels: tuple = ()):
+        self.name = name
+        self.help = help_text
+        self.labels = labels
+        self.lock = threading.Lock()
+        self.values = {}
+
+    def header(self):
+        return [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.type}"]
+
+
+class Counter(Metric):
+    type = "counter"
+
+    def inc(self, amount=1, *labels):
+        with self.lock:
+            self.values[labels] = self.values.get(labels, 0) + amount
+
+    def render(self):
+        with self.lock:
+            items = list(self.values.items())
+        return self.header() + [f"{self.name}{_format_labels(self.labels, k)} {v}" for k, v in items]
+
+
+class Gauge(Counter):
+    type = "gauge"
+
+    def dec(self, amount=1, *labels):
+        self.inc(-amount, *labels)
+
+
+class Histogram(Metric):
+    type = "histogram"
+
+    def __init__(self, name: str, help_text: str, labels: tuple = (), buckets: tuple = LATENCY_BUCKETS):
+        super().__init__(name, help_text, labels)
+        self.buckets = buckets
+
+    def observe(self, value, *labels):
+        index = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            entry = self.values.get(labels)
+            if entry is None:
+                entry = self.values[labels] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            entry[0][index] += 1
+            entry[1] += value
+            entry[2] += 1
+
+    def render(self):
+        with self.lock:
+            items = [(k, list(v[0]), v[1], v[2]) for k, v in self.values.items()]
+        lines = self.header()
+        for key, counts, total, count in items:
+            cumulative = 0
+            for bound, n in zip(self.buckets, counts):
+                cumulative += n
+                le = 'le="%s"' % bound
+                lines.append(f"{self.name}_bucket{_format_labels(self.labels, key, le)} {cumulative}")
+            le = 'le="+Inf"'
+            lines.append(f"{self.name}_bucket{_format_labels(self.labels, key, le)} {count}")
+            lines.append(f"{self.name}_sum{_format_labels(self.labels, key)} {total}")
+            lines.append(f"{self.name}_count{_format_labels(self.labels, key)} {count}")
+        return lines
+
+
+class MetricsRegistry:
+    def __init__(self):
+        self.metrics = []
+        # 抓取时才计算的指标：返回 (名称, 类型, 说明, 数值) 列表
+        self.collectors = []
+
+    def register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def render(self):
+        lines = []
+        for metric in self.metrics:
+            lines.extend(metric.render())
+        for collect in self.collectors:
+            for name, kind, help_text, value in collect():
+                lines.extend([f"# HELP {name} {help_text}", f"# TYPE {name} {kind}", f"{name} {value}"])
+        return "\n".join(lines) + "\n"
+
+
+metrics = MetricsRegistry()
+HTTP_REQUESTS = metrics.register(Counter(
+    "http_requests_total", "HTTP 请求数", ("method", "route", "status")))
+HTTP_LATENCY = metrics.register(Histogram(
+    "http_request_duration_seconds", "HTTP 请求耗时", ("method", "route")))
+HTTP_RESPONSE_SIZE = metrics.register(Histogram(
+    "http_response_size_bytes", "HTTP 响应体大小", ("method", "route"), SIZE_BUCKETS))
+HTTP_INFLIGHT = metrics.register(Gauge(
+    "http_requests_in_flight", "正在处理的 HTTP 请求数"))
+REQUEST_FILES = metrics.register(Histogram(
+    "http_request_files_opened", "单个请求打开的文件数", ("method", "route"), COUNT_BUCKETS))
+REQUEST_BYTES_READ = metrics.register(Histogram(
+    "http_request_bytes_read", "单个请求读取的字节数", ("method", "route"), SIZE_BUCKETS))
+REQUEST_BYTES_WRITTEN = metrics.register(Histogram(
+    "http_request_bytes_written", "单个请求写入的字节数", ("method", "route"), SIZE_BUCKETS))
+FILES_OPENED = metrics.register(Counter(
+    "storage_files_opened_total", "打开的数据文件数", ("mode",)))
+STORAGE_BYTES = metrics.register(Counter(
+    "storage_bytes_total", "读写的数据字节数", ("direction",)))
+STORAGE_OPS = metrics.register(Histogram(
+    "storage_operation_duration_seconds", "持久化操作耗时", ("op",)))
+
+# 当前请求的文件读写统计，由 MetricsMiddleware 为每个请求设置
+request_io = contextvars.ContextVar("request_io", default=None)
+
+
+@contextmanager
+def metered_open(path, mode="r", **kwargs):
+    """与 open 相同，额外统计打开的文件数与读写字节数。"""
+    f = open(path, mode, **kwargs)
+    writing = any(c in mode for c in "wax+")
+    try:
+        yield f
+    finally:
+        try:
+            if writing:
+                f.flush()
+            size = os.fstat(f.fileno()).st_size
+        except (OSError, ValueError):
+            size = 0
+        f.close()
+        direction = "written" if writing else "read"
+        FILES_OPENED.inc(1, "write" if writing else "read")
+        STORAGE_BYTES.inc(size, direction)
+        io = request_io.get()
+        if io is not None:
+            io["files"] += 1
+            io[direction] += size
+
+
+def instrumented(op: str):
+    """记录持久化函数的耗时。"""
+    def decorate(fn):
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                STORAGE_OPS.observe(time.perf_counter() - start, op)
+        return wrapper
+    return decorate
+
+
+class MetricsMiddleware:
+    """按路由模板记录请求耗时、响应大小与文件读写量。"""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        start = time.perf_counter()
+        io = {"files": 0, "read": 0, "written": 0}
+        token = request_io.set(io)
+        response = {"status": 500, "size": 0}
+
+        async def send_wrapper(message):
+            if message["type"] == "http.response.start":
+                response["status"] = message["status"]
+            elif message["type"] == "http.response.body":
+                response["size"] += len(message.get("body", b""))
+            await send(message)
+
+        HTTP_INFLIGHT.inc()
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            HTTP_INFLIGHT.dec()
+            request_io.reset(token)
+            # 未匹配的路径统一归为一类，避免标签数量无限增长
+            route = getattr(scope.get("route"), "path", "unmatched")
+            method = scope["method"]
+            HTTP_REQUESTS.inc(1, method, route, response["status"])
+            HTTP_LATENCY.observe(time.perf_counter() - start, method, route)
+            HTTP_RESPONSE_SIZE.observe(response["size"], method, route)
+            REQUEST_FILES.observe(io["files"], method, route)
+            REQUEST_BYTES_READ.observe(io["read"], method, route)
+            REQUEST_BYTES_WRITTEN.observe(io["written"], method, route)
+
+
+app.add_middleware(MetricsMiddleware)
+
+
+@instrumented("encode_image")
+def save_webp_image(source, filepath: str):
+    with Image.open(source) as img:
+        # Handle transparency
+        if img.mode in ("RGBA", "LA") or (img.mode == "P" and "transparency" in img.info):
+            img = img.convert("RGBA")
+        else:
+            img = img.convert("RGB")
+        img.save(filepath, "WEBP")
+    size = os.path.getsize(filepath)
+    FILES_OPENED.inc(1, "write")
+    STORAGE_BYTES.inc(size, "written")
+    io = request_io.get()
+    if io is not None:
+        io["files"] += 1
+        io["written"] += size
+
+# --- 请求性能分析 ---
+
+# 超过该耗时（秒）的请求自动采样，0 表示关闭
+SLOW_REQUEST_THRESHOLD = float(os.getenv("SLOW_REQUEST_THRESHOLD", "0"))
+# 两次自动采样之间的最短间隔（秒）
+SLOW_PROFILE_INTERVAL = float(os.getenv("SLOW_PROFILE_INTERVAL", "60"))
+# 长轮询接口本来就会等待，不参与慢请求采样
+SLOW_PROFILE_EXCLUDE = {"/api/notifications/wait"}
+PROFILE_SAMPLE_INTERVAL = 0.005
+PROFILE_MAX_SAMPLES = 12000
+PROFILE_MAX_REPORTS = 100
+
+request_profile = contextvars.ContextVar("request_profile", default=None)
+
+
+class RequestProfile:
+    __slots__ = ("scope", "mode", "name", "start", "elapsed", "status",
+                 "thread_id", "sampling", "slow", "samples", "sample_count", "profile")
+
+    def __init__(self, scope, mode: Optional[str]):
+        self.scope = scope
+        self.mode = mode
+        self.name = None
+        self.start = time.perf_counter()
+        self.elapsed = 0.0
+        self.status = None
+        # 同步接口在线程池中执行，进入接口时会更新为工作线程
+        self.thread_id = threading.get_ident()
+        self.sampling = mode is not None
+        self.slow = False
+        self.samples = {}
+        self.sample_count = 0
+        self.profile = None
+
+    def route(self):
+        return getattr(self.scope.get("route"), "path", self.scope["path"])
+
+
+def fold_stack(frame):
+    stack = []
+    while frame is not None:
+        code = frame.f_code
+        stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+        frame = frame.f_back
+    return ";".join(reversed(stack))
+
+
+class StackSampler:
+    """
+    采样线程：定期抓取正在分析的请求所在线程的调用栈，并按 flamegraph 的折叠格式计数。
+    开启慢请求模式时也负责发现超过阈值的请求，从那一刻开始采样。
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.active = {}
+        self.thread = None
+        self.last_slow = float("-inf")
+
+    def track(self, state: RequestProfile):
+        with self.lock:
+            self.active[id(state)] = state
+            if self.thread is None:
+                self.thread = threading.Thread(target=self._run, name="stack-sampler", daemon=True)
+                self.thread.start()
+
+    def untrack(self, state: RequestProfile):
+        with self.lock:
+            self.active.pop(id(state), None)
+
+    def _run(self):
+        while True:
+            time.sleep(PROFILE_SAMPLE_INTERVAL)
+            with self.lock:
+                if not self.active:
+                    self.thread = None
+                    return
+                states = list(self.active.values())
+            now = time.perf_counter()
+            frames = None
+            for state in states:
+                if not state.sampling and SLOW_REQUEST_THRESHOLD:
+                    if now - state.start < SLOW_REQUEST_THRESHOLD or state.route() in SLOW_PROFILE_EXCLUDE:
+                        continue
+                    with self.lock:
+                        if now - self.last_slow < SLOW_PROFILE_INTERVAL:
+                            continue
+                        self.last_slow = now
+                    state.sampling = state.slow = True
+                if not state.sampling or state.sample_count >= PROFILE_MAX_SAMPLES:
+                    continue
+                if frames is None:
+                    frames = sys._current_frames()
+                frame = frames.get(state.thread_id)
+                if frame is None:
+                    continue
+                stack = fold_stack(frame)
+                state.samples[stack] = state.samples.get(stack, 0) + 1
+                state.sample_count += 1
+
+
+stack_sampler = StackSampler()
+
+
+def profiled_endpoint(endpoint):
+    """包装同步接口：记录执行线程，按需在 cProfile 下运行。"""
+    @functools.wraps(endpoint)
+    def wrapper(*args, **kwargs):
+        state = request_profile.get()
+        if state is None:
+            return endpoint(*args, **kwargs)
+        state.thread_id = threading.get_ident()
+        if state.mode != "cprofile":
+            return endpoint(*args, **kwargs)
+        state.profile = cProfile.Profile()
+        state.profile.enable()
+        try:
+            return endpoint(*args, **kwargs)
+        finally:
+            state.profile.disable()
+    return wrapper
+
+
+class ProfiledRoute(APIRoute):
+    def __init__(self, path: str, endpoint, **kwargs):
+        if not asyncio.iscoroutinefunction(endpoint):
+            endpoint = profiled_endpoint(endpoint)
+        super().__init__(path, endpoint, **kwargs)
+
+
+app.router.route_class = ProfiledRoute
+
+
+def requested_profile_mode(scope):
+    """
+    只有管理员可以通过 X-Profile 请求头或 ?profile= 参数开启分析：
+    cprofile 为确定性分析，其他取值为采样分析。
+    身份只取自会话令牌，没有有效的管理员令牌时不开启。
+    """
+    headers = dict(scope["headers"])
+    query = urllib.parse.parse_qs(scope.get("query_string", b"").decode("latin-1"))
+    value = headers.get(b"x-profile", b"").decode("latin-1") or query.get("profile", [""])[0]
+    if not value or value in ("0", "false"):
+        return None
+    authorization = headers.get(b"authorization", b"").decode("latin-1")
+    if not authorization.startswith("Bearer "):
+        return None
+    claims = verify_session_token(authorization[len("Bearer "):])
+    if claims is None or claims["role"] != "admin":
+        return None
+    return "cprofile" if value == "cprofile" else "sample"
+
+
+def write_profile_report(state: RequestProfile):
+    os.makedirs(PROFILES_DIR, exist_ok=True)
+    method = state.scope["method"]
+    lines = [
+        f"{method} {state.scope['path']}",
+        f"route: {state.route()}",
+        f"status: {state.status}",
+        f"elapsed: {state.elapsed * 1000:.1f} ms",
+        f"mode: {'slow' if state.slow else state.mode}",
+        f"samples: {state.sample_count} (每 {PROFILE_SAMPLE_INTERVAL * 1000:.0f} ms 一次)",
+    ]
+    if state.slow:
+        lines.append(f"采样从请求超过 {SLOW_REQUEST_THRESHOLD * 1000:.0f} ms 时开始")
+    base = os.path.join(PROFILES_DIR, state.name)
+    if state.profile is not None:
+        state.profile.dump_stats(f"{base}.prof")
+        text = io.StringIO()
+        pstats.Stats(state.profile, stream=text).sort_stats("cumulative").print_stats(50)
+        lines.extend(["", text.getvalue()])
+    if state.samples:
+        with open(f"{base}.folded", "w", encoding="utf-8") as f:
+            for stack, count in sorted(state.samples.items()):
+                f.write(f"{stack} {count}\n")
+    with open(f"{base}.txt", "w", encoding="utf-8") as f:
+        f.write("\n".join(lines) + "\n")
+    prune_profile_reports()
+
+
+def list_profile_reports():
+    """按报告名分组，返回从新到旧的报告列表。"""
+    if not os.path.exists(PROFILES_DIR):
+        return []
+    reports = {}
+    for filename in os.listdir(PROFILES_DIR):
+        stem, _, ext = filename.rpartition(".")
+        if not stem:
+            continue
+        path = os.path.join(PROFILES_DIR, filename)
+        report = reports.setdefault(stem, {"name": stem, "files": [], "time": 0.0})
+        report["files"].append(filename)
+        report["time"] = max(report["time"], os.path.getmtime(path))
+    return sorted(reports.values(), key=lambda r: r["time"], reverse=True)
+
+
+def prune_profile_reports():
+    for report in list_profile_reports()[PROFILE_MAX_REPORTS:]:
+        for filename in report["files"]:
+            try:
+                os.remove(os.path.join(PROFILES_DIR, filename))
+            except OSError:
+                pass
+
+
+class ProfilingMiddleware:
+    """管理员按需分析单个请求；开启慢请求模式时自动采样超过阈值的请求。"""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        mode = requested_profile_mode(scope)
+        if mode is None and not SLOW_REQUEST_THRESHOLD:
+            await self.app(scope, receive, send)
+            return
+
+        state = RequestProfile(scope, mode)
+        slug = re.sub(r"[^A-Za-z0-9]+", "_", scope["path"]).strip("_")[:60]
+        state.name = f"{datetime.datetime.now():%Y%m%d-%H%M%S}-{scope['method']}-{slug}-{uuid.uuid4().hex[:6]}"
+
+        async def send_wrapper(message):
+            if message["type"] == "http.response.start":
+                state.status = message["status"]
+                if mode is not None:
+                    headers = list(message.get("headers", []))
+                    headers.append((b"x-profile-report", state.name.encode("latin-1")))
+                    message = {**message, "headers": headers}
+            await send(message)
+
+        token = request_profile.set(state)
+        stack_sampler.track(state)
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            stack_sampler.untrack(state)
+            request_profile.reset(token)
+            state.elapsed = time.perf_counter() - state.start
+            if state.sampling:
+                try:
+                    await run_in_threadpool(write_profile_report, state)
+                except OSError as e:
+                    print(f"Profile report failed: {e}")
+
+
+app.add_middleware(ProfilingMiddleware)
+
+def perform_data_backup():
+    """
+    备份 data 文件夹并保留最近 3 天的数据。
+    增加了额外的日期锁文件检查，确保全站每天仅触发一次备份。
+    """
+    today_str = datetime.date.today().strftime("%Y-%m-%d")
+    lock_file = os.path.join(BACKUP_DIR, f".backup_done_{today_str}")
+    backup_path = os.path.join(BACKUP_DIR, today_str)
+    
+    # 只要锁文件存在，说明今天已经备份过了
+    if os.path.exists(lock_file):
+        return
+
+    # 执行备份
+    if not os.path.exists(backup_path):
+        try:
+            shutil.copytree(DATA_DIR, backup_path)
+            # 写入锁文件，防止其他用户再次触发
+            with metered_open(lock_file, "w") as f:
+                f.write(datetime.datetime.now().strftime("%H:%M:%S"))
+            print(f"Daily full backup completed to {backup_path}")
+        except Exception as e:
+            print(f"Backup failed: {e}")
+            return # 失败时不执行清理
+            
+    # 清理 3 天前的备份和对应的锁文件
+    try:
+        all_items = os.listdir(BACKUP_DIR)
+        dirs = sorted([d for d in all_items if os.path.isdir(os.path.join(BACKUP_DIR, d))])
+        
+        if len(dirs) > 3:
+            for old_backup in dirs[:-3]:
+                shutil.rmtree(os.path.join(BACKUP_DIR, old_backup))
+                # 同时尝试清理旧的锁文件
+                old_lock = os.path.join(BACKUP_DIR, f".backup_done_{old_backup}")
+                if os.path.exists(old_lock):
+                    os.remove(old_lock)
+                print(f"Deleted expired backup and lock: {old_backup}")
+    except Exception as e:
+        print(f"Cleanup failed: {e}")
+
+@instrumented("read_node_files")
+def read_node_files():
+    nodes = []
+    if os.path.exists(DATA_DIR):
+        for filename in os.listdir(DATA_DIR):
+            if filename.endswith(".json"):
+                try:
+                    with metered_open(os.path.join(DATA_DIR, filename), "r", encoding="utf-8") as f:
+                        node = json.load(f)
+                        nodes.append(node)
+                except (json.JSONDecodeError, IOError):
+                    continue
+    return nodes
+
+def load_data():
+    return {"nodes": list(graph_index.ensure_loaded().values())}
+
+
+# --- 打包快照与多进程同步 ---
+#
+# data/*.json 仍是唯一的写入源。每次写入节点文件后在 graph.journal 末尾追加一行 "<写入者> put|del <id>"，
+# 其他进程（多个 uvicorn worker 或命令行脚本）读取时只需 stat 一次日志文件，发现变化后重新读取对应的节点文件。
+# 写入平息后在后台把整个图写成 graph.snapshot：启动时只需读取这一个文件，不必逐个打开 data 文件夹中的节点文件，
+# 但仍会把其中的全部节点解析出来建立内存索引。快照保持映射，内存中的图与它一致（之后没有任何写入或重放）时，
+# GET /api/nodes 直接返回快照的 JSON 区，GET /api/nodes/{id} 按快照末尾的 id 索引取出该节点的 JSON 字节。
+# 日志超过 JOURNAL_ROTATE_BYTES 时在排他锁下写出最新快照并换用新日志（epoch + 1），其他进程发现后重新映射快照。
+# 用 rollback.py 等方式直接替换 data 文件夹后，需要删除 graph.snapshot 与 graph.journal。
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+# 设置为 0 时不读写快照，总是从 data 文件夹加载
+GRAPH_SNAPSHOT = os.getenv("GRAPH_SNAPSHOT", "1") == "1"
+SNAPSHOT_MAGIC = b"AGSN"
+SNAPSHOT_FORMAT = 1
+# magic、格式版本、保留位、日志 epoch、快照覆盖到的日志位置、节点数、crc32、JSON 区字节数
+SNAPSHOT_HEADER = struct.Struct("<4sHHQQIIQ")
+# 索引项：节点 id、在 JSON 区中的偏移、长度（按 id 排序）
+SNAPSHOT_ENTRY = struct.Struct("<qQI")
+SNAPSHOT_DEBOUNCE = 2.0
+SNAPSHOT_MAX_DELAY = 30.0
+JOURNAL_ROTATE_BYTES = 1 << 20
+# 区分日志中的写入者，跳过自己写入的条目
+JOURNAL_WRITER = uuid.uuid4().hex[:12]
+
+
+class GraphSnapshot:
+    """
+    只读映射的图快照。JSON 区就是 GET /api/nodes 的完整响应体，每个节点在其中的位置由索引给出，
+    多个进程映射同一个文件时共享页缓存。
+    """
+
+    def __init__(self, path: str):
+        with open(path, "rb") as f:
+            self.mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            if len(self.mm) < SNAPSHOT_HEADER.size:
+                raise ValueError("快照文件不完整")
+            (magic, fmt, _, self.epoch, self.journal_pos, self.count,
+             checksum, self.body_length) = SNAPSHOT_HEADER.unpack_from(self.mm, 0)
+            if magic != SNAPSHOT_MAGIC or fmt != SNAPSHOT_FORMAT:
+                raise ValueError("不支持的快照格式")
+            self.index_offset = SNAPSHOT_HEADER.size + self.body_length
+            if len(self.mm) != self.index_offset + self.count * SNAPSHOT_ENTRY.size:
+                raise ValueError("快照文件不完整")
+            if zlib.crc32(memoryview(self.mm)[SNAPSHOT_HEADER.size:]) != checksum:
+                raise ValueError("快照校验失败")
+        except Exception:
+            self.mm.close()
+            raise
+
+    def body(self):
+        return self.mm[SNAPSHOT_HEADER.size:self.index_offset]
+
+    def nodes(self):
+        return json.loads(self.body())["nodes"]
+
+    def record(self, node_id: int):
+        """二分查找索引，返回单个节点的 JSON 字节；不存在时返回 None。"""
+        lo, hi = 0, self.count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            entry_id, offset, length = SNAPSHOT_ENTRY.unpack_from(self.mm, self.index_offset + mid * SNAPSHOT_ENTRY.size)
+            if entry_id == node_id:
+                start = SNAPSHOT_HEADER.size + offset
+                return self.mm[start:start + length]
+            if entry_id < node_id:
+                lo = mid + 1
+            else:
+                hi = mid
+        return None
+
+    def close(self):
+        self.mm.close()
+
+
+def open_graph_snapshot():
+    if not GRAPH_SNAPSHOT or not os.path.exists(SNAPSHOT_FILE):
+        return None
+    try:
+        return GraphSnapshot(SNAPSHOT_FILE)
+    except (OSError, ValueError, struct.error) as e:
+        print(f"Ignoring graph snapshot: {e}")
+        return None
+
+
+@instrumented("write_graph_snapshot")
+def write_graph_snapshot(nodes: list, epoch: int, journal_pos: int):
+    nodes = sorted(nodes, key=lambda n: n["id"])
+    records = [json_bytes(n) for n in nodes]
+    prefix = b'{"nodes":['
+    entries, offset = [], len(prefix)
+    for node, record in zip(nodes, records):
+        entries.append(SNAPSHOT_ENTRY.pack(node["id"], offset, len(record)))
+        offset += len(record) + 1
+    body = prefix + b",".join(records) + b"]}"
+    tail = body + b"".join(entries)
+    header = SNAPSHOT_HEADER.pack(SNAPSHOT_MAGIC, SNAPSHOT_FORMAT, 0, epoch, journal_pos,
+                                  len(nodes), zlib.crc32(tail), len(body))
+    tmp_path = f"{SNAPSHOT_FILE}.{uuid.uuid4().hex}.tmp"
+    try:
+        with metered_open(tmp_path, "wb") as f:
+            f.write(header)
+            f.write(tail)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, SNAPSHOT_FILE)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+
+@contextmanager
+def file_lock(path: str, exclusive: bool = False):
+    """跨进程的文件锁；没有 fcntl 的平台上不加锁。"""
+    if fcntl is None:
+        yield
+        return
+    with open(path, "a") as f:
+        fcntl.flock(f.fileno(), fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+        try:
+            yield
+        finally:
+            fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+
+
+class StoreLock:
+    """
+    多个 worker 共用的 JSON 文件在修改时使用的锁：进程内可重入，同一线程嵌套加锁时只在最外层取文件锁。
+    加锁顺序固定为先文件锁、后 inner（存储对象自身的 RLock），只读访问只需要 inner。
+    """
+
+    def __init__(self, path: str, inner: threading.RLock):
+        self.path = path
+        self.inner = inner
+        self._local = threading.local()
+
+    def __enter__(self):
+        depth = getattr(self._local, "depth", 0)
+        if depth == 0:
+            held = file_lock(self.path, exclusive=True)
+            held.__enter__()
+            self._local.held = held
+        self.inner.acquire()
+        self._local.depth = depth + 1
+        return self
+
+    def __exit__(self, *exc):
+        self._local.depth -= 1
+        self.inner.release()
+        if self._local.depth == 0:
+            held, self._local.held = self._local.held, None
+            held.__exit__(None, None, None)
+
+
+def journal_lock(exclusive: bool = False):
+    """追加日志时持共享锁，换用新日志时持排他锁；没有 fcntl 的平台上不加锁（也不会换用新日志）。"""
+    return file_lock(JOURNAL_LOCK_FILE, exclusive)
+
+
+def append_journal(op: str, node_ids):
+    lines = "".join(f"{JOURNAL_WRITER} {op} {node_id}\n" for node_id in node_ids)
+    if not lines:
+        return
+    if graph_index.lock.held():
+        # 持有索引锁时不能再等日志文件锁（write_snapshot 先取文件锁再取索引锁），释放索引锁后再追加
+        graph_index.lock.defer(op, node_ids)
+        return
+    with journal_lock():
+        fd = os.open(JOURNAL_FILE, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        try:
+            os.write(fd, lines.encode("ascii"))
+        finally:
+            os.close(fd)
+    if GRAPH_SNAPSHOT:
+        snapshot_scheduler.schedule()
+    if STATIC_EXPORT_DIR:
+        static_export_scheduler.schedule()
+
+
+def read_journal_epoch(data: bytes):
+    if data.startswith(b"epoch "):
+        line, _, _ = data.partition(b"\n")
+        try:
+            return int(line[6:]), len(line) + 1
+        except ValueError:
+            pass
+    return 0, 0
+
+
+class DebouncedTask:
+    """在最后一次 schedule 之后 delay 秒于后台执行 fn；持续触发时最多推迟 max_delay 秒。"""
+
+    def __init__(self, name: str, fn, delay: float, max_delay: float):
+        self.name = name
+        self.fn = fn
+        self.delay = delay
+        self.max_delay = max_delay
+        self.lock = threading.Lock()
+        self.timer = None
+        self.first_pending = None
+
+    def schedule(self):
+        with self.lock:
+            now = time.monotonic()
+            if self.timer is not None:
+                if now - self.first_pending >= self.max_delay:
+                    return
+                self.timer.cancel()
+            else:
+                self.first_pending = now
+            self.timer = threading.Timer(self.delay, self._run)
+            self.timer.daemon = True
+            self.timer.start()
+
+    def _run(self):
+        with self.lock:
+            self.timer = None
+        try:
+            self.fn()
+        except Exception as e:
+            print(f"{self.name} failed: {e}")
+
+
+snapshot_scheduler = DebouncedTask("Graph snapshot", lambda: graph_index.write_snapshot(), SNAPSHOT_DEBOUNCE, SNAPSHOT_MAX_DELAY)
+
+
+class IndexLock:
+    """
+    GraphIndex 的可重入锁。加锁顺序固定为先日志文件锁、后索引锁：
+    持有本锁期间调用 append_journal 的日志行会暂存，在最外层释放之后才写入日志文件。
+    暂存期间内存中的索引已包含这些修改，此时写出的快照也包含它们，之后再追加的日志行只会被重复重放。
+    """
+
+    def __init__(self):
+        self._lock = threading.RLock()
+        self._local = threading.local()
+
+    def __enter__(self):
+        self._lock.acquire()
+        self._local.depth = getattr(self._local, "depth", 0) + 1
+        return self
+
+    def __exit__(self, *exc):
+        self._local.depth -= 1
+        pending = None
+        if self._local.depth == 0:
+            pending, self._local.pending = getattr(self._local, "pending", None), None
+        self._lock.release()
+        for op, node_ids in pending or ():
+            append_journal(op, node_ids)
+
+    def held(self):
+        return getattr(self._local, "depth", 0) > 0
+
+    def defer(self, op: str, node_ids):
+        if getattr(self._local, "pending", None) is None:
+            self._local.pending = []
+        self._local.pending.append((op, list(node_ids)))
+
+
+class GraphIndex:
+    """
+    data 文件夹中所有节点的内存索引。
+    首次访问时从磁盘加载一次，之后由 save_node / delete_node_file 同步更新，
+    每次变更都会递增 version，派生数据（如聚类层级）据此判断是否需要重建。
+
+    同时增量维护 extension 关系的血缘信息：
+    - parents：引用某节点的所有父节点
+    - tree_parent / tree_children：以 id 最小的父节点作为树上的父节点，roots 为没有父节点的节点
+    - 子树摘要（节点数、包围盒、代表图片）按需计算并缓存，连线、位置或图片变化时
+      只让变化点到根路径上的缓存失效；后代数量与聚类层级都由它得出
+    """
+
+    def __init__(self):
+        self.lock = IndexLock()
+        self.nodes = {}
+        self.loaded = False
+        self.version = 0
+        self.parents = {}
+        self.tree_parent = {}
+        self.tree_children = {}
+        self.roots = set()
+        self._summaries = {}
+        # 多进程同步状态：已读到的日志 epoch / 位置 / 文件标识，以及映射中的快照
+        self.journal_epoch = 0
+        self.journal_pos = 0
+        self.journal_stat = None
+        self.snapshot = None
+        self.snapshot_version = None
+
+    def ensure_loaded(self):
+        with self.lock:
+            if not self.loaded:
+                self._load()
+            else:
+                self.sync()
+            return self.nodes
+
+    def _build(self, nodes):
+        self.nodes = {n["id"]: n for n in nodes if "id" in n}
+        self.parents, self.tree_parent, self.tree_children, self._summaries = {}, {}, {}, {}
+        for node_id, node in self.nodes.items():
+            for child_id in node.get("extension", []):
+                self.parents.setdefault(child_id, set()).add(node_id)
+        # 初始构建时没有需要失效的缓存，直接取 id 最小的父节点，避免逐个 _retree 沿祖先链向上遍历
+        for child_id, parents in self.parents.items():
+            candidates = [p for p in parents if p in self.nodes and p != child_id]
+            if candidates and child_id in self.nodes:
+                parent_id = min(candidates)
+                self.tree_parent[child_id] = parent_id
+                self.tree_children.setdefault(parent_id, set()).add(child_id)
+        self.roots = {node_id for node_id in self.nodes if node_id not in self.tree_parent}
+        self.loaded = True
+        self.version += 1
+
+    def _load(self):
+        """优先从快照加载并重放其后的日志；快照缺失、损坏或落后于日志时从 data 文件夹加载。"""
+        journal = self._read_journal()
+        epoch = read_journal_epoch(journal)[0] if journal is not None else 0
+        if self.snapshot is not None:
+            self.snapshot.close()
+        self.snapshot = open_graph_snapshot()
+        if self.snapshot is not None and self.snapshot.epoch >= epoch:
+            self._build(self.snapshot.nodes())
+            self.snapshot_version = self.version
+            if self.snapshot.epoch == epoch and journal is not None:
+                self.journal_epoch, self.journal_pos = epoch, self.snapshot.journal_pos
+                self._replay(journal)
+            else:
+                # 快照已包含旧日志中的全部内容
+                self.journal_epoch, self.journal_pos = epoch, len(journal or b"")
+        else:
+            # 先记下日志位置再读文件，读文件期间的写入会在下次同步时重放
+            self._build(read_node_files())
+            self.snapshot_version = None
+            self.journal_epoch, self.journal_pos = epoch, len(journal or b"")
+            if GRAPH_SNAPSHOT:
+                snapshot_scheduler.schedule()
+
+    def _read_journal(self):
+        try:
+            with open(JOURNAL_FILE, "rb") as f:
+                self.journal_stat = os.fstat(f.fileno())
+                return f.read()
+        except FileNotFoundError:
+            self.journal_stat = None
+            return None
+
+    def _replay(self, journal: bytes):
+        end = journal.rfind(b"\n", self.journal_pos) + 1
+        if end <= self.journal_pos:
+            return
+        changed = set()
+        for line in journal[self.journal_pos:end].decode("ascii", "replace").splitlines():
+            parts = line.split()
+            if len(parts) == 3 and parts[0] != JOURNAL_WRITER and parts[2].lstrip("-").isdigit():
+                changed.add(int(parts[2]))
+        self.journal_pos = end
+        for node_id in sorted(changed):
+            # 以文件的当前内容为准，所以 put/del 不必区分，多次写入同一节点只需读一次
+            try:
+                with metered_open(os.path.join(DATA_DIR, f"{node_id}.json"), "r", encoding="utf-8") as f:
+                    self.put(json.load(f))
+            except FileNotFoundError:
+                self.remove(node_id)
+            except (json.JSONDecodeError, OSError):
+                continue
+
+    def sync(self):
+        """读取其他进程追加的日志；日志未变化时只有一次 stat。"""
+        if not GRAPH_SNAPSHOT:
+            return
+        try:
+            st = os.stat(JOURNAL_FILE)
+        except FileNotFoundError:
+            if self.journal_stat is not None:
+                # 日志被删除（例如旧版回滚脚本）：无法知道删除前后的变化，从头加载
+                with self.lock:
+                    self._load()
+            return
+        with self.lock:
+            previous = self.journal_stat
+            if previous is not None and (st.st_ino, st.st_size) == (previous.st_ino, previous.st_size):
+                return
+            journal = self._read_journal()
+            if journal is None:
+                return
+            epoch = read_journal_epoch(journal)[0]
+            if previous is not None and (self.journal_stat.st_ino != previous.st_ino or epoch != self.journal_epoch):
+                # 日志已换新：重新映射最新快照并从头重放
+                self._load()
+            else:
+                self._replay(journal)
+
+    def _remap(self, version: int):
+        if self.snapshot is not None:
+            self.snapshot.close()
+        self.snapshot = open_graph_snapshot()
+        # 快照写出期间内存中的图若又有变化，就不能再直接用快照作为 /api/nodes 的响应
+        self.snapshot_version = version if self.snapshot is not None and self.version == version else None
+
+    def write_snapshot(self):
+        """把当前内存中的图写成快照；日志过大且支持文件锁时同时换用新日志。"""
+        rotate = fcntl is not None and self.journal_stat is not None and self.journal_stat.st_size > JOURNAL_ROTATE_BYTES
+        with journal_lock(exclusive=rotate):
+            with self.lock:
+                self.ensure_loaded()
+                nodes = list(self.nodes.values())
+                epoch, pos, version = self.journal_epoch, self.journal_pos, self.version
+            if not rotate:
+                write_graph_snapshot(nodes, epoch, pos)
+                with self.lock:
+                    self._remap(version)
+                return
+            # 持有排他锁时其他进程无法追加日志，快照包含旧日志中的全部内容
+            header = f"epoch {epoch + 1}\n".encode("ascii")
+            write_graph_snapshot(nodes, epoch + 1, len(header))
+            tmp_path = f"{JOURNAL_FILE}.{uuid.uuid4().hex}.tmp"
+            with open(tmp_path, "wb") as f:
+                f.write(header)
+            os.replace(tmp_path, JOURNAL_FILE)
+            with self.lock:
+                self.journal_epoch, self.journal_pos = epoch + 1, len(header)
+                self._read_journal()
+                self._remap(version)
+
+    def put(self, node):
+        with self.lock:
+            # 尚未加载时无需处理，之后的加载会直接读到磁盘上的新内容
+            if self.loaded:
+                node_id = node["id"]
+                old = self.nodes.get(node_id)
+                old_ext = set(old.get("extension", [])) if old else set()
+                new_ext = set(node.get("extension", []))
+                self.nodes[node_id] = node
+                for child_id in old_ext - new_ext:
+                    self.parents.get(child_id, set()).discard(node_id)
+                    self._retree(child_id)
+                for child_id in new_ext - old_ext:
+                    self.parents.setdefault(child_id, set()).add(node_id)
+                    self._retree(child_id)
+                if old is None:
+                    self._retree(node_id)
+                elif any(old.get(k) != node.get(k) for k in ("x", "y", "image")):
+                    self._invalidate_upwards(node_id)
+            self.version += 1
+
+    def remove(self, node_id: int):
+        with self.lock:
+            if self.loaded:
+                node = self.nodes.pop(node_id, None)
+                if node is not None:
+                    for child_id in node.get("extension", []):
+                        self.parents.get(child_id, set()).discard(node_id)
+                        self._retree(child_id)
+                    self._retree(node_id)
+                    self._summaries.pop(node_id, None)
+            self.version += 1
+
+    def _retree(self, node_id: int):
+        candidates = [p for p in self.parents.get(node_id, ()) if p in self.nodes and p != node_id]
+        new_parent = min(candidates) if candidates and node_id in self.nodes else None
+        old_parent = self.tree_parent.get(node_id)
+        if new_parent is None and node_id in self.nodes:
+            self.roots.add(node_id)
+        else:
+            self.roots.discard(node_id)
+        if new_parent == old_parent:
+            return
+        self._invalidate_upwards(old_parent)
+        self._invalidate_upwards(new_parent)
+        if old_parent is not None:
+            self.tree_children[old_parent].discard(node_id)
+            del self.tree_parent[node_id]
+        if new_parent is not None:
+            self.tree_parent[node_id] = new_parent
+            self.tree_children.setdefault(new_parent, set()).add(node_id)
+
+    def _invalidate_upwards(self, node_id):
+        seen = set()
+        while node_id is not None and node_id not in seen:
+            seen.add(node_id)
+            self._summaries.pop(node_id, None)
+            node_id = self.tree_parent.get(node_id)
+
+    def lineage(self, node_id: int):
+        """沿父节点指针走到根，耗时与路径长度成正比。"""
+        with self.lock:
+            path = [node_id]
+            seen = {node_id}
+            in_cycle = False
+            current = self.tree_parent.get(node_id)
+            while current is not None:
+                if current in seen:
+                    in_cycle = True
+                    break
+                seen.add(current)
+                path.append(current)
+                current = self.tree_parent.get(current)
+            path.reverse()
+            return {
+                "path": path,
+                "in_cycle": in_cycle,
+                "other_parents": sorted(p for p in self.parents.get(node_id, ())
+                                        if p in self.nodes and p != self.tree_parent.get(node_id))
+            }
+
+    def summary(self, node_id: int):
+        """
+        子树的 (节点数, 包围盒 [x1, y1, x2, y2], 代表图片)，结果缓存到相关连线、位置或图片发生变化为止。
+        代表图片为节点自己的图片，没有时取最大子树的代表图片。
+        """
+        with self.lock:
+            if node_id in self._summaries:
+                return self._summaries[node_id]
+            order, stack, seen = [], [node_id], set()
+            while stack:
+                current = stack.pop()
+                if current in seen:
+                    continue
+                seen.add(current)
+                order.append(current)
+                stack.extend(c for c in self.tree_children.get(current, ()) if c not in self._summaries)
+            for current in reversed(order):
+                node = self.nodes.get(current, {})
+                x, y = float(node.get("x", 0.0)), float(node.get("y", 0.0))
+                total, box, best = 1, [x, y, x, y], None
+                for child_id in sorted(self.tree_children.get(current, ())):
+                    # 环上回到起点的连线此时还没有结果，跳过即可在起点处断开环
+                    child = self._summaries.get(child_id)
+                    if child is None:
+                        continue
+                    total += child[0]
+                    box = [min(box[0], child[1][0]), min(box[1], child[1][1]),
+                           max(box[2], child[1][2]), max(box[3], child[1][3])]
+                    if best is None or child[0] > best[0]:
+                        best = child
+                image = node.get("image") or (best[2] if best else DEFAULT_IMAGE_URL)
+                self._summaries[current] = (total, box, image)
+            return self._summaries[node_id]
+
+    def descendant_count(self, node_id: int):
+        """统计子树中的后代数量，结果缓存到相关连线发生变化为止。"""
+        return self.summary(node_id)[0] - 1
+
+    def subtree(self, node_id: int, max_depth: Optional[int] = None, limit: Optional[int] = None):
+        """按层遍历子树，耗时与返回的子树规模成正比。"""
+        with self.lock:
+            result = []
+            queue = deque([(node_id, 0)])
+            seen = {node_id}
+            truncated = False
+            while queue:
+                current, depth = queue.popleft()
+                if current != node_id:
+                    if limit is not None and len(result) >= limit:
+                        truncated = True
+                        break
+                    result.append((current, depth))
+                if max_depth is not None and depth >= max_depth:
+                    continue
+                for child_id in sorted(self.tree_children.get(current, ())):
+                    if child_id not in seen:
+                        seen.add(child_id)
+                        queue.append((child_id, depth + 1))
+            return result, truncated
+
+
+graph_index = GraphIndex()
+
+@instrumented("save_node")
+def save_node(node):
+    node_id = node.get("id")
+    if node_id is None:
+        return
+    with metered_open(os.path.join(DATA_DIR, f"{node_id}.json"), "w", encoding="utf-8") as f:
+        json.dump(node, f, ensure_ascii=False, indent=2)
+    graph_index.put(node)
+    append_journal("put", [node_id])
+
+@instrumented("write_json_files")
+def write_json_files(entries):
+    """
+    写入多个 JSON 文件：先全部写入同目录下的临时文件并落盘，全部成功后再逐个替换。
+    每个文件的替换是原子的，但多个文件之间不是：替换过程中进程崩溃时，可能只有一部分文件是新内容。
+    临时文件写入阶段出错时，已写出的临时文件会被清理，原文件全部保持不变。
+    """
+    staged = []
+    try:
+        for path, content in entries:
+            tmp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+            staged.append((tmp_path, path))
+            with metered_open(tmp_path, "w", encoding="utf-8") as f:
+                json.dump(content, f, ensure_ascii=False, indent=2)
+                f.flush()
+                os.fsync(f.fileno())
+    except Exception:
+        for tmp_path, _ in staged:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+        raise
+    for tmp_path, path in staged:
+        os.replace(tmp_path, path)
+
+def save_nodes(nodes):
+    """一次性写入多个节点文件，用于需要整体生效的批量修改。"""
+    write_json_files([(os.path.join(DATA_DIR, f"{n['id']}.json"), n) for n in nodes])
+    for node in nodes:
+        graph_index.put(node)
+    append_journal("put", [n["id"] for n in nodes])
+
+def clean_old_new_status():
+    """
+    遍历所有节点，检查 'new' 属性。如果创建于 3 天前，则移除 'new' 状态。
+    """
+    if not os.path.exists(DATA_DIR):
+        return
+    
+    today = datetime.date.today()
+    threshold = today - datetime.timedelta(days=3)
+    
+    for filename in os.listdir(DATA_DIR):
+        if filename.endswith(".json"):
+            filepath = os.path.join(DATA_DIR, filename)
+            try:
+                with metered_open(filepath, "r", encoding="utf-8") as f:
+                    node = json.load(f)
+                
+                changed = False
+                # 如果有 new 属性且为 True
+                if node.get("new"):
+                    created_at_str = node.get("time") # 格式: YYYY-MM-DD
+                    if created_at_str:
+                        try:
+                            created_at = datetime.datetime.strptime(created_at_str, "%Y-%m-%d").date()
+                            if created_at <= threshold:
+                                node["new"] = False
+                                changed = True
+                        except ValueError:
+                            pass
+                
+                if changed:
+                    save_node(node)
+            except Exception:
+                continue
+
+def delete_node_file(node_id: int):
+    # Load node data to find image path
+    file_path = os.path.join(DATA_DIR, f"{node_id}.json")
+    if os.path.exists(file_path):
+        try:
+            with metered_open(file_path, "r", encoding="utf-8") as f:
+                node = json.load(f)
+                image_url = node.get("image", "")
+                # Delete image if it is not default
+                if image_url and not image_url.endswith("default.png") and image_url.startswith("/images/"):
+                    image_path = image_storage_path(image_url)
+                    if image_path and os.path.exists(image_path):
+                        os.remove(image_path)
+        except:
+            pass
+        os.remove(file_path)
+    graph_index.remove(node_id)
+    append_journal("del", [node_id])
+
+@instrumented("load_applications")
+def load_applications():
+    if not os.path.exists(APPLICATIONS_FILE):
+        return []
+    try:
+        with metered_open(APPLICATIONS_FILE, "r", encoding="utf-8") as f:
+            content = f.read().strip()
+            return json.loads(content) if content else []
+    except (json.JSONDecodeError, IOError):
+        return []
+
+@instrumented("save_applications")
+def save_applications(apps):
+    """原子地替换 applications.json，其他 worker 不会读到写了一半的文件；写入失败时抛出异常。"""
+    write_json_files([(APPLICATIONS_FILE, apps)])
+
+class ApplicationStore:
+    """
+    待认证申请的内存索引：按申请 id 和节点 id 分别索引，并保持提交顺序。
+    多个 worker 共用 applications.json：每次访问前比较文件的修改时间与大小，其他进程写入过就重新加载；
+    修改时持 write_lock，在锁内重新检查文件，先写文件再更新索引。
+    """
+
+    def __init__(self):
+        self.lock = threading.RLock()
+        self.write_lock = StoreLock(APPLICATIONS_LOCK_FILE, self.lock)
+        self.loaded = False
+        self.stamp = None
+        self.by_id = {}
+        self.by_node = {}
+
+    @staticmethod
+    def _stat():
+        try:
+            st = os.stat(APPLICATIONS_FILE)
+            return st.st_mtime_ns, st.st_size
+        except OSError:
+            return None
+
+    def ensure_loaded(self):
+        with self.lock:
+            # 先取文件状态再读文件：两者之间文件被替换时，下次访问会再加载一次
+            stamp = self._stat()
+            if not self.loaded or stamp != self.stamp:
+                self.by_id = {a["id"]: a for a in load_applications() if "id" in a}
+                self.by_node = {a["node_id"]: a["id"] for a in self.by_id.values()}
+                self.loaded, self.stamp = True, stamp
+
+    def has_node(self, node_id: int):
+        with self.lock:
+            self.ensure_loaded()
+            return node_id in self.by_node
+
+    def get(self, app_id: str):
+        with self.lock:
+            self.ensure_loaded()
+            return self.by_id.get(app_id)
+
+    def count(self):
+        with self.lock:
+            self.ensure_loaded()
+            return len(self.by_id)
+
+    def page(self, offset: int, limit: int):
+        with self.lock:
+            self.ensure_loaded()
+            return list(itertools.islice(self.by_id.values(), offset, offset + limit))
+
+    def all(self):
+        with self.lock:
+            self.ensure_loaded()
+            return list(self.by_id.values())
+
+    def without(self, app_id: str):
+        """移除指定申请后应写回文件的完整列表（不修改索引）。调用方须持有 write_lock，直到写完文件并调用 discard。"""
+        with self.lock:
+            self.ensure_loaded()
+            return [a for a in self.by_id.values() if a["id"] != app_id]
+
+    def add(self, application: dict):
+        with self.write_lock:
+            self.ensure_loaded()
+            save_applications(list(self.by_id.values()) + [application])
+            self.by_id[application["id"]] = application
+            self.by_node[application["node_id"]] = application["id"]
+            self.stamp = self._stat()
+
+    def discard(self, app_id: str):
+        """调用方已在持有 write_lock 期间把 without(app_id) 写回文件后调用。"""
+        with self.write_lock:
+            application = self.by_id.pop(app_id, None)
+            if application and self.by_node.get(application["node_id"]) == app_id:
+                del self.by_node[application["node_id"]]
+            self.stamp = self._stat()
+
+
+application_store = ApplicationStore()
+
+@instrumented("load_mailbox")
+def load_mailbox():
+    if not os.path.exists(MAILBOX_FILE):
+        return []
+    try:
+        with metered_open(MAILBOX_FILE, "r", encoding="utf-8") as f:
+            content = f.read().strip()
+            return json.loads(content) if content else []
+    except (json.JSONDecodeError, IOError):
+        return []
+
+@instrumented("save_mailbox")
+def save_mailbox(messages):
+    """原子地替换 mailbox.json，其他 worker 不会读到写了一半的文件；写入失败时抛出异常。"""
+    write_json_files([(MAILBOX_FILE, messages)])
+
+@instrumented("load_mail_history")
+def load_mail_history():
+    if not os.path.exists(MAILBOX_HISTORY_FILE):
+        return []
+    try:
+        with metered_open(MAILBOX_HISTORY_FILE, "r", encoding="utf-8") as f:
+            content = f.read().strip()
+            return json.loads(content) if content else []
+    except (json.JSONDecodeError, IOError):
+        return []
+
+@instrumented("save_mail_history")
+def save_mail_history(history):
+    try:
+        with metered_open(MAILBOX_HISTORY_FILE, "w", encoding="utf-8") as f:
+            json.dump(history, f, ensure_ascii=False, indent=2)
+    except IOError:
+        pass
+
+class MailboxStore:
+    """
+    信箱的内存索引。
+    按 id 索引全部信件，并为每种状态维护一个按时间升序排列的 (时间, id) 队列：
+    未处理信件按投递时间排序，已处理/已拒绝信件按处理时间排序。
+    多个 worker 共用 mailbox.json：每次访问前比较文件的修改时间与大小，其他进程写入过就重新加载；
+    修改时持 write_lock，在锁内重新检查文件后更新索引，再整体写回文件。
+    """
+
+    def __init__(self):
+        self.lock = threading.RLock()
+        self.write_lock = StoreLock(MAILBOX_LOCK_FILE, self.lock)
+        self.loaded = False
+        self.stamp = None
+        self.by_id = {}
+        self.queues = {}
+
+    @staticmethod
+    def _stat():
+        try:
+            st = os.stat(MAILBOX_FILE)
+            return st.st_mtime_ns, st.st_size
+        except OSError:
+            return None
+
+    @staticmethod
+    def sort_key(msg):
+        if msg.get("status") == "unprocessed":
+            return (msg.get("time", ""), msg["id"])
+        return (msg.get("processed_time") or msg.get("time", ""), msg["id"])
+
+    def ensure_loaded(self):
+        with self.lock:
+            # 先取文件状态再读文件：两者之间文件被替换时，下次访问会再加载一次
+            stamp = self._stat()
+            if not self.loaded or stamp != self.stamp:
+                self.by_id = {m["id"]: m for m in load_mailbox() if "id" in m}
+                self.queues = {}
+                for msg in self.by_id.values():
+                    self.queues.setdefault(msg.get("status"), []).append(self.sort_key(msg))
+                for queue in self.queues.values():
+                    queue.sort()
+                self.loaded, self.stamp = True, stamp
+
+    def persist(self):
+        """调用方须持有 write_lock。写入失败时索引已与文件不一致，标记为未加载，下次访问重新读取文件。"""
+        try:
+            save_mailbox(list(self.by_id.values()))
+        except OSError:
+            self.loaded = False
+            raise
+        self.stamp = self._stat()
+
+    def get(self, msg_id: str):
+        with self.lock:
+            self.ensure_loaded()
+            return self.by_id.get(msg_id)
+
+    def add(self, msg: dict):
+        with self.write_lock:
+            self.ensure_loaded()
+            self.by_id[msg["id"]] = msg
+            bisect.insort(self.queues.setdefault(msg.get("status"), []), self.sort_key(msg))
+            self.persist()
+
+    def update(self, msg: dict, old_key: tuple, old_status: str):
+        """
+        信件状态或处理时间改变后调用，把它从旧队列移到新队列。
+        msg 须是在同一次持有 write_lock 期间通过 get 取得并修改的，否则可能改到已被重新加载替换掉的旧对象。
+        """
+        with self.write_lock:
+            self._discard(old_status, old_key)
+            bisect.insort(self.queues.setdefault(msg.get("status"), []), self.sort_key(msg))
+            self.persist()
+
+    def _discard(self, status, key):
+        queue = self.queues.get(status, [])
+        i = bisect.bisect_left(queue, key)
+        if i < len(queue) and queue[i] == key:
+            queue.pop(i)
+
+    def unread_count(self):
+        with self.lock:
+            self.ensure_loaded()
+            return len(self.queues.get("unprocessed", []))
+
+    def all_messages(self):
+        """未处理信件在前，其余在后，各自按时间从新到旧。"""
+        with self.lock:
+            self.ensure_loaded()
+            unprocessed = self.queues.get("unprocessed", [])
+            handled = list(heapq.merge(*(q for status, q in self.queues.items() if status != "unprocessed")))
+            return [self.by_id[k[1]] for k in reversed(unprocessed)] + [self.by_id[k[1]] for k in reversed(handled)]
+
+    def page(self, status: str, before: Optional[tuple], limit: int):
+        """返回指定状态下早于游标 before 的最多 limit 封信件（从新到旧）以及下一页的游标。"""
+        with self.lock:
+            self.ensure_loaded()
+            queue = self.queues.get(status, [])
+            end = bisect.bisect_left(queue, before) if before else len(queue)
+            start = max(0, end - limit)
+            keys = queue[start:end][::-1]
+            next_before = keys[-1] if keys and start > 0 else None
+            return [self.by_id[k[1]] for k in keys], next_before
+
+    def archive(self, threshold: datetime.datetime, save_archived):
+        """
+        移出投递时间早于 threshold 的信件并返回它们，时间无法解析的信件保留。
+        先调用 save_archived 保存这些信件，它抛出异常时信箱保持不变，避免信件从两个文件中同时丢失。
+        整个过程持有 write_lock，多个 worker 的归档任务依次执行，不会把同一封信件归档两次。
+        """
+        with self.write_lock:
+            self.ensure_loaded()
+            to_archive = []
+            for msg in self.by_id.values():
+                try:
+                    msg_time = datetime.datetime.strptime(msg["time"], "%Y-%m-%d %H:%M:%S")
+                except (ValueError, KeyError, TypeError):
+                    continue
+                if msg_time < threshold:
+                    to_archive.append(msg)
+            if not to_archive:
+                return to_archive
+            save_archived(to_archive)
+            for msg in to_archive:
+                self._discard(msg.get("status"), self.sort_key(msg))
+                del self.by_id[msg["id"]]
+            self.persist()
+            return to_archive
+
+
+mailbox_store = MailboxStore()
+
+def archive_old_mail():
+    def save_archived(messages):
+        history = load_mail_history()
+        history.extend(messages)
+        # 与 save_mail_history 不同，写入失败时抛出异常，信件留在信箱中等待下次归档
+        write_json_files([(MAILBOX_HISTORY_FILE, history)])
+
+    threshold = datetime.datetime.now() - datetime.timedelta(days=30)
+    try:
+        mailbox_store.archive(threshold, save_archived)
+    except OSError as e:
+        print(f"Mail archive failed: {e}")
+
+@instrumented("load_history")
+def load_history():
+    if not os.path.exists(HISTORY_FILE):
+        return []
+    try:
+        with metered_open(HISTORY_FILE, "r", encoding="utf-8") as f:
+            content = f.read().strip()
+            return json.loads(content) if content else []
+    except (json.JSONDecodeError, IOError):
+        return []
+
+def history_stamp():
+    """history.json 的修改时间与大小，用于判断读取结果是否仍然有效；其他 worker 或命令行脚本写入后同样会变化。"""
+    try:
+        st = os.stat(HISTORY_FILE)
+        return st.st_mtime_ns, st.st_size
+    except OSError:
+        return None
+
+@instrumented("save_history")
+def save_history(history):
+    try:
+        with metered_open(HISTORY_FILE, "w", encoding="utf-8") as f:
+            json.dump(history, f, ensure_ascii=False, indent=2)
+    except IOError:
+        pass
+
+@instrumented("load_history_archive")
+def load_history_archive():
+    if not os.path.exists(HISTORY_ARCHIVE_FILE):
+        return []
+    try:
+        with metered_open(HISTORY_ARCHIVE_FILE, "r", encoding="utf-8") as f:
+            content = f.read().strip()
+            return json.loads(content) if content else []
+    except (json.JSONDecodeError, IOError):
+        return []
+
+@instrumented("save_history_archive")
+def save_history_archive(archive):
+    try:
+        with metered_open(HISTORY_ARCHIVE_FILE, "w", encoding="utf-8") as f:
+            json.dump(archive, f, ensure_ascii=False, indent=2)
+    except IOError:
+        pass
+
+def archive_old_history():
+    history = load_history()
+    if len(history) <= 50:
+        return
+    
+    # 按照时间从新到旧排序（假设 record_action 是 append 到末尾，所以最后面的是最新的）
+    # 但为了保险，我们取最后 50 条作为保留，前面的移入归档
+    to_archive = history[:-50]
+    to_keep = history[-50:]
+    
+    if to_archive:
+        archive = load_history_archive()
+        archive.extend(to_archive)
+        save_history_archive(archive)
+        save_history(to_keep)
+
+# --- 贡献统计 ---
+#
+# stats.json 保存按用户、操作类型、日期、月份汇总的计数，每次 record_action 时增量更新，
+# 查询贡献排行与每日活跃度时无需再扫描 history.json 与不断增长的 historyarchive.json。
+# 文件不存在时会从两份历史中完整回填一次；删除 stats.json 即可重新回填。
+
+STATS_FORMAT = 1
+STATS_MAX_DAYS = 366
+
+
+def empty_stats():
+    return {"format": STATS_FORMAT, "total": 0, "actions": {}, "users": {}, "days": {}, "months": {}}
+
+
+def _bump(counts: dict, key: str, n: int = 1):
+    counts[key] = counts.get(key, 0) + n
+
+
+class ContributionStats:
+    """
+    贡献统计的内存副本。多个 worker 共用 stats.json：写入时持文件锁，
+    读写前都会比较文件的修改时间与大小，其他进程写入过就重新加载。
+    """
+
+    def __init__(self):
+        self.lock = threading.RLock()
+        self.data = None
+        self.stamp = None
+
+    @staticmethod
+    def _stat():
+        try:
+            st = os.stat(STATS_FILE)
+            return st.st_mtime_ns, st.st_size
+        except OSError:
+            return None
+
+    def _apply(self, entry: dict):
+        data = self.data
+        action = entry.get("action") or "unknown"
+        user_id = str(entry.get("user_id", ""))
+        when = str(entry.get("time", ""))
+        day, month = when[:10], when[:7]
+
+        data["total"] += 1
+        _bump(data["actions"], action)
+        user = data["users"].setdefault(user_id, {"nickname": "", "role": "user", "total": 0, "actions": {}, "first": when, "last": when})
+        user["total"] += 1
+        _bump(user["actions"], action)
+        if entry.get("nickname"):
+            user["nickname"] = entry["nickname"]
+        user["role"] = entry.get("role", user["role"])
+        user["first"] = min(user["first"], when)
+        user["last"] = max(user["last"], when)
+        if day:
+            _bump(data["days"].setdefault(day, {}), action)
+        if month:
+            _bump(data["months"].setdefault(month, {}).setdefault(user_id, {}), action)
+
+    def _backfill(self):
+        self.data = empty_stats()
+        for entry in itertools.chain(load_history_archive(), load_history()):
+            self._apply(entry)
+        write_json_files([(STATS_FILE, self.data)])
+        print(f"Contribution stats backfilled from {self.data['total']} history records")
+
+    def _refresh(self):
+        """调用方须持有 self.lock。文件缺失时返回 False，由写入方负责回填。"""
+        stamp = self._stat()
+        if stamp is None:
+            return False
+        if self.data is not None and stamp == self.stamp:
+            return True
+        try:
+            with metered_open(STATS_FILE, "r", encoding="utf-8") as f:
+                data = json.load(f)
+        except (json.JSONDecodeError, IOError):
+            return False
+        if data.get("format") != STATS_FORMAT:
+            return False
+        self.data, self.stamp = data, stamp
+        return True
+
+    def ensure_loaded(self):
+        with self.lock:
+            if self._refresh():
+                return
+        with file_lock(STATS_LOCK_FILE, exclusive=True), self.lock:
+            if not self._refresh():
+                self._backfill()
+                self.stamp = self._stat()
+
+    @instrumented("record_stats")
+    def record(self, entry: dict):
+        """须在新记录写入 history.json 之前调用，否则首次回填时会把它计入两次。"""
+        with file_lock(STATS_LOCK_FILE, exclusive=True), self.lock:
+            if not self._refresh():
+                self._backfill()
+            self._apply(entry)
+            try:
+                write_json_files([(STATS_FILE, self.data)])
+            except OSError as e:
+                print(f"Failed to save contribution stats: {e}")
+            self.stamp = self._stat()
+
+    def contributors(self, month: Optional[str], action: Optional[str], limit: int):
+        self.ensure_loaded()
+        with self.lock:
+            users = self.data["users"]
+            if month:
+                counts = self.data["months"].get(month, {})
+            else:
+                counts = {user_id: user["actions"] for user_id, user in users.items()}
+            ranked = []
+            for user_id, actions in counts.items():
+                total = actions.get(action, 0) if action else sum(actions.values())
+                if total:
+                    ranked.append((total, user_id, actions))
+            ranked.sort(key=lambda r: (-r[0], r[1]))
+            return {
+                "month": month,
+                "action": action,
+                "users": len(ranked),
+                "total": sum(r[0] for r in ranked),
+                "contributors": [{
+                    "user_id": user_id,
+                    "nickname": users.get(user_id, {}).get("nickname", ""),
+                    "role": users.get(user_id, {}).get("role", "user"),
+                    "total": total,
+                    "actions": dict(actions)
+                } for total, user_id, actions in ranked[:limit]]
+            }
+
+    def activity(self, days: int, action: Optional[str]):
+        self.ensure_loaded()
+        today = datetime.date.today()
+        with self.lock:
+            series = []
+            for offset in range(days - 1, -1, -1):
+                day = str(today - datetime.timedelta(days=offset))
+                actions = self.data["days"].get(day, {})
+                total = actions.get(action, 0) if action else sum(actions.values())
+                series.append({"date": day, "total": total, "actions": dict(actions)})
+            return {
+                "action": action,
+                "total": sum(d["total"] for d in series),
+                "all_time": self.data["actions"].get(action, 0) if action else self.data["total"],
+                "days": series
+            }
+
+
+contribution_stats = ContributionStats()
+
+@instrumented("load_users")
+def load_users():
+    """Deprecated: using individual files. Returns a fake dict for compatibility."""
+    users = {}
+    if os.path.exists(USERS_DIR):
+        for filename in os.listdir(USERS_DIR):
+            if filename.endswith(".json"):
+                try:
+                    uid = filename[:-5]
+                    with metered_open(os.path.join(USERS_DIR, filename), "r", encoding="utf-8") as f:
+                        users[uid] = json.load(f)
+                except: continue
+    return users
+
+# 用户文件的内存副本，以文件的修改时间与大小为准：其他 worker 写入后会重新读取，
+# 未变化时权限与配额检查只需一次 stat
+_user_cache = {}
+_user_cache_lock = threading.Lock()
+
+def user_file_stamp(user_id: str):
+    try:
+        st = os.stat(os.path.join(USERS_DIR, f"{user_id}.json"))
+        return st.st_mtime_ns, st.st_size
+    except OSError:
+        return None
+
+@instrumented("load_user")
+def load_user(user_id: str):
+    stamp = user_file_stamp(user_id)
+    if stamp is None:
+        return None
+    with _user_cache_lock:
+        cached = _user_cache.get(user_id)
+    if cached is not None and cached[0] == stamp:
+        return copy.deepcopy(cached[1])
+    user_file = os.path.join(USERS_DIR, f"{user_id}.json")
+    try:
+        with metered_open(user_file, "r", encoding="utf-8") as f:
+            user = json.load(f)
+    except: return None
+    with _user_cache_lock:
+        _user_cache[user_id] = (stamp, copy.deepcopy(user))
+    return user
+
+@instrumented("save_user")
+def save_user(user_id: str, user_data: dict):
+    user_file = os.path.join(USERS_DIR, f"{user_id}.json")
+    try:
+        with metered_open(user_file, "w", encoding="utf-8") as f:
+            json.dump(user_data, f, ensure_ascii=False, indent=2)
+    except: return
+    with _user_cache_lock:
+        _user_cache[user_id] = (user_file_stamp(user_id), copy.deepcopy(user_data))
+
+def get_user_quota(user_id: str):
+    user = load_user(user_id)
+    today = str(datetime.date.today())
+    changed = not user
+    if not user:
+        user = {"last_date": today, "adds": 0, "edits": 0, "deletes": 0, "applies": 0, "messages": 0, "notifications": []}
+    
+    if user.get("last_date") != today:
+        changed = True
+        user["last_date"] = today
+        user["adds"] = 0
+        user["edits"] = 0
+        user["deletes"] = 0
+        user["applies"] = 0
+        user["messages"] = 0
+        # 每天第一次登录时触发备份、归档和状态清理
+        perform_data_backup()
+        archive_old_history()
+        archive_old_mail()
+        clean_old_new_status()
+    
+    if changed:
+        save_user(user_id, user)
+    return user
+
+# admins.json / banned.json 最多每隔 ACCESS_LIST_RECHECK 秒检查一次修改时间，未变化时直接使用内存中的列表
+ACCESS_LIST_RECHECK = 2.0
+_access_lists = {}
+
+def _load_access_list(path: str, default: list):
+    now = time.monotonic()
+    cached = _access_lists.get(path)
+    if cached and now - cached[0] < ACCESS_LIST_RECHECK:
+        return list(cached[2])
+    try:
+        mtime = os.path.getmtime(path)
+    except OSError:
+        mtime = None
+    if cached and cached[1] == mtime:
+        _access_lists[path] = (now, mtime, cached[2])
+        return list(cached[2])
+
+    value = list(default)
+    if mtime is not None:
+        try:
+            with metered_open(path, "r", encoding="utf-8") as f:
+                content = f.read().strip()
+                loaded = json.loads(content) if content else default
+                value = loaded if isinstance(loaded, list) else list(default)
+        except (json.JSONDecodeError, IOError):
+            pass
+    _access_lists[path] = (now, mtime, value)
+    return list(value)
+
+def load_admins():
+    return _load_access_list(ADMINS_FILE, ["1173408"])
+
+def load_banned():
+    return _load_access_list(BANNED_FILE, [])
+
+def check_permission(user_id: str, action: str):
+    if user_id == "guest":
+        return False
+    if not identity_matches(user_id):
+        return False
+    
+    # 封禁检查
+    if is_banned(user_id):
+        return False
+        
+    if is_admin(user_id):
+        return True
+    
+    user = get_user_quota(user_id)
+    if action == "add" and user["adds"] >= 10: return False
+    if action == "edit" and user["edits"] >= 10: return False
+    if action == "delete" and user["deletes"] >= 1: return False
+    if action == "apply" and user["applies"] >= 1: return False
+    if action == "message" and user["messages"] >= 3: return False
+    return True
+
+def record_action(user_id: str, action: str, node_id: int, node_name: str, nickname: str = "未知用户", details: Optional[dict] = None):
+    # Record history
+    history = load_history()
+    now = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    admin = is_admin(user_id)
+    role = "admin" if admin else "user"
+    
+    entry = {
+        "time": now,
+        "user_id": user_id,
+        "nickname": nickname,
+        "role": role,
+        "node_id": node_id,
+        "node_name": node_name,
+        "action": action
+    }
+    if details:
+        entry["details"] = details
+    contribution_stats.record(entry)
+    history.append(entry)
+    save_history(history)
+    # 全站历史的 50 条限制归档放在写入时处理，读取时不再触发
+    archive_old_history()
+    if STATIC_EXPORT_DIR:
+        static_export_scheduler.schedule()
+
+    # Record quota
+    if admin: return
+    user = load_user(user_id)
+    if not user:
+        user = {"last_date": str(datetime.date.today()), "adds": 0, "edits": 0, "deletes": 0, "applies": 0, "messages": 0, "notifications": []}
+    
+    if action == "add": user["adds"] += 1
+    elif action == "edit": user["edits"] += 1
+    elif action == "delete": user["deletes"] += 1
+    elif action == "apply_famous": user["applies"] += 1
+    elif action == "send_message": user["messages"] += 1
+    save_user(user_id, user)
+
+# --- 并发读取合并（single-flight） ---
+
+class _Flight:
+    __slots__ = ("event", "value", "error")
+
+    def __init__(self):
+        self.event = threading.Event()
+        self.value = None
+        self.error = None
+
+
+class SingleFlight:
+    """
+    合并对同一份数据的并发读取。
+    key 的最后一项是数据版本：同一版本下只有第一个请求真正计算，
+    同时到达的请求等待并共享它的结果，之后的请求直接使用缓存，直到版本变化。
+    """
+
+    def __init__(self, max_entries: int = 256):
+        self.lock = threading.Lock()
+        self.inflight = {}
+        self.results = OrderedDict()
+        self.max_entries = max_entries
+        self.computations = 0
+        self.shared_waiters = 0
+        self.cache_hits = 0
+
+    def do(self, key: tuple, compute):
+        slot = key[:-1]
+        with self.lock:
+            cached = self.results.get(slot)
+            if cached is not None and cached[0] == key:
+                self.cache_hits += 1
+                return cached[1]
+            flight = self.inflight.get(key)
+            leader = flight is None
+            if leader:
+                flight = self.inflight[key] = _Flight()
+                self.computations += 1
+            else:
+                self.shared_waiters += 1
+
+        if not leader:
+            flight.event.wait()
+            if flight.error is not None:
+                raise flight.error
+            return flight.value
+
+        try:
+            flight.value = compute()
+        except BaseException as e:
+            flight.error = e
+            raise
+        finally:
+            with self.lock:
+                del self.inflight[key]
+                if flight.error is None:
+                    self.results[slot] = (key, flight.value)
+                    self.results.move_to_end(slot)
+                    while len(self.results) > self.max_entries:
+                        self.results.popitem(last=False)
+            flight.event.set()
+        return flight.value
+
+    def stats(self):
+        with self.lock:
+            return {
+                "computations": self.computations,
+                "shared_waiters": self.shared_waiters,
+                "cache_hits": self.cache_hits,
+                "inflight": len(self.inflight)
+            }
+
+
+read_flight = SingleFlight()
+
+
+def collect_runtime_metrics():
+    stats = read_flight.stats()
+    return [
+        ("singleflight_computations_total", "counter", "合并读取中实际执行的计算次数", stats["computations"]),
+        ("singleflight_shared_waiters_total", "counter", "等待并共享他人计算结果的请求数", stats["shared_waiters"]),
+        ("singleflight_cache_hits_total", "counter", "直接命中已序列化结果的请求数", stats["cache_hits"]),
+        ("graph_nodes", "gauge", "内存索引中的节点数", len(graph_index.nodes)),
+        ("graph_version", "gauge", "节点索引的数据版本", graph_index.version),
+    ]
+
+metrics.collectors.append(collect_runtime_metrics)
+
+def json_bytes(data):
+    return json.dumps(data, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+
+# --- 会话令牌 ---
+
+# 登录后签发的会话令牌：载荷中带有角色与封禁状态，使用 HMAC-SHA256 签名，
+# 校验只需内存计算；封禁或撤销时在内存中记录撤销时间，早于该时间签发的令牌立即失效。
+SESSION_TTL = 12 * 3600
+SESSION_KEY_FILE = backend_path("session.key")
+SESSION_SECRET_MIN_BYTES = 32
+
+def load_session_secret():
+    """
+    优先使用环境变量 SESSION_SECRET，否则使用 session.key，文件不存在时生成。
+    多个 worker 可能同时启动：新密钥先完整写入临时文件，再用 os.link 放到位（目标已存在时失败），
+    之后一律读回 session.key，所有 worker 都使用最先放到位的那份密钥。
+    """
+    secret = os.getenv("SESSION_SECRET")
+    if secret:
+        key = secret.encode("utf-8")
+    else:
+        if not os.path.exists(SESSION_KEY_FILE):
+            tmp_path = f"{SESSION_KEY_FILE}.{uuid.uuid4().hex}.tmp"
+            fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+            try:
+                with os.fdopen(fd, "wb") as f:
+                    f.write(secrets.token_bytes(SESSION_SECRET_MIN_BYTES))
+                    f.flush()
+                    os.fsync(f.fileno())
+                os.link(tmp_path, SESSION_KEY_FILE)
+            except FileExistsError:
+                pass
+            finally:
+                os.remove(tmp_path)
+        with metered_open(SESSION_KEY_FILE, "rb") as f:
+            key = f.read()
+    if len(key) < SESSION_SECRET_MIN_BYTES:
+        raise ValueError(f"会话密钥至少需要 {SESSION_SECRET_MIN_BYTES} 字节，请检查 SESSION_SECRET 或 {SESSION_KEY_FILE}")
+    return key
+
+SESSION_SECRET = load_session_secret()
+# None 表示不在请求中（命令行脚本、后台任务），此时按 admins.json / banned.json 判断身份；
+# 没有携带令牌的请求一律视为游客
+current_session = contextvars.ContextVar("current_session", default=None)
+GUEST_SESSION = {"uid": "guest", "role": "user", "banned": False}
+_session_revocations = {}
+
+def _b64encode(data: bytes):
+    return base64.urlsafe_b64encode(data).rstrip(b"=").decode("ascii")
+
+def _b64decode(text: str):
+    return base64.urlsafe_b64decode(text + "=" * (-len(text) % 4))
+
+def _sign(body: str):
+    return _b64encode(hmac.new(SESSION_SECRET, body.encode("ascii"), hashlib.sha256).digest())
+
+def issue_session_token(user_id: str):
+    now = time.time()
+    claims = {
+        "uid": user_id,
+        "role": "admin" if user_id in load_admins() else "user",
+        "banned": user_id in load_banned(),
+        "iat": now,
+        "exp": now + SESSION_TTL
+    }
+    body = _b64encode(json.dumps(claims, separators=(",", ":")).encode("utf-8"))
+    return f"{body}.{_sign(body)}"
+
+def verify_session_token(token: str):
+    """
+    校验签名、有效期与撤销记录，通过时返回令牌载荷，否则返回 None。
+    令牌来自请求头，可能含有非 ASCII 字符，无法编码或解码的令牌同样视为无效。
+    """
+    body, _, signature = token.partition(".")
+    try:
+        if not signature or not hmac.compare_digest(signature, _sign(body)):
+            return None
+        claims = json.loads(_b64decode(body))
+    except (ValueError, TypeError, binascii.Error):
+        return None
+    if not isinstance(claims, dict):
+        return None
+    if claims.get("exp", 0) < time.time():
+        return None
+    if claims.get("iat", 0) <= _session_revocations.get(claims.get("uid"), 0):
+        return None
+    return claims
+
+def revoke_sessions(user_id: str):
+    _session_revocations[user_id] = time.time()
+
+async def authenticate_request(request: Request, call_next):
+    authorization = request.headers.get("authorization", "")
+    if authorization.startswith("Bearer "):
+        claims = verify_session_token(authorization[len("Bearer "):])
+        if claims is None:
+            return JSONResponse({"detail": "登录已过期，请重新登录"}, status_code=401)
+    else:
+        claims = GUEST_SESSION
+    token = current_session.set(claims)
+    try:
+        return await call_next(request)
+    finally:
+        current_session.reset(token)
+
+def identity_matches(user_id: str):
+    """请求只能以令牌中的身份操作，表单或查询参数中的 user_id 必须与令牌一致；没有令牌时视为游客。"""
+    session = current_session.get()
+    return session is None or (session is not GUEST_SESSION and session["uid"] == user_id)
+
+def is_admin(user_id: str):
+    """请求中只认令牌里的管理员角色；不在请求中时（命令行脚本）查 admins.json。"""
+    session = current_session.get()
+    if session is not None:
+        return identity_matches(user_id) and session["role"] == "admin"
+    return user_id in load_admins()
+
+def is_banned(user_id: str):
+    session = current_session.get()
+    if session is not None and session["banned"]:
+        return True
+    return user_id in load_banned()
+
+# --- 用户通知 ---
+
+class NotificationHub:
+    """
+    用户未读通知（已被处理的信件 id 列表）的内存副本。
+    每次访问只 stat 一次用户文件，文件被其他 worker 改过时重新读取，所以读取未读数量和长轮询都不必读文件；
+    新增通知和标记已读时持文件锁，先同步再修改并写回，避免覆盖其他 worker 写入的通知。
+    """
 
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.unread = {}
+        self.stamps = {}
+        self.waiters = {}
 
-def image_storage_path(image_url: str):
-    if not image_url or not image_url.startswith("/images/"):
+    def _sync(self, user_id: str):
+        stamp = user_file_stamp(user_id)
+        with self.lock:
+            if user_id in self.unread and self.stamps.get(user_id) == stamp:
+                return
+        user = load_user(user_id)
+        ids = list(user.get("notifications", [])) if user else []
+        with self.lock:
+            changed = self.unread.get(user_id) != ids
+            self.unread[user_id] = ids
+            self.stamps[user_id] = stamp
+            waiters = self.waiters.pop(user_id, set()) if changed else ()
+        self._wake(waiters)
+
+    def _persist(self, user_id: str, ids: list):
+        user = load_user(user_id)
+        if user:
+            user["notifications"] = ids
+            save_user(user_id, user)
+        with self.lock:
+            self.stamps[user_id] = user_file_stamp(user_id)
+
+    @staticmethod
+    def _wake(waiters):
+        for loop, future in waiters:
+            loop.call_soon_threadsafe(_resolve_future, future)
+
+    def unread_ids(self, user_id: str):
+        self._sync(user_id)
+        with self.lock:
+            return list(self.unread[user_id])
+
+    def push(self, user_id: str, msg_id: str):
+        """记录一条新通知，并唤醒该用户所有正在等待的长轮询请求。"""
+        with file_lock(NOTIFICATIONS_LOCK_FILE, exclusive=True):
+            self._sync(user_id)
+            with self.lock:
+                ids = self.unread[user_id]
+                if msg_id in ids:
+                    return
+                ids.append(msg_id)
+                snapshot = list(ids)
+                waiters = self.waiters.pop(user_id, set())
+            self._persist(user_id, snapshot)
+        self._wake(waiters)
+
+    def mark_read(self, user_id: str, msg_ids: Optional[list] = None):
+        """把指定的通知（不指定时为全部）标记为已读，返回剩余的未读数量。"""
+        with file_lock(NOTIFICATIONS_LOCK_FILE, exclusive=True):
+            self._sync(user_id)
+            with self.lock:
+                if msg_ids is None:
+                    remaining = []
+                else:
+                    read = set(msg_ids)
+                    remaining = [i for i in self.unread[user_id] if i not in read]
+                changed = remaining != self.unread[user_id]
+                self.unread[user_id] = remaining
+            if changed:
+                self._persist(user_id, list(remaining))
+        return len(remaining)
+
+    async def wait(self, user_id: str, since: int, timeout: float):
+        """
+        未读数量与客户端已知的 since 不同时立即返回，否则等待新通知或超时。
+        其他 worker 推送的通知无法唤醒本进程，超时前会再同步一次用户文件。
+        """
+        await run_in_threadpool(self._sync, user_id)
+        loop = asyncio.get_running_loop()
+        with self.lock:
+            if len(self.unread[user_id]) != since:
+                return len(self.unread[user_id])
+            future = loop.create_future()
+            self.waiters.setdefault(user_id, set()).add((loop, future))
+        try:
+            await asyncio.wait_for(future, timeout)
+        except asyncio.TimeoutError:
+            pass
+        finally:
+            with self.lock:
+                self.waiters.get(user_id, set()).discard((loop, future))
+        await run_in_threadpool(self._sync, user_id)
+        with self.lock:
+            return len(self.unread[user_id])
+
+
+def _resolve_future(future):
+    if not future.done():
+        future.set_result(True)
+
+
+notification_hub = NotificationHub()
+
+# --- 聚类层级（缩小视图时的细节层次） ---
+
+# 子树包围盒在屏幕上的尺寸（像素）小于该值时，整棵子树折叠为一个聚类
+CLUSTER_SCREEN_SIZE = 320.0
+DEFAULT_IMAGE_URL = "/images/default.webp"
+
+def cluster_roots():
+    """
+    聚类层级的根：graph_index 中没有父节点的节点。调用方须持有 graph_index.lock。
+    extension 关系成环时环上的节点都有父节点，从根出发无法到达；
+    只有这种情况下才扫描全部节点，取每个环上 id 最小的节点断开作为根。
+    """
+    roots = sorted(graph_index.roots)
+    if sum(graph_index.summary(r)[0] for r in roots) >= len(graph_index.nodes):
+        return roots
+    reached = set()
+    def mark(root_id):
+        stack = [root_id]
+        while stack:
+            node_id = stack.pop()
+            if node_id not in reached:
+                reached.add(node_id)
+                stack.extend(graph_index.tree_children.get(node_id, ()))
+    for root_id in roots:
+        mark(root_id)
+    for node_id in sorted(graph_index.nodes):
+        if node_id in reached:
+            continue
+        seen = []
+        while node_id not in seen:
+            seen.append(node_id)
+            node_id = graph_index.tree_parent[node_id]
+        root_id = min(seen[seen.index(node_id):])
+        roots.append(root_id)
+        mark(root_id)
+    return roots
+
+def cluster_children(node_id: int):
+    return sorted(graph_index.tree_children.get(node_id, ()))
+
+def cluster_item(node: dict, collapsed: bool):
+    node_id = node["id"]
+    size, bbox, image = graph_index.summary(node_id)
+    return {
+        "id": node_id,
+        "name": node.get("name", ""),
+        "image": image if collapsed else (node.get("image") or DEFAULT_IMAGE_URL),
+        "x": node.get("x", 0.0),
+        "y": node.get("y", 0.0),
+        "cluster": collapsed,
+        "size": size,
+        "bbox": bbox
+    }
+
+# --- 紧凑二进制图格式 ---
+
+GRAPH_BINARY_MEDIA_TYPE = "application/x-anon-graph"
+GRAPH_BINARY_MAGIC = b"AGRF"
+GRAPH_BINARY_VERSION = 1
+# 头部：magic、版本、保留位，以及节点数、连线数、标签引用数、字符串数、字符串区字节数
+GRAPH_BINARY_HEADER = struct.Struct("<4sHHIIIII")
+NODE_FLAG_FAMOUS = 1
+NODE_FLAG_NEW = 2
+
+
+def _little_endian(values: array.array):
+    if sys.byteorder == "big":
+        values.byteswap()
+    return values.tobytes()
+
+
+def encode_graph_binary(nodes: list):
+    """
+    把节点列表编码为首屏绘制所需的列式二进制格式（小端，每段按 4 字节对齐）：
+    ids(i32) x(f32) y(f32) name/image/source(字符串下标 u32) flags(u8)
+    标签与连线用 CSR 表示：offsets(u32, N+1) + 引用数组；所有字符串去重后放在同一张表里。
+    简介、相关作品等详情字段不包含在内，由 GET /api/nodes/{id} 按需获取。
+    """
+    nodes = sorted(nodes, key=lambda n: n["id"])
+    strings, string_index = [], {}
+
+    def intern(text):
+        text = text if isinstance(text, str) else ""
+        index = string_index.get(text)
+        if index is None:
+            index = string_index[text] = len(strings)
+            strings.append(text)
+        return index
+
+    ids, xs, ys = array.array("i"), array.array("f"), array.array("f")
+    names, images, sources = array.array("I"), array.array("I"), array.array("I")
+    flags = bytearray()
+    tag_offsets, tag_refs = array.array("I", [0]), array.array("I")
+    edge_offsets, edge_targets = array.array("I", [0]), array.array("i")
+    for node in nodes:
+        ids.append(node["id"])
+        xs.append(float(node.get("x") or 0.0))
+        ys.append(float(node.get("y") or 0.0))
+        names.append(intern(node.get("name", "")))
+        images.append(intern(node.get("image", "")))
+        source = node.get("source")
+        sources.append(intern(source.get("name", "") if isinstance(source, dict) else source))
+        flags.append((NODE_FLAG_FAMOUS if node.get("is_famous") else 0) | (NODE_FLAG_NEW if node.get("new") else 0))
+        tag_refs.extend(intern(tag) for tag in node.get("tags", []))
+        tag_offsets.append(len(tag_refs))
+        edge_targets.extend(i for i in node.get("extension", []) if isinstance(i, int))
+        edge_offsets.append(len(edge_targets))
+
+    encoded = [text.encode("utf-8") for text in strings]
+    string_offsets = array.array("I", [0])
+    for chunk in encoded:
+        string_offsets.append(string_offsets[-1] + len(chunk))
+    blob = b"".join(encoded)
+
+    flags.extend(b"\0" * (-len(flags) % 4))
+    parts = [
+        GRAPH_BINARY_HEADER.pack(GRAPH_BINARY_MAGIC, GRAPH_BINARY_VERSION, 0, len(nodes),
+                                 len(edge_targets), len(tag_refs), len(strings), len(blob)),
+        _little_endian(ids), _little_endian(xs), _little_endian(ys),
+        _little_endian(names), _little_endian(images), _little_endian(sources), bytes(flags),
+        _little_endian(tag_offsets), _little_endian(tag_refs),
+        _little_endian(edge_offsets), _little_endian(edge_targets),
+        _little_endian(string_offsets), blob
+    ]
+    return b"".join(parts)
+
+
+def accepts_graph_binary(request: Request):
+    return GRAPH_BINARY_MEDIA_TYPE in request.headers.get("accept", "")
+
+# --- 静态站点导出 ---
+#
+# 把只读接口渲染为一组静态文件，交给 nginx / CDN 直接提供：
+#   manifest.json                     入口，记录下面各文件的实际路径（短缓存）
+#   static/nodes.<hash>.json / .bin   等同于 GET /api/nodes 的 JSON 与二进制格式
+#   static/history.<hash>.json        最近的操作历史（等同于 GET /api/history）
+#   static/history/<id>.<hash>.json   单个节点的最近历史（等同于 GET /api/history?node_id=），没有记录的节点不导出
+#   static/node/<id>.<hash>.json      单个节点的完整信息（等同于 GET /api/nodes/{id}）
+#   static/thumbs/<图片名>.<尺寸>.webp  节点图片的缩略图（上传的图片文件名本身不会复用，无需再算哈希）
+# static 下的文件名随内容变化，可以设置永久缓存；json 与 bin 同时写出 .gz 供 gzip_static 使用。
+
+# 设置后每次写入都会在后台重新导出到该目录
+STATIC_EXPORT_DIR = os.getenv("STATIC_EXPORT_DIR", "")
+STATIC_EXPORT_DEBOUNCE = 5.0
+STATIC_EXPORT_MAX_DELAY = 60.0
+THUMBNAIL_SIZE = 256
+STATIC_EXPORT_LOCK_FILE = ".export.lock"
+
+_static_export_lock = threading.Lock()
+
+
+def _hashed_name(prefix: str, data: bytes, ext: str):
+    return f"{prefix}.{hashlib.sha256(data).hexdigest()[:16]}.{ext}"
+
+
+def _write_static_file(out_dir: str, rel_path: str, data: bytes, compress: bool = True):
+    """内容寻址的文件已存在时直接跳过，所以重复导出只会写出变化的部分。"""
+    path = os.path.join(out_dir, rel_path)
+    if os.path.exists(path):
+        return False
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    outputs = [(path, data)]
+    if compress:
+        outputs.insert(0, (f"{path}.gz", gzip.compress(data, compresslevel=9, mtime=0)))
+    for target, content in outputs:
+        tmp_path = f"{target}.{uuid.uuid4().hex}.tmp"
+        with metered_open(tmp_path, "wb") as f:
+            f.write(content)
+        os.replace(tmp_path, target)
+    return True
+
+
+def _write_thumbnail(out_dir: str, image_url: str):
+    source = image_storage_path(image_url)
+    if not source or not os.path.exists(source):
         return None
-    return os.path.join(IMAGES_DIR, os.path.basename(image_url))
-
-# Ensure data directory exists
-os.makedirs(DATA_DIR, exist_ok=True)
-os.makedirs(USERS_DIR, exist_ok=True)
-os.makedirs(BACKUP_DIR, exist_ok=True)
-
-def perform_data_backup():
-    """
-    备份 data 文件夹并保留最近 3 天的数据。
-    增加了额外的日期锁文件检查，确保全站每天仅触发一次备份。
-    """
-    today_str = datetime.date.today().strftime("%Y-%m-%d")
-    lock_file = os.path.join(BACKUP_DIR, f".backup_done_{today_str}")
-    backup_path = os.path.join(BACKUP_DIR, today_str)
-    
-    # 只要锁文件存在，说明今天已经备份过了
-    if os.path.exists(lock_file):
-        return
-
-    # 执行备份
-    if not os.path.exists(backup_path):
-        try:
-            shutil.copytree(DATA_DIR, backup_path)
-            # 写入锁文件，防止其他用户再次触发
-            with open(lock_file, "w") as f:
-                f.write(datetime.datetime.now().strftime("%H:%M:%S"))
-            print(f"Daily full backup completed to {backup_path}")
-        except Exception as e:
-            print(f"Backup failed: {e}")
-            return # 失败时不执行清理
-            
-    # 清理 3 天前的备份和对应的锁文件
-    try:
-        all_items = os.listdir(BACKUP_DIR)
-        dirs = sorted([d for d in all_items if os.path.isdir(os.path.join(BACKUP_DIR, d))])
-        
-        if len(dirs) > 3:
-            for old_backup in dirs[:-3]:
-                shutil.rmtree(os.path.join(BACKUP_DIR, old_backup))
-                # 同时尝试清理旧的锁文件
-                old_lock = os.path.join(BACKUP_DIR, f".backup_done_{old_backup}")
-                if os.path.exists(old_lock):
-                    os.remove(old_lock)
-                print(f"Deleted expired backup and lock: {old_backup}")
-    except Exception as e:
-        print(f"Cleanup failed: {e}")
-
-def load_data():
-    nodes = []
-    if os.path.exists(DATA_DIR):
-        for filename in os.listdir(DATA_DIR):
-            if filename.endswith(".json"):
-                try:
-                    with open(os.path.join(DATA_DIR, filename), "r", encoding="utf-8") as f:
-                        node = json.load(f)
-                        nodes.append(node)
-                except (json.JSONDecodeError, IOError):
-                    continue
-    return {"nodes": nodes}
-
-def save_node(node):
-    node_id = node.get("id")
-    if node_id is None:
-        return
-    with open(os.path.join(DATA_DIR, f"{node_id}.json"), "w", encoding="utf-8") as f:
-        json.dump(node, f, ensure_ascii=False, indent=2)
-
-def clean_old_new_status():
-    """
-    遍历所有节点，检查 'new' 属性。如果创建于 3 天前，则移除 'new' 状态。
-    """
-    if not os.path.exists(DATA_DIR):
-        return
-    
-    today = datetime.date.today()
-    threshold = today - datetime.timedelta(days=3)
-    
-    for filename in os.listdir(DATA_DIR):
-        if filename.endswith(".json"):
-            filepath = os.path.join(DATA_DIR, filename)
-            try:
-                with open(filepath, "r", encoding="utf-8") as f:
-                    node = json.load(f)
-                
-                changed = False
-                # 如果有 new 属性且为 True
-                if node.get("new"):
-                    created_at_str = node.get("time") # 格式: YYYY-MM-DD
-                    if created_at_str:
-                        try:
-                            created_at = datetime.datetime.strptime(created_at_str, "%Y-%m-%d").date()
-                            if created_at <= threshold:
-                                node["new"] = False
-                                changed = True
-                        except ValueError:
-                            pass
-                
-                if changed:
-                    save_node(node)
-            except Exception:
-                continue
-
-def delete_node_file(node_id: int):
-    # Load node data to find image path
-    file_path = os.path.join(DATA_DIR, f"{node_id}.json")
-    if os.path.exists(file_path):
-        try:
-            with open(file_path, "r", encoding="utf-8") as f:
-                node = json.load(f)
-                image_url = node.get("image", "")
-                # Delete image if it is not default
-                if image_url and not image_url.endswith("default.png") and image_url.startswith("/images/"):
-                    image_path = image_storage_path(image_url)
-                    if image_path and os.path.exists(image_path):
-                        os.remove(image_path)
-        except:
-            pass
-        os.remove(file_path)
-
-def load_applications():
-    if not os.path.exists(APPLICATIONS_FILE):
-        return []
-    try:
-        with open(APPLICATIONS_FILE, "r", encoding="utf-8") as f:
-            content = f.read().strip()
-            return json.loads(content) if content else []
-    except (json.JSONDecodeError, IOError):
-        return []
-
-def save_applications(apps):
-    try:
-        with open(APPLICATIONS_FILE, "w", encoding="utf-8") as f:
-            json.dump(apps, f, ensure_ascii=False, indent=2)
-    except IOError:
-        pass
-
-def load_mailbox():
-    if not os.path.exists(MAILBOX_FILE):
-        return []
-    try:
-        with open(MAILBOX_FILE, "r", encoding="utf-8") as f:
-            content = f.read().strip()
-            return json.loads(content) if content else []
-    except (json.JSONDecodeError, IOError):
-        return []
-
-def save_mailbox(messages):
-    try:
-        with open(MAILBOX_FILE, "w", encoding="utf-8") as f:
-            json.dump(messages, f, ensure_ascii=False, indent=2)
-    except IOError:
-        pass
-
-def load_mail_history():
-    if not os.path.exists(MAILBOX_HISTORY_FILE):
-        return []
-    try:
-        with open(MAILBOX_HISTORY_FILE, "r", encoding="utf-8") as f:
-            content = f.read().strip()
-            return json.loads(content) if content else []
-    except (json.JSONDecodeError, IOError):
-        return []
-
-def save_mail_history(history):
-    try:
-        with open(MAILBOX_HISTORY_FILE, "w", encoding="utf-8") as f:
-            json.dump(history, f, ensure_ascii=False, indent=2)
-    except IOError:
-        pass
-
-def archive_old_mail():
-    messages = load_mailbox()
-    if not messages:
-        return
-    
-    today = datetime.datetime.now()
-    threshold = today - datetime.timedelta(days=30)
-    
-    current_messages = []
-    to_archive = []
-    
-    for msg in messages:
-        try:
-            msg_time = datetime.datetime.strptime(msg["time"], "%Y-%m-%d %H:%M:%S")
-            if msg_time < threshold:
-                to_archive.append(msg)
-            else:
-                current_messages.append(msg)
-        except (ValueError, KeyError):
-            current_messages.append(msg)
-            
-    if to_archive:
-        history = load_mail_history()
-        history.extend(to_archive)
-        save_mail_history(history)
-        save_mailbox(current_messages)
-
-def load_history():
-    if not os.path.exists(HISTORY_FILE):
-        return []
-    try:
-        with open(HISTORY_FILE, "r", encoding="utf-8") as f:
-            content = f.read().strip()
-            return json.loads(content) if content else []
-    except (json.JSONDecodeError, IOError):
-        return []
-
-def save_history(history):
-    try:
-        with open(HISTORY_FILE, "w", encoding="utf-8") as f:
-            json.dump(history, f, ensure_ascii=False, indent=2)
-    except IOError:
-        pass
-
-def load_history_archive():
-    if not os.path.exists(HISTORY_ARCHIVE_FILE):
-        return []
-    try:
-        with open(HISTORY_ARCHIVE_FILE, "r", encoding="utf-8") as f:
-            content = f.read().strip()
-            return json.loads(content) if content else []
-    except (json.JSONDecodeError, IOError):
-        return []
-
-def save_history_archive(archive):
-    try:
-        with open(HISTORY_ARCHIVE_FILE, "w", encoding="utf-8") as f:
-            json.dump(archive, f, ensure_ascii=False, indent=2)
-    except IOError:
-        pass
-
-def archive_old_history():
-    history = load_history()
-    if len(history) <= 50:
-        return
-    
-    # 按照时间从新到旧排序（假设 record_action 是 append 到末尾，所以最后面的是最新的）
-    # 但为了保险，我们取最后 50 条作为保留，前面的移入归档
-    to_archive = history[:-50]
-    to_keep = history[-50:]
-    
-    if to_archive:
-        archive = load_history_archive()
-        archive.extend(to_archive)
-        save_history_archive(archive)
-        save_history(to_keep)
-
-def load_users():
-    """Deprecated: using individual files. Returns a fake dict for compatibility."""
-    users = {}
-    if os.path.exists(USERS_DIR):
-        for filename in os.listdir(USERS_DIR):
-            if filename.endswith(".json"):
-                try:
-                    uid = filename[:-5]
-                    with open(os.path.join(USERS_DIR, filename), "r", encoding="utf-8") as f:
-                        users[uid] = json.load(f)
-                except: continue
-    return users
-
-def load_user(user_id: str):
-    user_file = os.path.join(USERS_DIR, f"{user_id}.json")
-    if not os.path.exists(user_file):
-        return None
-    try:
-        with open(user_file, "r", encoding="utf-8") as f:
-            return json.load(f)
-    except: return None
-
-def save_user(user_id: str, user_data: dict):
-    user_file = os.path.join(USERS_DIR, f"{user_id}.json")
-    try:
-        with open(user_file, "w", encoding="utf-8") as f:
-            json.dump(user_data, f, ensure_ascii=False, indent=2)
-    except: pass
-
-def get_user_quota(user_id: str):
-    user = load_user(user_id)
-    today = str(datetime.date.today())
-    if not user:
-        user = {"last_date": today, "adds": 0, "edits": 0, "deletes": 0, "applies": 0, "messages": 0, "notifications": []}
-    
-    if user.get("last_date") != today:
-        user["last_date"] = today
-        user["adds"] = 0
-        user["edits"] = 0
-        user["deletes"] = 0
-        user["applies"] = 0
-        user["messages"] = 0
-        # 每天第一次登录时触发备份、归档和状态清理
-        perform_data_backup()
-        archive_old_history()
-        archive_old_mail()
-        clean_old_new_status()
-    
-    save_user(user_id, user)
-    return user
-
-def load_admins():
-    if not os.path.exists(ADMINS_FILE):
-        return ["1173408"]
-    try:
-        with open(ADMINS_FILE, "r", encoding="utf-8") as f:
-            content = f.read().strip()
-            admins = json.loads(content) if content else ["1173408"]
-            return admins if isinstance(admins, list) else ["1173408"]
-    except (json.JSONDecodeError, IOError):
-        return ["1173408"]
-
-def load_banned():
-    if not os.path.exists(BANNED_FILE):
-        return []
-    try:
-        with open(BANNED_FILE, "r", encoding="utf-8") as f:
-            content = f.read().strip()
-            banned = json.loads(content) if content else []
-            return banned if isinstance(banned, list) else []
-    except (json.JSONDecodeError, IOError):
-        return []
-
-def check_permission(user_id: str, action: str):
-    if user_id == "guest":
-        return False
-    
-    # 封禁检查
-    banned = load_banned()
-    if user_id in banned:
-        return False
-        
-    admins = load_admins()
-    if user_id in admins:
-        return True
-    
-    user = get_user_quota(user_id)
-    if action == "add" and user["adds"] >= 10: return False
-    if action == "edit" and user["edits"] >= 10: return False
-    if action == "delete" and user["deletes"] >= 1: return False
-    if action == "apply" and user["applies"] >= 1: return False
-    if action == "message" and user["messages"] >= 3: return False
-    return True
-
-def record_action(user_id: str, action: str, node_id: int, node_name: str, nickname: str = "未知用户"):
-    # Record history
-    history = load_history()
-    now = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-    admins = load_admins()
-    role = "admin" if user_id in admins else "user"
-    
-    history.append({
-        "time": now,
-        "user_id": user_id,
-        "nickname": nickname,
-        "role": role,
-        "node_id": node_id,
-        "node_name": node_name,
-        "action": action
-    })
-    save_history(history)
-
-    # Record quota
-    if user_id in admins: return
-    user = load_user(user_id)
-    if not user:
-        user = {"last_date": str(datetime.date.today()), "adds": 0, "edits": 0, "deletes": 0, "applies": 0, "messages": 0, "notifications": []}
-    
-    if action == "add": user["adds"] += 1
-    elif action == "edit": user["edits"] += 1
-    elif action == "delete": user["deletes"] += 1
-    elif action == "apply_famous": user["applies"] += 1
-    elif action == "send_message": user["messages"] += 1
-    save_user(user_id, user)
-
-# Ensure images directory exists
-os.makedirs(IMAGES_DIR, exist_ok=True)
-
-# Mount images directory to serve static files
-app.mount("/images", StaticFiles(directory=IMAGES_DIR), name="images")
-
-# load_data is now at the top
-
-# --- Auth Routes ---
-
-@app.get("/api/auth/login")
-def login():
-    # Redirect user to Bangumi
-    auth_url = f"https://bgm.tv/oauth/authorize?client_id={BGM_CLIENT_ID}&response_type=code&redirect_uri={BGM_REDIRECT_URI}"
-    return {"url": auth_url}
-
-@app.get("/api/auth/callback")
-async def auth_callback(code: str):
-    # Increased timeout to prevent ReadTimeout
-    async with httpx.AsyncClient(timeout=30.0) as client:
-        # 1. Exchange code for access token
-        try:
-            token_resp = await client.post("https://bgm.tv/oauth/access_token", data={
-                "grant_type": "authorization_code",
-                "client_id": BGM_CLIENT_ID,
-                "client_secret": BGM_CLIENT_SECRET,
-                "code": code,
-                "redirect_uri": BGM_REDIRECT_URI
-            })
-            token_resp.raise_for_status()
-        except httpx.HTTPError:
-            raise HTTPException(400, "Failed to exchange token with Bangumi")
-            
-        token_data = token_resp.json()
-        if "access_token" not in token_data:
-            raise HTTPException(400, "Failed to get access token")
-        
-        access_token = token_data["access_token"]
-        user_id = str(token_data["user_id"])
-        
-        # 2. Get user profile to get the real nick (optional but good for display)
-        try:
-            profile_resp = await client.get("https://api.bgm.tv/v0/me", headers={
-                "Authorization": f"Bearer {access_token}"
-            })
-            if profile_resp.status_code == 200:
-                profile = profile_resp.json()
-                nickname = profile.get("nickname", "User_" + access_token[:8])
-            else:
-                nickname = "User_" + access_token[:8]
-        except:
-            nickname = "User_" + access_token[:8]
-        
-        # In a real app, you'd set a secure cookie or JWT here.
-        # For this setup, we redirect back to frontend with info in query params
-        base_frontend_url = os.getenv("FRONTEND_URL", "http://localhost:5173/")
-        
-        # Fix: UnicodeEncodeError - Use urllib.parse.quote for non-ASCII chars in headers
-        redirect_params = {
-            "user_id": user_id,
-            "nickname": nickname
-        }
-        query_string = urllib.parse.urlencode(redirect_params)
-        
-        # Ensure base url has ? or & correctly
-        if "?" in base_frontend_url:
-            frontend_url = f"{base_frontend_url}&{query_string}"
-        else:
-            # Handle trailing slash logic if needed, but usually query params are fine
-            if base_frontend_url.endswith("/"):
-                 frontend_url = f"{base_frontend_url}?{query_string}"
-            else:
-                 frontend_url = f"{base_frontend_url}/?{query_string}"
-
-        return Response(status_code=302, headers={"Location": frontend_url})
-
-# --- Node Routes ---
-
-@app.get("/api/nodes")
-def get_nodes():
-    return load_data()
-
-@app.get("/api/user/info")
+    stem = os.path.splitext(os.path.basename(source))[0]
+    rel_path = f"static/thumbs/{stem}.{THUMBNAIL_SIZE}.webp"
+    path = os.path.join(out_dir, rel_path)
+    if not os.path.exists(path):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+        try:
+            with Image.open(source) as img:
+                img.thumbnail((THUMBNAIL_SIZE, THUMBNAIL_SIZE))
+                img.save(tmp_path, "WEBP")
+            os.replace(tmp_path, path)
+        except (OSError, ValueError):
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            return None
+    return rel_path
+
+
+def _manifest_paths(manifest: dict):
+    paths = [manifest.get("nodes"), manifest.get("nodes_binary"), manifest.get("history")]
+    paths.extend(manifest.get("node_detail", {}).values())
+    paths.extend(manifest.get("node_history", {}).values())
+    paths.extend(manifest.get("thumbnails", {}).values())
+    return {p for p in paths if p}
+
+
+@instrumented("export_static_site")
+def export_static_site(out_dir: str):
+    """
+    导出一次完整的只读站点，返回新的 manifest 以及本次实际写出的文件数。
+    每个 worker 都有自己的导出任务，所以除了进程内的锁，还在导出目录中持有文件锁，
+    避免一个进程的清理删掉另一个进程刚写出、尚未写入 manifest 的文件。
+    """
+    os.makedirs(out_dir, exist_ok=True)
+    with _static_export_lock, file_lock(os.path.join(out_dir, STATIC_EXPORT_LOCK_FILE), exclusive=True):
+        nodes = graph_index.ensure_loaded()
+        with graph_index.lock:
+            node_list = sorted(nodes.values(), key=lambda n: n["id"])
+            version = graph_index.version
+        history = load_history()
+
+        written = 0
+        nodes_json = json_bytes({"nodes": node_list})
+        nodes_binary = encode_graph_binary(node_list)
+        history_json = json_bytes(history_view(history))
+        manifest = {
+            "format": 1,
+            "generated": datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+            "graph_version": version,
+            "nodes": f"static/{_hashed_name('nodes', nodes_json, 'json')}",
+            "nodes_binary": f"static/{_hashed_name('nodes', nodes_binary, 'bin')}",
+            "history": f"static/{_hashed_name('history', history_json, 'json')}",
+            "node_detail": {},
+            "node_history": {},
+            "thumbnails": {}
+        }
+        written += _write_static_file(out_dir, manifest["nodes"], nodes_json)
+        written += _write_static_file(out_dir, manifest["nodes_binary"], nodes_binary)
+        written += _write_static_file(out_dir, manifest["history"], history_json)
+        for node in node_list:
+            detail = json_bytes(node)
+            rel_path = f"static/node/{_hashed_name(str(node['id']), detail, 'json')}"
+            written += _write_static_file(out_dir, rel_path, detail)
+            manifest["node_detail"][str(node["id"])] = rel_path
+            image_url = node.get("image")
+            if image_url and image_url not in manifest["thumbnails"]:
+                thumb = _write_thumbnail(out_dir, image_url)
+                if thumb:
+                    manifest["thumbnails"][image_url] = thumb
+        for node_id in sorted({h.get("node_id") for h in history if isinstance(h.get("node_id"), int)}):
+            records = json_bytes(history_view(history, node_id))
+            rel_path = f"static/history/{_hashed_name(str(node_id), records, 'json')}"
+            written += _write_static_file(out_dir, rel_path, records)
+            manifest["node_history"][str(node_id)] = rel_path
+
+        # 保留上一版 manifest 引用的文件，已经拿到旧 manifest 的访客仍能读完这一轮
+        manifest_path = os.path.join(out_dir, "manifest.json")
+        keep = _manifest_paths(manifest)
+        if os.path.exists(manifest_path):
+            try:
+                with open(manifest_path, "r", encoding="utf-8") as f:
+                    keep |= _manifest_paths(json.load(f))
+            except (json.JSONDecodeError, OSError):
+                pass
+
+        manifest_json = json.dumps(manifest, ensure_ascii=False, indent=2).encode("utf-8")
+        tmp_path = f"{manifest_path}.{uuid.uuid4().hex}.tmp"
+        with metered_open(tmp_path, "wb") as f:
+            f.write(manifest_json)
+        os.replace(tmp_path, manifest_path)
+
+        removed = 0
+        static_root = os.path.join(out_dir, "static")
+        for dirpath, _, filenames in os.walk(static_root):
+            for filename in filenames:
+                path = os.path.join(dirpath, filename)
+                rel_path = os.path.relpath(path, out_dir).replace(os.sep, "/")
+                if rel_path.endswith(".gz"):
+                    rel_path = rel_path[:-3]
+                if rel_path not in keep:
+                    os.remove(path)
+                    removed += 1
+        return {"manifest": manifest, "written": written, "removed": removed}
+
+
+static_export_scheduler = DebouncedTask(
+    "Static export", lambda: export_static_site(STATIC_EXPORT_DIR), STATIC_EXPORT_DEBOUNCE, STATIC_EXPORT_MAX_DELAY)
+
+# --- 批量调整连线 ---
+
+BATCH_OPS = ("move", "link", "unlink")
+
+def apply_graph_batch(operations: list, dry_run: bool = False):
+    """
+    批量执行 move / link / unlink 操作，全部校验通过后才会一次性写入。
+
+    每条操作形如 {"op": "move", "node": 47, "parent": 1000}：
+    - move：把 node 从所有现有父节点的 extension 中移除，再挂到 parent 下
+    - link：在 parent 的 extension 中加入 node
+    - unlink：从 parent 的 extension 中移除 node
+
+    任何操作引用了不存在的节点、删除不存在的连线或造成环时抛出 ValueError，不做任何写入。
+    返回发生变化的节点列表（已写入，或 dry_run 时仅为计算结果）。
+    """
+    if not isinstance(operations, list) or not operations:
+        raise ValueError("操作列表不能为空")
+
+    nodes = graph_index.ensure_loaded()
+    with graph_index.lock:
+        # 只为被修改的节点复制一份 extension，其余节点直接读取索引
+        working = {}
+        def extension_of(node_id):
+            if node_id in working:
+                return working[node_id]
+            return nodes[node_id].get("extension", [])
+        def editable(node_id):
+            if node_id not in working:
+                working[node_id] = list(nodes[node_id].get("extension", []))
+            return working[node_id]
+
+        parents_of = {}
+        for node_id, node in nodes.items():
+            for child_id in node.get("extension", []):
+                parents_of.setdefault(child_id, set()).add(node_id)
+
+        errors = []
+        added_edges = []
+        for i, op in enumerate(operations):
+            prefix = f"第{i + 1}条操作"
+            if not isinstance(op, dict) or op.get("op") not in BATCH_OPS:
+                errors.append(f"{prefix}：op 必须是 {'/'.join(BATCH_OPS)} 之一")
+                continue
+            node_id, parent_id = op.get("node"), op.get("parent")
+            if any(not isinstance(n, int) or isinstance(n, bool) for n in (node_id, parent_id)):
+                errors.append(f"{prefix}：node 与 parent 必须是节点 id")
+                continue
+            missing = [str(n) for n in (node_id, parent_id) if n not in nodes]
+            if missing:
+                errors.append(f"{prefix}：节点 {', '.join(missing)} 不存在")
+                continue
+            if node_id == parent_id:
+                errors.append(f"{prefix}：节点不能连接到自身")
+                continue
+
+            if op["op"] == "unlink":
+                if node_id not in extension_of(parent_id):
+                    errors.append(f"{prefix}：节点 {parent_id} 与 {node_id} 之间没有连线")
+                    continue
+                editable(parent_id).remove(node_id)
+                parents_of[node_id].discard(parent_id)
+                continue
+
+            if op["op"] == "move":
+                for old_parent in list(parents_of.get(node_id, ())):
+                    ext = editable(old_parent)
+                    while node_id in ext:
+                        ext.remove(node_id)
+                parents_of[node_id] = set()
+            ext = editable(parent_id)
+            if node_id not in ext:
+                ext.append(node_id)
+                parents_of.setdefault(node_id, set()).add(parent_id)
+                added_edges.append((i, parent_id, node_id))
+
+        if not errors:
+            for i, parent_id, node_id in added_edges:
+                if parent_id not in parents_of.get(node_id, ()):
+                    continue
+                # 从新子节点出发沿 extension 向下搜索，能回到父节点即说明成环
+                stack, seen = [node_id], set()
+                while stack:
+                    current = stack.pop()
+                    if current == parent_id:
+                        errors.append(f"第{i + 1}条操作：连接 {parent_id} → {node_id} 会形成环")
+                        break
+                    if current in seen or current not in nodes:
+                        continue
+                    seen.add(current)
+                    stack.extend(extension_of(current))
+
+        if errors:
+            raise ValueError("；".join(errors))
+
+        changed = []
+        for node_id, ext in working.items():
+            if ext != nodes[node_id].get("extension", []):
+                node = dict(nodes[node_id])
+                node["extension"] = ext
+                changed.append(node)
+        if changed and not dry_run:
+            save_nodes(changed)
+    return changed
+
+# --- 数据完整性检查（fsck） ---
+
+# 节点文件应有的字段及类型；缺失时可以安全补上默认值的字段列在 NODE_FIELD_DEFAULTS 中
+NODE_SCHEMA = {
+    "id": int, "name": str, "image": str, "source": (dict, str), "related": list,
+    "tags": list, "extension": list, "introduction": str, "x": (int, float), "y": (int, float)
+}
+NODE_FIELD_DEFAULTS = {"image": "", "related": [], "tags": [], "extension": [], "introduction": ""}
+FSCK_CHUNK_SIZE = 1000
+
+def check_node_files(filenames: list):
+    """
+    逐个解析并检查一批节点文件，只做单文件内的检查，供进程池并行调用。
+    返回每个文件的精简信息（id、引用、图片）以及发现的问题，跨文件的检查由 run_fsck 汇总完成。
+    """
+    results = []
+    for filename in filenames:
+        entry = {"file": filename, "id": None, "extension": [], "connections": [], "image": "", "issues": []}
+        results.append(entry)
+        try:
+            with metered_open(os.path.join(DATA_DIR, filename), "r", encoding="utf-8") as f:
+                node = json.load(f)
+        except (json.JSONDecodeError, UnicodeDecodeError, IOError) as e:
+            entry["issues"].append({"type": "unparseable", "message": str(e)})
+            continue
+        if not isinstance(node, dict):
+            entry["issues"].append({"type": "schema", "message": "节点文件内容不是对象"})
+            continue
+
+        for field, expected in NODE_SCHEMA.items():
+            if field not in node:
+                entry["issues"].append({"type": "missing_field", "field": field, "repairable": field in NODE_FIELD_DEFAULTS})
+            elif not isinstance(node[field], expected) or isinstance(node[field], bool):
+                entry["issues"].append({"type": "schema", "field": field, "message": f"字段 {field} 类型错误"})
+
+        entry["id"] = node.get("id") if isinstance(node.get("id"), int) else None
+        if entry["id"] is not None and filename != f"{entry['id']}.json":
+            entry["issues"].append({"type": "id_mismatch", "message": f"文件名与 id {entry['id']} 不一致"})
+        for key in ("extension", "connections"):
+            refs = node.get(key, [])
+            if not isinstance(refs, list):
+                continue
+            entry[key] = [r for r in refs if isinstance(r, int) and not isinstance(r, bool)]
+            if len(entry[key]) != len(refs):
+                entry["issues"].append({"type": "schema", "field": key, "message": f"{key} 中含有非整数 id"})
+        if isinstance(node.get("image"), str):
+            entry["image"] = node["image"]
+    return results
+
+def run_fsck(workers: Optional[int] = None):
+    """
+    并行检查 data 中的全部节点文件，返回可序列化的检查报告。
+    报告中的每个问题都带有 type / file / node_id，可自动修复的问题标记 repairable。
+    """
+    started = datetime.datetime.now()
+    filenames = sorted(f for f in os.listdir(DATA_DIR) if f.endswith(".json"))
+    chunks = [filenames[i:i + FSCK_CHUNK_SIZE] for i in range(0, len(filenames), FSCK_CHUNK_SIZE)]
+    if len(chunks) > 1 and workers != 1:
+        # API 进程是多线程的，fork 出的子进程可能继承被其他线程持有的锁（如指标锁）而永远阻塞，所以用 spawn
+        with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn")) as pool:
+            entries = [e for chunk in pool.map(check_node_files, chunks) for e in chunk]
+    else:
+        entries = [e for chunk in chunks for e in check_node_files(chunk)]
+
+    issues = []
+    def report(entry, issue):
+        issue.setdefault("repairable", False)
+        issues.append({"file": entry["file"], "node_id": entry["id"], **issue})
+
+    files_by_id = {}
+    for entry in entries:
+        for issue in entry["issues"]:
+            report(entry, issue)
+        if entry["id"] is not None:
+            files_by_id.setdefault(entry["id"], []).append(entry["file"])
+    known_ids = set(files_by_id)
+    image_files = set(os.listdir(IMAGES_DIR)) if os.path.exists(IMAGES_DIR) else set()
+
+    parents = {}
+    for entry in entries:
+        if entry["id"] is None:
+            continue
+        if len(files_by_id[entry["id"]]) > 1:
+            report(entry, {"type": "duplicate_id", "message": f"id {entry['id']} 同时出现在 {', '.join(files_by_id[entry['id']])}"})
+        for key, issue_type in (("extension", "dangling_extension"), ("connections", "dangling_connection")):
+            seen = set()
+            for target in entry[key]:
+                if target in seen:
+                    report(entry, {"type": "duplicate_reference", "field": key, "target": target, "repairable": True})
+                    continue
+                seen.add(target)
+                if target == entry["id"]:
+                    report(entry, {"type": "self_reference", "field": key, "target": target, "repairable": True})
+                elif target not in known_ids:
+                    report(entry, {"type": issue_type, "field": key, "target": target, "repairable": True})
+                elif key == "extension":
+                    parents.setdefault(target, []).append(entry["id"])
+        image_url = entry["image"]
+        if image_url.startswith("/images/") and os.path.basename(image_url) not in image_files:
+            # 图片可能只是尚未从备份恢复，不自动清除引用
+            report(entry, {"type": "missing_image", "target": image_url})
+
+    for child_id, parent_ids in sorted(parents.items()):
+        if len(parent_ids) > 1:
+            issues.append({
+                "file": files_by_id[child_id][0], "node_id": child_id, "type": "multiple_parents",
+                "parents": sorted(parent_ids), "repairable": False
+            })
+
+    summary = {}
+    for issue in issues:
+        summary[issue["type"]] = summary.get(issue["type"], 0) + 1
+    return {
+        "checked": len(filenames),
+        "nodes": len(known_ids),
+        "issues": issues,
+        "summary": summary,
+        "repairable": sum(1 for i in issues if i["repairable"]),
+        "elapsed": (datetime.datetime.now() - started).total_seconds()
+    }
+
+def apply_fsck_repairs(report: dict):
+    """
+    根据检查报告修复可自动修复的问题（移除悬空/重复/自引用 id、补齐缺失字段），
+    所有被修改的节点文件通过 write_json_files 一并写入。返回被修改的节点 id 列表。
+    """
+    by_file = {}
+    for issue in report["issues"]:
+        # 文件名与 id 不一致的文件需要人工处理，这里只修复能按 id 写回原文件的节点
+        if issue["repairable"] and issue["file"] == f"{issue['node_id']}.json":
+            by_file.setdefault(issue["file"], []).append(issue)
+
+    repaired = []
+    for filename, file_issues in sorted(by_file.items()):
+        with metered_open(os.path.join(DATA_DIR, filename), "r", encoding="utf-8") as f:
+            node = json.load(f)
+        for issue in file_issues:
+            if issue["type"] == "missing_field":
+                default = NODE_FIELD_DEFAULTS[issue["field"]]
+                node.setdefault(issue["field"], list(default) if isinstance(default, list) else default)
+        for key in ("extension", "connections"):
+            drop = {i["target"] for i in file_issues if i.get("field") == key and i["type"] != "duplicate_reference"}
+            if key in node and any(i.get("field") == key for i in file_issues):
+                cleaned = []
+                for target in node[key]:
+                    if target not in drop and target not in cleaned:
+                        cleaned.append(target)
+                node[key] = cleaned
+        repaired.append(node)
+
+    if repaired:
+        save_nodes(repaired)
+    return [n["id"] for n in repaired]
+
+# Ensure images directory exists
+os.makedirs(IMAGES_DIR, exist_ok=True)
+
+# Mount images directory to serve static files
+app.mount("/images", StaticFiles(directory=IMAGES_DIR), name="images")
+
+# load_data is now at the top
+
+# --- Bangumi HTTP client ---
+
+_bgm_client = None
+_nickname_cache = OrderedDict()
+
+def get_bgm_client():
+    """
+    整个应用共享的 Bangumi HTTP 客户端，复用到 bgm.tv / api.bgm.tv 的长连接。
+    安装了 h2 时启用 HTTP/2。
+    """
+    global _bgm_client
+    if _bgm_client is None:
+        try:
+            import h2  # noqa: F401
+            http2 = BGM_HTTP2
+        except ImportError:
+            http2 = False
+        _bgm_client = httpx.AsyncClient(
+            timeout=BGM_TIMEOUT,
+            http2=http2,
+            limits=httpx.Limits(max_connections=100, max_keepalive_connections=20, keepalive_expiry=60.0)
+        )
+    return _bgm_client
+
+async def close_bgm_client():
+    global _bgm_client
+    if _bgm_client is not None:
+        await _bgm_client.aclose()
+        _bgm_client = None
+
+async def bgm_request(method: str, url: str, idempotent: bool = True, **kwargs):
+    """
+    带指数退避重试的请求。
+    非幂等请求（如用一次性 code 换取 token）只在连接尚未建立时重试，避免重复提交。
+    """
+    client = get_bgm_client()
+    for attempt in range(BGM_RETRIES + 1):
+        try:
+            resp = await client.request(method, url, **kwargs)
+            if not idempotent or (resp.status_code < 500 and resp.status_code != 429) or attempt == BGM_RETRIES:
+                return resp
+        except (httpx.ConnectError, httpx.ConnectTimeout, httpx.PoolTimeout):
+            if attempt == BGM_RETRIES:
+                raise
+        except httpx.TransportError:
+            if not idempotent or attempt == BGM_RETRIES:
+                raise
+        await asyncio.sleep(0.5 * 2 ** attempt)
+
+def cached_nickname(user_id: str):
+    entry = _nickname_cache.get(user_id)
+    if entry and entry[0] > time.monotonic():
+        return entry[1]
+    return None
+
+def cache_nickname(user_id: str, nickname: str):
+    _nickname_cache[user_id] = (time.monotonic() + NICKNAME_CACHE_TTL, nickname)
+    _nickname_cache.move_to_end(user_id)
+    while len(_nickname_cache) > NICKNAME_CACHE_SIZE:
+        _nickname_cache.popitem(last=False)
+
+# --- Auth Routes ---
+
+@app.get("/api/auth/login")
+def login():
+    # Redirect user to Bangumi
+    auth_url = f"{BGM_OAUTH_BASE}/oauth/authorize?client_id={BGM_CLIENT_ID}&response_type=code&redirect_uri={BGM_REDIRECT_URI}"
+    return {"url": auth_url}
+
+@app.get("/api/auth/callback")
+async def auth_callback(code: str):
+    # 1. Exchange code for access token
+    try:
+        token_resp = await bgm_request("POST", f"{BGM_OAUTH_BASE}/oauth/access_token", idempotent=False, data={
+            "grant_type": "authorization_code",
+            "client_id": BGM_CLIENT_ID,
+            "client_secret": BGM_CLIENT_SECRET,
+            "code": code,
+            "redirect_uri": BGM_REDIRECT_URI
+        })
+        token_resp.raise_for_status()
+    except httpx.HTTPError:
+        raise HTTPException(400, "Failed to exchange token with Bangumi")
+        
+    token_data = token_resp.json()
+    if "access_token" not in token_data:
+        raise HTTPException(400, "Failed to get access token")
+    
+    access_token = token_data["access_token"]
+    user_id = str(token_data["user_id"])
+    
+    # 2. Get user profile to get the real nick (optional but good for display)
+    nickname = cached_nickname(user_id)
+    if nickname is None:
+        try:
+            profile_resp = await bgm_request("GET", f"{BGM_API_BASE}/v0/me", headers={
+                "Authorization": f"Bearer {access_token}"
+            })
+            if profile_resp.status_code == 200:
+                profile = profile_resp.json()
+                nickname = profile.get("nickname", "User_" + access_token[:8])
+                cache_nickname(user_id, nickname)
+            else:
+                nickname = "User_" + access_token[:8]
+        except:
+            nickname = "User_" + access_token[:8]
+    
+    # Redirect back to frontend with the user info and a signed session token in query params
+    base_frontend_url = os.getenv("FRONTEND_URL", "http://localhost:5173/")
+    
+    # Fix: UnicodeEncodeError - Use urllib.parse.quote for non-ASCII chars in headers
+    redirect_params = {
+        "user_id": user_id,
+        "nickname": nickname,
+        "token": issue_session_token(user_id)
+    }
+    query_string = urllib.parse.urlencode(redirect_params)
+    
+    # Ensure base url has ? or & correctly
+    if "?" in base_frontend_url:
+        frontend_url = f"{base_frontend_url}&{query_string}"
+    else:
+        # Handle trailing slash logic if needed, but usually query params are fine
+        if base_frontend_url.endswith("/"):
+             frontend_url = f"{base_frontend_url}?{query_string}"
+        else:
+             frontend_url = f"{base_frontend_url}/?{query_string}"
+
+    return Response(status_code=302, headers={"Location": frontend_url})
+
+# --- Node Routes ---
+
+@app.get("/api/nodes")
+def get_nodes(request: Request):
+    # 带 Accept: application/x-anon-graph 的客户端获取紧凑的二进制格式，其余仍为 JSON
+    binary = accepts_graph_binary(request)
+    def render():
+        with graph_index.lock:
+            if not binary and graph_index.snapshot is not None and graph_index.snapshot_version == graph_index.version:
+                # 内存中的图与快照一致时，快照的 JSON 区就是完整的响应体
+                return graph_index.snapshot.body()
+            data = load_data()
+            return encode_graph_binary(data["nodes"]) if binary else json_bytes(data)
+    graph_index.ensure_loaded()
+    body = read_flight.do(("nodes", binary, graph_index.version), render)
+    media_type = GRAPH_BINARY_MEDIA_TYPE if binary else "application/json"
+    return Response(content=body, media_type=media_type, headers={"Vary": "Accept"})
+
+@app.get("/api/nodes/{node_id}")
+def get_node(node_id: int):
+    nodes = graph_index.ensure_loaded()
+    with graph_index.lock:
+        if graph_index.snapshot is not None and graph_index.snapshot_version == graph_index.version:
+            # 内存中的图与快照一致时直接取快照中该节点的 JSON，不必复制并重新序列化节点
+            record = graph_index.snapshot.record(node_id)
+            if record is None:
+                raise HTTPException(status_code=404, detail="Node not found")
+            return Response(content=record, media_type="application/json")
+        node = nodes.get(node_id)
+        if node is None:
+            raise HTTPException(status_code=404, detail="Node not found")
+        return copy.deepcopy(node)
+
+@app.get("/api/clusters")
+def get_clusters(zoom: float = 1.0, expand: str = ""):
+    """
+    返回当前缩放级别下应当绘制的节点与聚类。
+    子树在屏幕上足够大（或在 expand 中显式展开）时展开其子节点，否则整棵子树折叠为一个聚类。
+    """
+    if zoom <= 0:
+        raise HTTPException(400, "zoom 必须大于 0")
+    expanded = {int(i) for i in expand.split(",") if i.strip().isdigit()}
+
+    nodes = graph_index.ensure_loaded()
+    with graph_index.lock:
+        items = []
+        visible = set()
+        stack = list(reversed(cluster_roots()))
+        while stack:
+            node_id = stack.pop()
+            if node_id in visible:
+                continue
+            kids = cluster_children(node_id)
+            box = graph_index.summary(node_id)[1]
+            extent = max(box[2] - box[0], box[3] - box[1]) * zoom
+            is_open = not kids or node_id in expanded or extent >= CLUSTER_SCREEN_SIZE
+            items.append(cluster_item(nodes[node_id], not is_open))
+            visible.add(node_id)
+            if is_open:
+                stack.extend(reversed(kids))
+
+        edges = []
+        for node_id in visible:
+            for target_id in nodes[node_id].get("extension", []):
+                if target_id in visible and target_id != node_id:
+                    edges.append([node_id, target_id])
+        version = graph_index.version
+
+    return {"version": version, "zoom": zoom, "items": items, "edges": edges}
+
+@app.get("/api/clusters/{node_id}")
+def expand_cluster(node_id: int):
+    nodes = graph_index.ensure_loaded()
+    with graph_index.lock:
+        if node_id not in nodes:
+            raise HTTPException(404, "Node not found")
+        kids = cluster_children(node_id)
+        items = [cluster_item(nodes[k], bool(graph_index.tree_children.get(k))) for k in kids]
+        version = graph_index.version
+    return {
+        "version": version,
+        "id": node_id,
+        "items": items,
+        "edges": [[node_id, k] for k in kids]
+    }
+
+@app.get("/api/nodes/{node_id}/lineage")
+def get_node_lineage(node_id: int):
+    nodes = graph_index.ensure_loaded()
+    with graph_index.lock:
+        if node_id not in nodes:
+            raise HTTPException(404, "Node not found")
+        info = graph_index.lineage(node_id)
+        path = [{"id": i, "name": nodes[i].get("name", "")} for i in info["path"]]
+    root_id = path[0]["id"]
+    return {
+        "id": node_id,
+        "parent": path[-2]["id"] if len(path) > 1 else None,
+        "depth": len(path) - 1,
+        "path": path,
+        # 根节点下的第一层即该节点所属的分类
+        "category": path[1] if len(path) > 1 and root_id == 1 else None,
+        "other_parents": info["other_parents"],
+        "orphan": root_id != 1 and not info["in_cycle"],
+        "in_cycle": info["in_cycle"]
+    }
+
+@app.get("/api/nodes/{node_id}/subtree")
+def get_node_subtree(node_id: int, max_depth: Optional[int] = None, limit: int = 1000):
+    nodes = graph_index.ensure_loaded()
+    with graph_index.lock:
+        if node_id not in nodes:
+            raise HTTPException(404, "Node not found")
+        members, truncated = graph_index.subtree(node_id, max_depth=max_depth, limit=max(limit, 0))
+        return {
+            "id": node_id,
+            "descendant_count": graph_index.descendant_count(node_id),
+            "children": len(graph_index.tree_children.get(node_id, ())),
+            "nodes": [
+                {"id": i, "name": nodes[i].get("name", ""), "parent": graph_index.tree_parent.get(i), "depth": d}
+                for i, d in members
+            ],
+            "truncated": truncated
+        }
+
+@app.get("/api/user/info")
 def get_user_info(user_id: str = "guest", nickname: str = "游客"):
-    if user_id == "guest":
-        return {"logged_in": False, "role": "visitor"}
-    
-    banned = load_banned()
-    if user_id in banned:
-        return {
-            "logged_in": True,  # 允许显示登录态
-            "user_id": user_id,
-            "nickname": nickname,  # 恢复原名，不需要提示
-            "role": "banned",      # 角色设为 banned
-            "quota": {"adds": 0, "edits": 0, "deletes": 0, "applies": 0, "messages": 0}, # 配额全设为 0
-            "notifications": []
-        }
-        
-    admins = load_admins()
-    user_data = load_user(user_id)
+    if user_id == "guest":
+        return {"logged_in": False, "role": "visitor"}
+    
+    if not identity_matches(user_id):
+        raise HTTPException(403, "身份校验失败，请重新登录")
+    if is_banned(user_id):
+        return {
+            "logged_in": True,  # 允许显示登录态
+            "user_id": user_id,
+            "nickname": nickname,  # 恢复原名，不需要提示
+            "role": "banned",      # 角色设为 banned
+            "quota": {"adds": 0, "edits": 0, "deletes": 0, "applies": 0, "messages": 0}, # 配额全设为 0
+            "notifications": []
+        }
+        
     quota = get_user_quota(user_id)
-    role = "admin" if user_id in admins else "user"
-    notifications = user_data.get("notifications", []) if user_data else []
+    role = "admin" if is_admin(user_id) else "user"
+    notifications = notification_hub.unread_ids(user_id)
     return {
         "logged_in": True,
         "user_id": user_id,
@@ -535,104 +3166,98 @@ def get_user_info(user_id: str = "guest", nickname: str = "游客"):
         "quota": quota,
         "notifications": notifications
     }
-
-@app.post("/api/nodes")
-def add_node(
-    name: str = Form(...),
-    source: str = Form(...),
-    related: str = Form(...),
-    tags: str = Form(...),
-    extension: str = Form(...),
-    introduction: str = Form(""),
-    x: float = Form(0.0),
-    y: float = Form(0.0),
-    user_id: str = Form("guest"),
-    nickname: str = Form("未知用户"),
-    parent_id: Optional[int] = Form(None),
-    image: Optional[UploadFile] = File(None)
-):
-    if user_id == "guest":
-        raise HTTPException(403, "游客状态-请登录后进行新增")
-    if not check_permission(user_id, "add"):
-        raise HTTPException(403, "普通用户-你今天已经新增了10个爱音了，明天再来吧")
-    
-    data = load_data()
-    nodes = data.get("nodes", [])
-    
-    new_id = max([n.get("id", 0) for n in nodes], default=0) + 1
-    
-    image_url = ""
-    if image:
-        filename = f"{uuid.uuid4()}.webp"
-        filepath = os.path.join(IMAGES_DIR, filename)
-        try:
-            with Image.open(image.file) as img:
-                if img.mode in ("RGBA", "LA") or (img.mode == "P" and "transparency" in img.info):
-                    img = img.convert("RGBA")
-                else:
-                    img = img.convert("RGB")
-                img.save(filepath, "WEBP")
-            image_url = f"/images/{filename}"
-        except Exception as e:
-            raise HTTPException(500, f"Image processing failed: {str(e)}")
-    
-    new_node = {
-        "id": new_id,
-        "name": name,
-        "image": image_url,
-        "source": json.loads(source),
-        "related": json.loads(related),
-        "tags": json.loads(tags),
-        "extension": json.loads(extension),
-        "introduction": introduction,
-        "x": x,
-        "y": y,
-        "time": str(datetime.date.today()),
-        "new": True
-    }
-    
-    # Automatic connection from parent to new node
-    if parent_id is not None:
-        parent_file = os.path.join(DATA_DIR, f"{parent_id}.json")
-        if os.path.exists(parent_file):
-            with open(parent_file, "r", encoding="utf-8") as f:
-                parent = json.load(f)
-                if "extension" not in parent: parent["extension"] = []
-                if new_id not in parent["extension"]:
-                    parent["extension"].append(new_id)
-                    save_node(parent)
-
-    save_node(new_node)
-    record_action(user_id, "add", new_node["id"], new_node["name"], nickname)
-    return new_node
-
-@app.put("/api/nodes/{node_id}")
-def update_node(
-    node_id: int,
-    name: str = Form(...),
-    source: str = Form(...),
-    related: str = Form(...),
-    tags: str = Form(...),
-    extension: str = Form(...),
-    introduction: str = Form(""),
-    user_id: str = Form("guest"),
-    nickname: str = Form("未知用户"),
-    image: Optional[UploadFile] = File(None)
-):
-    if user_id == "guest":
-        raise HTTPException(403, "游客状态-请登录后进行修改")
-    if not check_permission(user_id, "edit"):
-        raise HTTPException(403, "普通用户-你今天已经修改了10个爱音了，明天再来吧")
-        
-    node_file = os.path.join(DATA_DIR, f"{node_id}.json")
-    if not os.path.exists(node_file):
-        raise HTTPException(status_code=404, detail="Node not found")
-        
-    with open(node_file, "r", encoding="utf-8") as f:
-        node = json.load(f)
-    
-    if image:
-        # Delete old image if it exists and is not default
+
+@app.post("/api/nodes")
+def add_node(
+    name: str = Form(...),
+    source: str = Form(...),
+    related: str = Form(...),
+    tags: str = Form(...),
+    extension: str = Form(...),
+    introduction: str = Form(""),
+    x: float = Form(0.0),
+    y: float = Form(0.0),
+    user_id: str = Form("guest"),
+    nickname: str = Form("未知用户"),
+    parent_id: Optional[int] = Form(None),
+    image: Optional[UploadFile] = File(None)
+):
+    if user_id == "guest":
+        raise HTTPException(403, "游客状态-请登录后进行新增")
+    if not check_permission(user_id, "add"):
+        raise HTTPException(403, "普通用户-你今天已经新增了10个爱音了，明天再来吧")
+    
+    nodes = graph_index.ensure_loaded()
+    with graph_index.lock:
+        new_id = max(nodes.keys(), default=0) + 1
+    
+    image_url = ""
+    if image:
+        filename = f"{uuid.uuid4()}.webp"
+        filepath = os.path.join(IMAGES_DIR, filename)
+        try:
+            save_webp_image(image.file, filepath)
+            image_url = f"/images/{filename}"
+        except Exception as e:
+            raise HTTPException(500, f"Image processing failed: {str(e)}")
+    
+    new_node = {
+        "id": new_id,
+        "name": name,
+        "image": image_url,
+        "source": json.loads(source),
+        "related": json.loads(related),
+        "tags": json.loads(tags),
+        "extension": json.loads(extension),
+        "introduction": introduction,
+        "x": x,
+        "y": y,
+        "time": str(datetime.date.today()),
+        "new": True
+    }
+    
+    # Automatic connection from parent to new node
+    if parent_id is not None:
+        parent_file = os.path.join(DATA_DIR, f"{parent_id}.json")
+        if os.path.exists(parent_file):
+            with metered_open(parent_file, "r", encoding="utf-8") as f:
+                parent = json.load(f)
+                if "extension" not in parent: parent["extension"] = []
+                if new_id not in parent["extension"]:
+                    parent["extension"].append(new_id)
+                    save_node(parent)
+
+    save_node(new_node)
+    record_action(user_id, "add", new_node["id"], new_node["name"], nickname)
+    return new_node
+
+@app.put("/api/nodes/{node_id}")
+def update_node(
+    node_id: int,
+    name: str = Form(...),
+    source: str = Form(...),
+    related: str = Form(...),
+    tags: str = Form(...),
+    extension: str = Form(...),
+    introduction: str = Form(""),
+    user_id: str = Form("guest"),
+    nickname: str = Form("未知用户"),
+    image: Optional[UploadFile] = File(None)
+):
+    if user_id == "guest":
+        raise HTTPException(403, "游客状态-请登录后进行修改")
+    if not check_permission(user_id, "edit"):
+        raise HTTPException(403, "普通用户-你今天已经修改了10个爱音了，明天再来吧")
+        
+    node_file = os.path.join(DATA_DIR, f"{node_id}.json")
+    if not os.path.exists(node_file):
+        raise HTTPException(status_code=404, detail="Node not found")
+        
+    with metered_open(node_file, "r", encoding="utf-8") as f:
+        node = json.load(f)
+    
+    if image:
+        # Delete old image if it exists and is not default
         old_image = node.get("image", "")
         # Check if old_image is not default (simplified check for 'default')
         if old_image and "default" not in old_image and old_image.startswith("/images/"):
@@ -641,33 +3266,27 @@ def update_node(
                 if old_image_path and os.path.exists(old_image_path):
                     os.remove(old_image_path)
             except: pass
-
-        filename = f"{uuid.uuid4()}.webp"
-        filepath = os.path.join(IMAGES_DIR, filename)
-        try:
-            with Image.open(image.file) as img:
-                # Handle transparency
-                if img.mode in ("RGBA", "LA") or (img.mode == "P" and "transparency" in img.info):
-                    img = img.convert("RGBA")
-                else:
-                    img = img.convert("RGB")
-                img.save(filepath, "WEBP")
-            node["image"] = f"/images/{filename}"
-        except Exception as e:
-            raise HTTPException(500, f"Image processing failed: {str(e)}")
-        
-    node["name"] = name
-    node["source"] = json.loads(source)
-    node["related"] = json.loads(related)
-    node["tags"] = json.loads(tags)
-    node["extension"] = json.loads(extension)
-    node["introduction"] = introduction
-    
-    save_node(node)
-    record_action(user_id, "edit", node["id"], node["name"], nickname)
-    return node
-
-@app.patch("/api/nodes/{node_id}/extension")
+
+        filename = f"{uuid.uuid4()}.webp"
+        filepath = os.path.join(IMAGES_DIR, filename)
+        try:
+            save_webp_image(image.file, filepath)
+            node["image"] = f"/images/{filename}"
+        except Exception as e:
+            raise HTTPException(500, f"Image processing failed: {str(e)}")
+        
+    node["name"] = name
+    node["source"] = json.loads(source)
+    node["related"] = json.loads(related)
+    node["tags"] = json.loads(tags)
+    node["extension"] = json.loads(extension)
+    node["introduction"] = introduction
+    
+    save_node(node)
+    record_action(user_id, "edit", node["id"], node["name"], nickname)
+    return node
+
+@app.patch("/api/nodes/{node_id}/extension")
 def update_node_extension(
     node_id: int,
     target_id: int = Form(...),
@@ -683,350 +3302,557 @@ def update_node_extension(
     node_file = os.path.join(DATA_DIR, f"{node_id}.json")
     if not os.path.exists(node_file):
         raise HTTPException(404, "Node not found")
-        
-    with open(node_file, "r", encoding="utf-8") as f:
-        node = json.load(f)
-    
-    if "extension" not in node:
-        node["extension"] = []
-    
-    if action == "add":
-        if target_id not in node["extension"]:
-            node["extension"].append(target_id)
-    elif action == "remove":
-        if target_id in node["extension"]:
-            node["extension"].remove(target_id)
-    
-    save_node(node)
-    record_action(user_id, "edit", node["id"], node["name"], nickname)
-    return node
-
-@app.patch("/api/nodes/{node_id}/position")
-def update_node_position(
-    node_id: int,
-    x: float = Form(...),
-    y: float = Form(...),
-    user_id: str = Form("guest"),
-    nickname: str = Form("未知用户")
-):
-    if user_id == "guest":
-        raise HTTPException(403, "游客状态-请登录后进行修改")
-    admins = load_admins()
-    if user_id not in admins:
-        raise HTTPException(403, "仅管理员可保存节点位置")
-        
-    node_file = os.path.join(DATA_DIR, f"{node_id}.json")
-    if not os.path.exists(node_file):
-        raise HTTPException(status_code=404, detail="Node not found")
-        
-    with open(node_file, "r", encoding="utf-8") as f:
-        node = json.load(f)
-    node["x"] = x
-    node["y"] = y
-    
-    save_node(node)
-    record_action(user_id, "edit", node["id"], node["name"], nickname)
-    return node
-
-@app.delete("/api/nodes/{node_id}")
-def delete_node(node_id: int, user_id: str = "guest", nickname: str = "未知用户"):
-    if user_id == "guest":
-        raise HTTPException(403, "游客状态-请登录后进行删除")
-    if not check_permission(user_id, "delete"):
-        raise HTTPException(403, "普通用户-你今天已经删除了一个爱音了，明天再来吧")
-        
-    node_file = os.path.join(DATA_DIR, f"{node_id}.json")
-    if not os.path.exists(node_file):
-        raise HTTPException(status_code=404, detail="Node not found")
-    
-    with open(node_file, "r", encoding="utf-8") as f:
-        node = json.load(f)
-    
-    if ("extension" in node and len(node["extension"]) > 0):
-        raise HTTPException(
-            status_code=400, 
-            detail=f"该形象「{node['name']}」尚有后续的分支/后辈节点，无法删除（请先删除其关联的所有后辈形象）。"
-        )
-
-    other_nodes_exist = any(f.endswith(".json") and f != "1.json" for f in os.listdir(DATA_DIR))
-    if (node_id == 1 and other_nodes_exist):
-        raise HTTPException(status_code=400, detail="根节点爱音受到宇宙法则保护，在其他爱音被清理完之前不可删除。")
-        
-    deleted_name = node["name"]
-    
-    # Remove references from other nodes
-    for filename in os.listdir(DATA_DIR):
-        if filename.endswith(".json") and filename != f"{node_id}.json":
-            other_file = os.path.join(DATA_DIR, filename)
-            try:
-                with open(other_file, "r", encoding="utf-8") as f:
-                    other_node = json.load(f)
-                changed = False
-                if "extension" in other_node and node_id in other_node["extension"]:
-                    other_node["extension"].remove(node_id)
-                    changed = True
-                if "connections" in other_node and node_id in other_node["connections"]:
-                    other_node["connections"].remove(node_id)
-                    changed = True
-                if changed:
-                    save_node(other_node)
-            except: continue
-            
-    delete_node_file(node_id)
-    record_action(user_id, "delete", node_id, deleted_name, nickname)
-    return {"message": "Node deleted successfully"}
-    
-    node = nodes[node_idx]
-    
-    # Check if any other node's extension points to this node? (Referenced elsewhere)
-    # The requirement: if it has extensions (children), it cannot be deleted.
-    if ("extension" in node and len(node["extension"]) > 0):
-        # Specific block: if this node has sub-nodes (branches), it cannot be deleted unless children are gone.
-        raise HTTPException(
-            status_code=400, 
-            detail=f"该形象「{node['name']}」尚有后续的分支/后辈节点，无法删除（请先删除其关联的所有后辈形象）。"
-        )
-
-    # Special protection for the root node if it's the only one of its kind? 
-    # Or as the user mentioned: "只要有一个其他爱音存在，id为1的千早爱音就是不能删除的"
-    if (node_id == 1 and len(nodes) > 1):
-        raise HTTPException(status_code=400, detail="根节点爱音受到宇宙法则保护，在其他爱音被清理完之前不可删除。")
-        
-    # Remove extensions pointing to this node
-    for n in nodes:
-        if "extension" in n and node_id in n["extension"]:
-            n["extension"].remove(node_id)
-        # Handle old key if it exists
-        if "connections" in n and node_id in n["connections"]:
-            n["connections"].remove(node_id)
-            
-    deleted_name = nodes[node_idx]["name"]
-    nodes.pop(node_idx)
-    data["nodes"] = nodes
-    save_data(data)
-    record_action(user_id, "delete", node_id, deleted_name, nickname)
-    return {"message": "Node deleted successfully"}
-
-@app.get("/api/history")
-def get_history(node_id: Optional[int] = None):
-    # 先处理全站历史的 50 条限制归档
-    archive_old_history()
-    
-    history = load_history()
-    if node_id is not None:
-        # Filter by node_id and only return the last 10 records for that node
-        node_history = [h for h in history if h.get("node_id") == node_id]
-        return node_history[-10:][::-1]
-    
-    # Return global history limited to the last 100 records
-    return history[-100:][::-1]
-
-@app.get("/api/applications")
-def get_applications(user_id: str = "guest"):
-    if user_id == "guest":
-        raise HTTPException(403, "Unauthorized")
-    admins = load_admins()
-    if user_id not in admins:
-        raise HTTPException(403, "Unauthorized")
-    return load_applications()
-
-@app.post("/api/applications")
-def apply_famous(
-    node_id: int = Form(...),
-    user_id: str = Form("guest"),
-    nickname: str = Form("未知用户")
-):
-    if user_id == "guest":
-        raise HTTPException(403, "请登录后操作")
-    if not check_permission(user_id, "apply"):
-        raise HTTPException(403, "今日申请次数已用完")
-        
-    node_file = os.path.join(DATA_DIR, f"{node_id}.json")
-    if not os.path.exists(node_file):
-        raise HTTPException(404, "Node not found")
-        
-    with open(node_file, "r", encoding="utf-8") as f:
-        node = json.load(f)
-        
-    apps = load_applications()
-    if any(a["node_id"] == node_id for a in apps):
-        raise HTTPException(400, "该节点已在申请中")
-        
-    new_app = {
-        "id": str(uuid.uuid4()),
-        "node_id": node_id,
-        "node_name": node["name"],
-        "user_id": user_id,
-        "nickname": nickname,
-        "time": datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-    }
-    apps.append(new_app)
-    save_applications(apps)
-    
-    # record_action will handle quota deduction
-    record_action(user_id, "apply_famous", node_id, node["name"], nickname)
-    return new_app
-
-@app.post("/api/applications/{app_id}/process")
-def process_application(
-    app_id: str,
-    action: str = Form(...),
-    user_id: str = Form("guest"),
-    nickname: str = Form("未知用户")
-):
-    admins = load_admins()
-    if user_id not in admins:
-        raise HTTPException(403, "Unauthorized")
-        
-    apps = load_applications()
-    app_idx = next((i for i, a in enumerate(apps) if a["id"] == app_id), None)
-    if app_idx is None:
-        raise HTTPException(404, "Application not found")
-        
-    application = apps[app_idx]
-    node_id = application["node_id"]
-    node_name = application["node_name"]
-    
-    if action == "approve":
-        node_file = os.path.join(DATA_DIR, f"{node_id}.json")
-        if os.path.exists(node_file):
-            with open(node_file, "r", encoding="utf-8") as f:
-                node = json.load(f)
-            node["is_famous"] = True
-            save_node(node)
-        record_action(user_id, "approve_famous", node_id, node_name, nickname)
-    else:
-        record_action(user_id, "reject_famous", node_id, node_name, nickname)
-        
-    apps.pop(app_idx)
-    save_applications(apps)
-    return {"message": "Processed"}
-
-@app.patch("/api/nodes/{node_id}/famous")
-def toggle_famous(
-    node_id: int,
-    is_famous: bool = Form(...),
-    user_id: str = Form("guest"),
-    nickname: str = Form("未知用户")
-):
-    admins = load_admins()
-    if user_id not in admins:
-        raise HTTPException(403, "Unauthorized")
-        
-    node_file = os.path.join(DATA_DIR, f"{node_id}.json")
-    if not os.path.exists(node_file):
-        raise HTTPException(404, "Node not found")
-        
-    with open(node_file, "r", encoding="utf-8") as f:
-        node = json.load(f)
-        
-    node["is_famous"] = is_famous
-    save_node(node)
-    record_action(user_id, "edit", node_id, node["name"], nickname)
-    return node
-
-# --- Mailbox Routes ---
-
-@app.get("/api/mailbox")
-def get_mailbox(user_id: str = "guest"):
+        
+    with metered_open(node_file, "r", encoding="utf-8") as f:
+        node = json.load(f)
+    
+    if "extension" not in node:
+        node["extension"] = []
+    
+    if action == "add":
+        if target_id not in node["extension"]:
+            node["extension"].append(target_id)
+    elif action == "remove":
+        if target_id in node["extension"]:
+            node["extension"].remove(target_id)
+    
+    save_node(node)
+    record_action(user_id, "edit", node["id"], node["name"], nickname)
+    return node
+
+@app.post("/api/nodes/batch")
+def batch_update_extensions(
+    operations: str = Form(...),
+    dry_run: bool = Form(False),
+    user_id: str = Form("guest"),
+    nickname: str = Form("未知用户")
+):
     if user_id == "guest":
-        raise HTTPException(403, "请登录后查看信箱")
-    
-    # 在获取信箱内容前先执行归档操作
-    archive_old_mail()
-    
-    messages = load_mailbox()
-
-    unprocessed = [m for m in messages if m.get("status") == "unprocessed"]
-    handled = [m for m in messages if m.get("status") != "unprocessed"]
-
-    unprocessed.sort(key=lambda x: x.get("time", ""), reverse=True)
-    handled.sort(
-        key=lambda x: x.get("processed_time") or x.get("time", ""),
-        reverse=True
+        raise HTTPException(403, "游客状态-请登录后进行修改")
+    if not is_admin(user_id):
+        raise HTTPException(403, "仅管理员可批量调整节点")
+
+    try:
+        ops = json.loads(operations)
+    except json.JSONDecodeError:
+        raise HTTPException(400, "operations 不是合法的 JSON")
+    try:
+        changed = apply_graph_batch(ops, dry_run=dry_run)
+    except ValueError as e:
+        raise HTTPException(400, str(e))
+
+    if changed and not dry_run:
+        record_action(
+            user_id, "edit", 0, f"批量调整连线（{len(changed)}个节点）", nickname,
+            details={"operations": len(ops), "nodes": [n["id"] for n in changed]}
+        )
+    return {"dry_run": dry_run, "changed": changed}
+
+@app.patch("/api/nodes/positions")
+def update_node_positions(
+    positions: str = Form(...),
+    user_id: str = Form("guest"),
+    nickname: str = Form("未知用户")
+):
+    """一次保存多个节点的位置（[{"id": 1, "x": 0, "y": 0}, ...]），只写一次文件、只记一条历史。"""
+    if user_id == "guest":
+        raise HTTPException(403, "游客状态-请登录后进行修改")
+    if not is_admin(user_id):
+        raise HTTPException(403, "仅管理员可保存节点位置")
+
+    try:
+        items = json.loads(positions)
+    except json.JSONDecodeError:
+        raise HTTPException(400, "positions 不是合法的 JSON")
+    if not isinstance(items, list) or not items:
+        raise HTTPException(400, "positions 不能为空")
+
+    nodes = graph_index.ensure_loaded()
+    updated = {}
+    with graph_index.lock:
+        for item in items:
+            try:
+                node_id, x, y = item["id"], float(item["x"]), float(item["y"])
+            except (KeyError, TypeError, ValueError):
+                raise HTTPException(400, f"位置数据格式错误: {item}")
+            if not isinstance(node_id, int) or isinstance(node_id, bool) or isinstance(item["x"], bool) or isinstance(item["y"], bool):
+                raise HTTPException(400, f"位置数据格式错误: {item}")
+            if not (math.isfinite(x) and math.isfinite(y)):
+                raise HTTPException(400, f"坐标必须是有限的数值: {item}")
+            if node_id not in nodes:
+                raise HTTPException(404, f"Node {node_id} not found")
+            node = updated.get(node_id) or dict(nodes[node_id])
+            node["x"] = x
+            node["y"] = y
+            updated[node_id] = node
+        save_nodes(list(updated.values()))
+
+    record_action(
+        user_id, "edit", 0, f"批量保存位置（{len(updated)}个节点）", nickname,
+        details={"nodes": list(updated)}
     )
+    return {"updated": [{"id": n["id"], "x": n["x"], "y": n["y"]} for n in updated.values()]}
+
+@app.patch("/api/nodes/{node_id}/position")
+def update_node_position(
+    node_id: int,
+    x: float = Form(...),
+    y: float = Form(...),
+    user_id: str = Form("guest"),
+    nickname: str = Form("未知用户")
+):
+    if user_id == "guest":
+        raise HTTPException(403, "游客状态-请登录后进行修改")
+    if not is_admin(user_id):
+        raise HTTPException(403, "仅管理员可保存节点位置")
+    if not (math.isfinite(x) and math.isfinite(y)):
+        raise HTTPException(400, "坐标必须是有限的数值")
+        
+    node_file = os.path.join(DATA_DIR, f"{node_id}.json")
+    if not os.path.exists(node_file):
+        raise HTTPException(status_code=404, detail="Node not found")
+        
+    with metered_open(node_file, "r", encoding="utf-8") as f:
+        node = json.load(f)
+    node["x"] = x
+    node["y"] = y
+    
+    save_node(node)
+    record_action(user_id, "edit", node["id"], node["name"], nickname)
+    return node
+
+@app.delete("/api/nodes/{node_id}")
+def delete_node(node_id: int, user_id: str = "guest", nickname: str = "未知用户"):
+    if user_id == "guest":
+        raise HTTPException(403, "游客状态-请登录后进行删除")
+    if not check_permission(user_id, "delete"):
+        raise HTTPException(403, "普通用户-你今天已经删除了一个爱音了，明天再来吧")
+        
+    node_file = os.path.join(DATA_DIR, f"{node_id}.json")
+    if not os.path.exists(node_file):
+        raise HTTPException(status_code=404, detail="Node not found")
+    
+    with metered_open(node_file, "r", encoding="utf-8") as f:
+        node = json.load(f)
+    
+    if ("extension" in node and len(node["extension"]) > 0):
+        raise HTTPException(
+            status_code=400, 
+            detail=f"该形象「{node['name']}」尚有后续的分支/后辈节点，无法删除（请先删除其关联的所有后辈形象）。"
+        )
+
+    nodes = graph_index.ensure_loaded()
+    if (node_id == 1 and len(nodes) > 1):
+        raise HTTPException(status_code=400, detail="根节点爱音受到宇宙法则保护，在其他爱音被清理完之前不可删除。")
+        
+    deleted_name = node["name"]
+    
+    # Remove references from other nodes (父节点直接取自索引，旧的 connections 字段仍需在内存中检查)
+    with graph_index.lock:
+        referrers = set(graph_index.parents.get(node_id, ()))
+        referrers.update(i for i, n in nodes.items() if node_id in n.get("connections", []))
+        changed_nodes = []
+        for other_id in referrers:
+            if other_id == node_id or other_id not in nodes:
+                continue
+            other_node = dict(nodes[other_id])
+            for key in ("extension", "connections"):
+                if node_id in other_node.get(key, []):
+                    other_node[key] = [i for i in other_node[key] if i != node_id]
+            changed_nodes.append(other_node)
+        if changed_nodes:
+            save_nodes(changed_nodes)
+            
+    delete_node_file(node_id)
+    record_action(user_id, "delete", node_id, deleted_name, nickname)
+    return {"message": "Node deleted successfully"}
+    
+    node = nodes[node_idx]
+    
+    # Check if any other node's extension points to this node? (Referenced elsewhere)
+    # The requirement: if it has extensions (children), it cannot be deleted.
+    if ("extension" in node and len(node["extension"]) > 0):
+        # Specific block: if this node has sub-nodes (branches), it cannot be deleted unless children are gone.
+        raise HTTPException(
+            status_code=400, 
+            detail=f"该形象「{node['name']}」尚有后续的分支/后辈节点，无法删除（请先删除其关联的所有后辈形象）。"
+        )
+
+    # Special protection for the root node if it's the only one of its kind? 
+    # Or as the user mentioned: "只要有一个其他爱音存在，id为1的千早爱音就是不能删除的"
+    if (node_id == 1 and len(nodes) > 1):
+        raise HTTPException(status_code=400, detail="根节点爱音受到宇宙法则保护，在其他爱音被清理完之前不可删除。")
+        
+    # Remove extensions pointing to this node
+    for n in nodes:
+        if "extension" in n and node_id in n["extension"]:
+            n["extension"].remove(node_id)
+        # Handle old key if it exists
+        if "connections" in n and node_id in n["connections"]:
+            n["connections"].remove(node_id)
+            
+    deleted_name = nodes[node_idx]["name"]
+    nodes.pop(node_idx)
+    data["nodes"] = nodes
+    save_data(data)
+    record_action(user_id, "delete", node_id, deleted_name, nickname)
+    return {"message": "Node deleted successfully"}
+
+def history_view(history: list, node_id: Optional[int] = None):
+    if node_id is not None:
+        # Filter by node_id and only return the last 10 records for that node
+        node_history = [h for h in history if h.get("node_id") == node_id]
+        return node_history[-10:][::-1]
+    # Return global history limited to the last 100 records
+    return history[-100:][::-1]
+
+@app.get("/api/history")
+def get_history(node_id: Optional[int] = None):
+    def render():
+        history = read_flight.do(("history_file", version), load_history)
+        return json_bytes(history_view(history, node_id))
+    version = history_stamp()
+    body = read_flight.do(("history", node_id, version), render)
+    return Response(content=body, media_type="application/json")
+
+@app.get("/api/stats/contributors")
+def get_contributors(month: Optional[str] = None, action: Optional[str] = None, limit: int = 20):
+    """贡献排行。month 为 YYYY-MM 或 current（本月），不传时统计全部历史；action 只统计某一种操作。"""
+    if month == "current":
+        month = datetime.date.today().strftime("%Y-%m")
+    elif month is not None and not re.fullmatch(r"\d{4}-\d{2}", month):
+        raise HTTPException(400, "month 格式应为 YYYY-MM 或 current")
+    return contribution_stats.contributors(month, action, max(1, min(limit, 100)))
+
+@app.get("/api/stats/activity")
+def get_activity(days: int = 30, action: Optional[str] = None):
+    """最近 days 天（含今天）每天的操作数，没有操作的日期计为 0。"""
+    return contribution_stats.activity(max(1, min(days, STATS_MAX_DAYS)), action)
+
+@app.get("/api/applications")
+def get_applications(user_id: str = "guest", offset: int = 0, limit: Optional[int] = None):
+    if user_id == "guest":
+        raise HTTPException(403, "Unauthorized")
+    if not is_admin(user_id):
+        raise HTTPException(403, "Unauthorized")
+    if limit is None:
+        return application_store.all()
+
+    offset = max(offset, 0)
+    items = application_store.page(offset, max(1, min(limit, 100)))
+    total = application_store.count()
+    next_offset = offset + len(items)
+    return {
+        "applications": items,
+        "total": total,
+        "next_offset": next_offset if next_offset < total else None
+    }
+
+@app.post("/api/applications")
+def apply_famous(
+    node_id: int = Form(...),
+    user_id: str = Form("guest"),
+    nickname: str = Form("未知用户")
+):
+    if user_id == "guest":
+        raise HTTPException(403, "请登录后操作")
+    if not check_permission(user_id, "apply"):
+        raise HTTPException(403, "今日申请次数已用完")
+        
+    node = graph_index.ensure_loaded().get(node_id)
+    if node is None:
+        raise HTTPException(404, "Node not found")
+        
+    with application_store.write_lock:
+        if application_store.has_node(node_id):
+            raise HTTPException(400, "该节点已在申请中")
+            
+        new_app = {
+            "id": str(uuid.uuid4()),
+            "node_id": node_id,
+            "node_name": node["name"],
+            "user_id": user_id,
+            "nickname": nickname,
+            "time": datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        }
+        application_store.add(new_app)
+    
+    # record_action will handle quota deduction
+    record_action(user_id, "apply_famous", node_id, node["name"], nickname)
+    return new_app
+
+@app.post("/api/applications/{app_id}/process")
+def process_application(
+    app_id: str,
+    action: str = Form(...),
+    user_id: str = Form("guest"),
+    nickname: str = Form("未知用户")
+):
+    if not is_admin(user_id):
+        raise HTTPException(403, "Unauthorized")
+        
+    with application_store.write_lock:
+        application = application_store.get(app_id)
+        if application is None:
+            raise HTTPException(404, "Application not found")
+            
+        node_id = application["node_id"]
+        node_name = application["node_name"]
+        
+        # 节点的 is_famous 与申请列表通过同一次 write_json_files 写入
+        files = [(APPLICATIONS_FILE, application_store.without(app_id))]
+        node = None
+        if action == "approve":
+            current = graph_index.ensure_loaded().get(node_id)
+            if current is not None:
+                node = dict(current)
+                node["is_famous"] = True
+                files.append((os.path.join(DATA_DIR, f"{node_id}.json"), node))
+        write_json_files(files)
+        if node is not None:
+            graph_index.put(node)
+            append_journal("put", [node_id])
+        application_store.discard(app_id)
+
+    if action == "approve":
+        record_action(user_id, "approve_famous", node_id, node_name, nickname)
+    else:
+        record_action(user_id, "reject_famous", node_id, node_name, nickname)
+    return {"message": "Processed"}
+
+@app.patch("/api/nodes/{node_id}/famous")
+def toggle_famous(
+    node_id: int,
+    is_famous: bool = Form(...),
+    user_id: str = Form("guest"),
+    nickname: str = Form("未知用户")
+):
+    if not is_admin(user_id):
+        raise HTTPException(403, "Unauthorized")
+        
+    node_file = os.path.join(DATA_DIR, f"{node_id}.json")
+    if not os.path.exists(node_file):
+        raise HTTPException(404, "Node not found")
+        
+    with metered_open(node_file, "r", encoding="utf-8") as f:
+        node = json.load(f)
+        
+    node["is_famous"] = is_famous
+    save_node(node)
+    record_action(user_id, "edit", node_id, node["name"], nickname)
+    return node
+
+# --- Admin Routes ---
+
+@app.get("/metrics")
+def get_metrics():
+    return Response(content=metrics.render(), media_type="text/plain; version=0.0.4; charset=utf-8")
+
+@app.get("/api/admin/profiles")
+def get_profile_reports(user_id: str = "guest"):
+    if not is_admin(user_id):
+        raise HTTPException(403, "Unauthorized")
+    return list_profile_reports()
+
+@app.get("/api/admin/profiles/{filename}")
+def download_profile_report(filename: str, user_id: str = "guest"):
+    if not is_admin(user_id):
+        raise HTTPException(403, "Unauthorized")
+    path = os.path.join(PROFILES_DIR, os.path.basename(filename))
+    if not os.path.isfile(path):
+        raise HTTPException(404, "报告不存在")
+    return FileResponse(path)
+
+@app.get("/api/admin/fsck")
+def get_fsck_report(user_id: str = "guest"):
+    if not is_admin(user_id):
+        raise HTTPException(403, "Unauthorized")
+    return run_fsck()
+
+@app.post("/api/admin/fsck/repair")
+def repair_graph(user_id: str = Form("guest"), nickname: str = Form("未知用户")):
+    if not is_admin(user_id):
+        raise HTTPException(403, "Unauthorized")
+    report = run_fsck()
+    repaired = apply_fsck_repairs(report)
+    if repaired:
+        record_action(user_id, "edit", 0, f"数据修复（{len(repaired)}个节点）", nickname, details={"nodes": repaired})
+    return {"repaired": repaired, "report": run_fsck()}
+
+@app.get("/api/admin/singleflight")
+def get_singleflight_stats(user_id: str = "guest"):
+    if not is_admin(user_id):
+        raise HTTPException(403, "Unauthorized")
+    return read_flight.stats()
+
+@app.post("/api/admin/ban")
+def set_user_banned(
+    target_id: str = Form(...),
+    banned: bool = Form(True),
+    user_id: str = Form("guest")
+):
+    """封禁或解封用户，并立即撤销其已签发的会话令牌。"""
+    if not is_admin(user_id):
+        raise HTTPException(403, "Unauthorized")
+    banned_list = [b for b in load_banned() if b != target_id]
+    if banned:
+        banned_list.append(target_id)
+    write_json_files([(BANNED_FILE, banned_list)])
+    _access_lists.pop(BANNED_FILE, None)
+    revoke_sessions(target_id)
+    return {"banned": banned_list}
+
+# --- Mailbox Routes ---
 
-    return unprocessed + handled
-
-@app.post("/api/mailbox")
-def send_message(
-    content: str = Form(...),
-    user_id: str = Form("guest"),
-    nickname: str = Form("未知用户")
-):
-    if user_id == "guest":
-        raise HTTPException(403, "请登录后发送信箱")
-    
-    if not check_permission(user_id, "message"):
-        raise HTTPException(403, "今日信件投递次数已用完")
-        
-    if len(content) > 200:
-        raise HTTPException(400, "信件内容不能超过200字")
-        
-    messages = load_mailbox()
-    new_msg = {
-        "id": str(uuid.uuid4()),
-        "user_id": user_id,
-        "nickname": nickname,
-        "content": content,
-        "time": datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
-        "status": "unprocessed"
-    }
-    messages.append(new_msg)
-    save_mailbox(messages)
-    
-    # 投递信件不再记录在全站历史里
-    # record_action(user_id, "send_message", 0, "Mailbox", nickname)
-    return new_msg
-
-@app.post("/api/mailbox/{msg_id}/process")
+MAIL_STATUSES = ("unprocessed", "processed", "rejected")
+
+@app.get("/api/mailbox")
+def get_mailbox(
+    user_id: str = "guest",
+    status: Optional[str] = None,
+    before: Optional[str] = None,
+    limit: Optional[int] = None
+):
+    """
+    不带 limit 时返回全部信件（未处理在前）。
+    带 limit 时按 status 分页：before 为上一页返回的 next_before 游标。
+    """
+    if user_id == "guest" or not identity_matches(user_id):
+        raise HTTPException(403, "请登录后查看信箱")
+
+    if limit is None:
+        return mailbox_store.all_messages()
+
+    if status not in MAIL_STATUSES:
+        raise HTTPException(400, f"status 必须是 {'/'.join(MAIL_STATUSES)} 之一")
+    cursor = None
+    if before:
+        time_part, sep, id_part = before.rpartition("|")
+        if not sep:
+            raise HTTPException(400, "before 游标格式错误")
+        cursor = (time_part, id_part)
+    messages, next_key = mailbox_store.page(status, cursor, max(1, min(limit, 100)))
+    return {
+        "messages": messages,
+        "next_before": "|".join(next_key) if next_key else None,
+        "unread": mailbox_store.unread_count()
+    }
+
+@app.get("/api/mailbox/unread")
+def get_mailbox_unread(user_id: str = "guest"):
+    if user_id == "guest" or not identity_matches(user_id):
+        raise HTTPException(403, "请登录后查看信箱")
+    return {"unread": mailbox_store.unread_count()}
+
+@app.post("/api/mailbox")
+def send_message(
+    content: str = Form(...),
+    user_id: str = Form("guest"),
+    nickname: str = Form("未知用户")
+):
+    if user_id == "guest":
+        raise HTTPException(403, "请登录后发送信箱")
+    
+    if not check_permission(user_id, "message"):
+        raise HTTPException(403, "今日信件投递次数已用完")
+        
+    if len(content) > 200:
+        raise HTTPException(400, "信件内容不能超过200字")
+        
+    new_msg = {
+        "id": str(uuid.uuid4()),
+        "user_id": user_id,
+        "nickname": nickname,
+        "content": content,
+        "time": datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+        "status": "unprocessed"
+    }
+    mailbox_store.add(new_msg)
+    
+    # 投递信件不再记录在全站历史里
+    # record_action(user_id, "send_message", 0, "Mailbox", nickname)
+    return new_msg
+
+@app.post("/api/mailbox/{msg_id}/process")
 def process_message(
     msg_id: str,
     action: str = Form("process"), # "process" or "reject"
-    feedback: str = Form(""),
-    user_id: str = Form("guest"),
-    nickname: str = Form("未知用户")
-):
-    admins = load_admins()
-    if user_id not in admins:
-        raise HTTPException(403, "Unauthorized")
-        
-    messages = load_mailbox()
-    msg = next((m for m in messages if m["id"] == msg_id), None)
-    if not msg:
-        raise HTTPException(404, "Message not found")
-    if msg.get("status") != "unprocessed":
-        raise HTTPException(400, "该信件已处理，请刷新后重试")
+    feedback: str = Form(""),
+    user_id: str = Form("guest"),
+    nickname: str = Form("未知用户")
+):
+    if not is_admin(user_id):
+        raise HTTPException(403, "Unauthorized")
         
-    msg["status"] = "processed" if action == "process" else "rejected"
-    msg["processed_by"] = nickname
-    msg["processed_time"] = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-    msg["feedback"] = feedback if feedback.strip() else "无"
-    
-    # 获取信件投递人并更新其通知列表
-    sender_id = msg.get("user_id")
-    if sender_id and sender_id != "guest":
-        user = load_user(sender_id)
-        if user:
-            # 记录需要通知用户的信件ID列表 (id_list)
-            if "notifications" not in user:
-                user["notifications"] = []
-            if msg_id not in user["notifications"]:
-                user["notifications"].append(msg_id)
-            save_user(sender_id, user)
-    
-    save_mailbox(messages)
-    return {"message": "Success"}
-
-@app.post("/api/user/clear_notifications")
-def clear_notifications(user_id: str = Form(...)):
-    user = load_user(user_id)
-    if user:
-        user["notifications"] = []
-        save_user(user_id, user)
-        return {"status": "success"}
-    return {"status": "not_found"}
-
-if __name__ == "__main__":
-    import uvicorn
-    uvicorn.run(app, host="0.0.0.0", port=8000)
+    with mailbox_store.write_lock:
+        msg = mailbox_store.get(msg_id)
+        if not msg:
+            raise HTTPException(404, "Message not found")
+        if msg.get("status") != "unprocessed":
+            raise HTTPException(400, "该信件已处理，请刷新后重试")
+
+        old_key, old_status = MailboxStore.sort_key(msg), msg["status"]
+        msg["status"] = "processed" if action == "process" else "rejected"
+        msg["processed_by"] = nickname
+        msg["processed_time"] = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        msg["feedback"] = feedback if feedback.strip() else "无"
+        mailbox_store.update(msg, old_key, old_status)
+    
+    # 通知信件投递人（记录需要通知用户的信件ID列表，并唤醒其长轮询）
+    sender_id = msg.get("user_id")
+    if sender_id and sender_id != "guest":
+        notification_hub.push(sender_id, msg_id)
+    
+    return {"message": "Success"}
+
+# --- Notification Routes ---
+
+# 长轮询的最长等待时间（秒）
+NOTIFICATION_WAIT_MAX = 55.0
+
+@app.get("/api/notifications")
+def get_notifications(user_id: str = "guest"):
+    if user_id == "guest" or not identity_matches(user_id):
+        raise HTTPException(403, "请登录后查看通知")
+    ids = notification_hub.unread_ids(user_id)
+    found = {i: mailbox_store.get(i) for i in ids}
+    # 信箱索引在读取前已与文件同步，仍找不到的信件已被归档，直接标记为已读，否则客户端会不断收到无法显示的未读通知
+    stale = [i for i, m in found.items() if m is None]
+    if stale:
+        notification_hub.mark_read(user_id, stale)
+    ids = [i for i in ids if found[i]]
+    return {"unread": len(ids), "ids": ids, "messages": [found[i] for i in ids]}
+
+@app.get("/api/notifications/wait")
+async def wait_notifications(user_id: str = "guest", since: int = 0, timeout: float = 25.0):
+    """长轮询：未读数量变得与 since 不同（或超时）时返回最新的未读数量。"""
+    if user_id == "guest" or not identity_matches(user_id):
+        raise HTTPException(403, "请登录后查看通知")
+    unread = await notification_hub.wait(user_id, since, max(0.0, min(timeout, NOTIFICATION_WAIT_MAX)))
+    return {"unread": unread, "changed": unread != since}
+
+@app.post("/api/notifications/read")
+def mark_notifications_read(user_id: str = Form(...), ids: Optional[str] = Form(None)):
+    """批量标记已读，ids 为信件 id 的 JSON 列表，不传时全部标记为已读。"""
+    if user_id == "guest" or not identity_matches(user_id):
+        raise HTTPException(403, "请登录后查看通知")
+    try:
+        msg_ids = json.loads(ids) if ids else None
+    except json.JSONDecodeError:
+        raise HTTPException(400, "ids 不是合法的 JSON")
+    if ids and (not isinstance(msg_ids, list) or not all(isinstance(i, str) for i in msg_ids)):
+        raise HTTPException(400, "ids 必须是信件 id 字符串组成的列表")
+    return {"unread": notification_hub.mark_read(user_id, msg_ids)}
+
+@app.post("/api/user/clear_notifications")
+def clear_notifications(user_id: str = Form(...)):
+    if not identity_matches(user_id):
+        raise HTTPException(403, "身份校验失败，请重新登录")
+    if load_user(user_id) is None:
+        return {"status": "not_found"}
+    notification_hub.mark_read(user_id)
+    return {"status": "success"}
+
+if __name__ == "__main__":
+    import uvicorn
+    uvicorn.run(app, host="0.0.0.0", port=8000)
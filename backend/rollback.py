@@ -2,8 +2,38 @@ import os
 import shutil
 import datetime
 
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
 BACKUP_DIR = "backups"
 DATA_DIR = "data"
+# 服务端的图快照与变更日志：回滚后删除快照，并把日志换成新的 epoch，
+# 正在运行的 worker 下次同步时发现 epoch 变化，就会从 data 文件夹重新加载
+SNAPSHOT_FILE = "graph.snapshot"
+JOURNAL_FILE = "graph.journal"
+JOURNAL_LOCK_FILE = "graph.journal.lock"
+
+def reset_graph_journal():
+    with open(JOURNAL_LOCK_FILE, "a") as lock:
+        if fcntl is not None:
+            fcntl.flock(lock.fileno(), fcntl.LOCK_EX)
+        epoch = 0
+        if os.path.exists(JOURNAL_FILE):
+            with open(JOURNAL_FILE, "rb") as f:
+                line = f.readline()
+            if line.startswith(b"epoch "):
+                try:
+                    epoch = int(line[6:])
+                except ValueError:
+                    pass
+        if os.path.exists(SNAPSHOT_FILE):
+            os.remove(SNAPSHOT_FILE)
+        tmp_path = f"{JOURNAL_FILE}.tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(f"epoch {epoch + 1}\n".encode("ascii"))
+        os.replace(tmp_path, JOURNAL_FILE)
 
 def rollback():
     if not os.path.exists(BACKUP_DIR):
@@ -41,6 +71,7 @@ def rollback():
         if os.path.exists(DATA_DIR):
             shutil.rmtree(DATA_DIR)
         shutil.copytree(target_path, DATA_DIR)
+        reset_graph_journal()
         print(f"成功回滚至 {target_date} 的数据状态。")
         
     except KeyboardInterrupt:
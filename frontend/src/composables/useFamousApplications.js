@@ -7,19 +7,33 @@ export function useFamousApplications(apiBase, currentUser, getNodesData, select
   const showPendingApplicationsModal = ref(false)
   const isTogglingFamous = ref(false)
   const processingApplicationId = ref(null)
+  const nextApplicationOffset = ref(null)
 
-  const fetchPendingApplications = async () => {
+  const APPLICATION_PAGE_SIZE = 50
+
+  const fetchPendingApplications = async (append = false) => {
     if (currentUser.role !== 'admin') return
     try {
       const response = await axios.get(`${apiBase}/api/applications`, {
-        params: { user_id: currentUser.user_id }
+        params: {
+          user_id: currentUser.user_id,
+          offset: append ? nextApplicationOffset.value : 0,
+          limit: APPLICATION_PAGE_SIZE
+        }
       })
-      pendingApplications.value = response.data
+      const page = response.data.applications
+      pendingApplications.value = append ? [...pendingApplications.value, ...page] : page
+      nextApplicationOffset.value = response.data.next_offset
     } catch (error) {
       console.error('Failed to fetch applications:', error)
     }
   }
 
+  const loadMoreApplications = async () => {
+    if (nextApplicationOffset.value === null) return
+    await fetchPendingApplications(true)
+  }
+
   const openPendingApplications = async () => {
     await fetchPendingApplications()
     showPendingApplicationsModal.value = true
@@ -72,6 +86,7 @@ export function useFamousApplications(apiBase, currentUser, getNodesData, select
       }
 
       pendingApplications.value = pendingApplications.value.filter(app => app.id !== appId)
+      if (nextApplicationOffset.value !== null) nextApplicationOffset.value -= 1
       notify(action === 'approve' ? '申请已同意' : '申请已拒绝')
     } catch (error) {
       notify(error.response?.data?.detail || '处理申请失败', 'error')
@@ -86,7 +101,9 @@ export function useFamousApplications(apiBase, currentUser, getNodesData, select
     showPendingApplicationsModal,
     isTogglingFamous,
     processingApplicationId,
+    nextApplicationOffset,
     fetchPendingApplications,
+    loadMoreApplications,
     openPendingApplications,
     toggleFamousStatus,
     processApplication
@@ -2,6 +2,72 @@ import { ref, computed, watch } from 'vue'
 import { Network } from 'vis-network'
 import { DataSet } from 'vis-data'
 import axios from 'axios'
+import { loadStaticManifest, staticUrl, useStaticReads } from './useStaticSite'
+
+// Compact columnar graph format served by GET /api/nodes for this Accept type (see encode_graph_binary in main.py)
+const GRAPH_BINARY_TYPE = 'application/x-anon-graph'
+const NODE_FLAG_FAMOUS = 1
+const NODE_FLAG_NEW = 2
+// Fields that only come from GET /api/nodes/{id}; the binary format leaves them out
+const DETAIL_FIELDS = ['source', 'related', 'introduction', 'time']
+
+const decodeGraphBinary = (buffer) => {
+  const view = new DataView(buffer)
+  const magic = String.fromCharCode(...new Uint8Array(buffer, 0, 4))
+  if (magic !== 'AGRF' || view.getUint16(4, true) !== 1) throw new Error('Unsupported graph format')
+  const nodeCount = view.getUint32(8, true)
+  const edgeCount = view.getUint32(12, true)
+  const tagRefCount = view.getUint32(16, true)
+  const stringCount = view.getUint32(20, true)
+  const stringBytes = view.getUint32(24, true)
+
+  let offset = 28
+  const take = (ArrayType, length) => {
+    const values = new ArrayType(buffer, offset, length)
+    offset += values.byteLength
+    return values
+  }
+  const ids = take(Int32Array, nodeCount)
+  const xs = take(Float32Array, nodeCount)
+  const ys = take(Float32Array, nodeCount)
+  const names = take(Uint32Array, nodeCount)
+  const images = take(Uint32Array, nodeCount)
+  const sources = take(Uint32Array, nodeCount)
+  const flags = new Uint8Array(buffer, offset, nodeCount)
+  offset += Math.ceil(nodeCount / 4) * 4
+  const tagOffsets = take(Uint32Array, nodeCount + 1)
+  const tagRefs = take(Uint32Array, tagRefCount)
+  const edgeOffsets = take(Uint32Array, nodeCount + 1)
+  const edgeTargets = take(Int32Array, edgeCount)
+  const stringOffsets = take(Uint32Array, stringCount + 1)
+
+  const decoder = new TextDecoder()
+  const blob = new Uint8Array(buffer, offset, stringBytes)
+  const strings = new Array(stringCount)
+  for (let i = 0; i < stringCount; i++) {
+    strings[i] = decoder.decode(blob.subarray(stringOffsets[i], stringOffsets[i + 1]))
+  }
+
+  const nodes = new Array(nodeCount)
+  for (let i = 0; i < nodeCount; i++) {
+    const tags = []
+    for (let t = tagOffsets[i]; t < tagOffsets[i + 1]; t++) tags.push(strings[tagRefs[t]])
+    nodes[i] = {
+      id: ids[i],
+      name: strings[names[i]],
+      image: strings[images[i]],
+      source: { name: strings[sources[i]] },
+      tags,
+      extension: Array.from(edgeTargets.subarray(edgeOffsets[i], edgeOffsets[i + 1])),
+      x: xs[i],
+      y: ys[i],
+      is_famous: (flags[i] & NODE_FLAG_FAMOUS) !== 0,
+      new: (flags[i] & NODE_FLAG_NEW) !== 0,
+      _partial: true
+    }
+  }
+  return nodes
+}
 
 export function useGraph(apiBase, currentUser, isDarkMode, callbacks, notify = () => {}) {
   // callbacks: { cancelEdit, triggerNotificationCheck, applyFilters, activeFilters, isEditing, isAdding, isConnectionEditMode: unused (we own it) }
@@ -17,6 +83,8 @@ export function useGraph(apiBase, currentUser, isDarkMode, callbacks, notify = (
   const isUpdatingConnection = ref(false)
   const isSavingPosition = ref(false)
   let isDraggingNode = false
+  // Nodes dragged since the last position save; saved together in one request
+  const movedNodeIds = new Set()
 
   let network = null
   let nodesData = new DataSet([])
@@ -52,6 +120,8 @@ export function useGraph(apiBase, currentUser, isDarkMode, callbacks, notify = (
 
   const canEditSelectedNode = computed(() => {
     if (!selectedNode.value || !currentUser.logged_in || currentUser.role === 'banned') return false
+    // Wait for the lazily loaded detail fields so an edit never submits a partial node
+    if (selectedNode.value._partial) return false
     if (currentUser.role === 'admin') return true
     return currentUser.quota && currentUser.quota.edits < 10
   })
@@ -116,6 +186,8 @@ export function useGraph(apiBase, currentUser, isDarkMode, callbacks, notify = (
       const imageUrl = node.image
         ? (node.image.startsWith('http') ? node.image : `${apiBase}${node.image}`)
         : `${apiBase}/images/default.webp`
+      // With a static export the graph draws exported thumbnails; the side panel keeps the full image
+      const thumbnail = staticManifest && staticManifest.thumbnails[node.image]
       const nodeSize = 34 + Math.min(36, (connectionCounts[node.id] || 0) * 4)
 
       return {
@@ -126,7 +198,8 @@ export function useGraph(apiBase, currentUser, isDarkMode, callbacks, notify = (
         id: node.id,
         label: node.name,
         shape: 'circularImage',
-        image: imageUrl,
+        image: thumbnail ? staticUrl(thumbnail) : imageUrl,
+        fullImage: imageUrl,
         size: nodeSize,
         originalSize: nodeSize,
         brokenImage: `${apiBase}/images/default.webp`,
@@ -171,10 +244,33 @@ export function useGraph(apiBase, currentUser, isDarkMode, callbacks, notify = (
     callbacks.applyFilters()
   }
 
+  let staticManifest = null
+
+  const fetchStaticGraphData = async () => {
+    staticManifest = await loadStaticManifest(true)
+    const response = await axios.get(staticUrl(staticManifest.nodes_binary), { responseType: 'arraybuffer' })
+    return decodeGraphBinary(response.data)
+  }
+
   const fetchGraphData = async () => {
     try {
-      const response = await axios.get(`${apiBase}/api/nodes`)
-      const data = response.data.nodes
+      if (useStaticReads(currentUser)) {
+        try {
+          renderNodes(await fetchStaticGraphData())
+          return
+        } catch (error) {
+          console.error('Failed to fetch static graph, falling back to the API:', error)
+        }
+      }
+      staticManifest = null
+      const response = await axios.get(`${apiBase}/api/nodes`, {
+        headers: { Accept: `${GRAPH_BINARY_TYPE}, application/json` },
+        responseType: 'arraybuffer'
+      })
+      const contentType = response.headers['content-type'] || ''
+      const data = contentType.startsWith(GRAPH_BINARY_TYPE)
+        ? decodeGraphBinary(response.data)
+        : JSON.parse(new TextDecoder().decode(response.data)).nodes
       renderNodes(data)
     } catch (error) {
       console.error('Failed to fetch data:', error)
@@ -182,6 +278,43 @@ export function useGraph(apiBase, currentUser, isDarkMode, callbacks, notify = (
     }
   }
 
+  // Nodes decoded from the binary format carry only what is needed to draw them; fetch the rest on focus
+  const fetchNodeDetail = async (nodeId) => {
+    if (!useStaticReads(currentUser)) staticManifest = null
+    const detailPath = staticManifest && staticManifest.node_detail[nodeId]
+    if (detailPath) {
+      try {
+        return await axios.get(staticUrl(detailPath))
+      } catch (error) {
+        // Files from older exports are garbage-collected, so a long-open tab can point at missing ones
+        console.error('Failed to fetch static node detail, falling back to the API:', error)
+      }
+    }
+    return axios.get(`${apiBase}/api/nodes/${nodeId}`)
+  }
+
+  const loadNodeDetail = async (nodeId) => {
+    try {
+      const response = await fetchNodeDetail(nodeId)
+      const detail = { id: nodeId, _partial: false }
+      DETAIL_FIELDS.forEach(field => {
+        if (field in response.data) detail[field] = response.data[field]
+      })
+      if (typeof detail.source === 'string') {
+        try { detail.source = JSON.parse(detail.source) } catch (e) { detail.source = { name: detail.source, link: '' } }
+      }
+      if (typeof detail.related === 'string') {
+        try { detail.related = JSON.parse(detail.related) } catch (e) { detail.related = [] }
+      }
+      nodesData.update(detail)
+      if (selectedNode.value && selectedNode.value.id === nodeId) {
+        selectedNode.value = nodesData.get(nodeId)
+      }
+    } catch (error) {
+      console.error('Failed to load node detail:', error)
+    }
+  }
+
   const focusNode = (nodeId) => {
     const node = nodesData.get(nodeId)
     if (node) {
@@ -194,6 +327,7 @@ export function useGraph(apiBase, currentUser, isDarkMode, callbacks, notify = (
       nodesData.update({ id: nodeId, size: node.originalSize * 1.5, borderWidth: 6 })
       selectedNode.value = node
       isPanelOpen.value = true
+      if (node._partial) loadNodeDetail(nodeId)
       if (network) {
         network.focus(nodeId, {
           scale: 1,
@@ -301,22 +435,27 @@ export function useGraph(apiBase, currentUser, isDarkMode, callbacks, notify = (
   }
 
   const saveNodePosition = async () => {
-    if (!selectedNode.value || !network || isSavingPosition.value) return
+    if (!network || isSavingPosition.value) return
 
-    const pos = network.getPositions([selectedNode.value.id])[selectedNode.value.id]
-    if (!pos) return
+    const ids = new Set(movedNodeIds)
+    if (selectedNode.value) ids.add(selectedNode.value.id)
+    const positions = network.getPositions([...ids])
+    const payload = [...ids]
+      .filter(id => positions[id])
+      .map(id => ({ id, x: positions[id].x, y: positions[id].y }))
+    if (payload.length === 0) return
 
     const formData = new FormData()
-    formData.append('x', pos.x)
-    formData.append('y', pos.y)
+    formData.append('positions', JSON.stringify(payload))
     formData.append('user_id', currentUser.user_id)
     formData.append('nickname', currentUser.nickname)
 
     isSavingPosition.value = true
 
     try {
-      await axios.patch(`${apiBase}/api/nodes/${selectedNode.value.id}/position`, formData)
-      notify('位置保存成功')
+      await axios.patch(`${apiBase}/api/nodes/positions`, formData)
+      payload.forEach(p => movedNodeIds.delete(p.id))
+      notify(payload.length > 1 ? `已保存${payload.length}个节点的位置` : '位置保存成功')
     } catch (error) {
       notify(error.response?.data?.detail || '保存位置失败', 'error')
     } finally {
@@ -391,8 +530,9 @@ export function useGraph(apiBase, currentUser, isDarkMode, callbacks, notify = (
         network.startSimulation()
       })
 
-      network.on('dragEnd', () => {
+      network.on('dragEnd', (params) => {
         isDraggingNode = false
+        params.nodes.forEach(id => movedNodeIds.add(id))
         network.startSimulation()
       })
 
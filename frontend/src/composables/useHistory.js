@@ -1,18 +1,39 @@
 import { ref } from 'vue'
 import axios from 'axios'
+import { loadStaticManifest, staticUrl, useStaticReads } from './useStaticSite'
 
-export function useHistory(apiBase) {
+export function useHistory(apiBase, currentUser) {
   const showHistory = ref(false)
   const historyData = ref([])
   const historyType = ref('global')
   const isHistoryLoading = ref(false)
 
+  // The export mirrors GET /api/history: one file for the global list, one per node that has records
+  const fetchStaticHistory = async (nodeId) => {
+    const manifest = await loadStaticManifest()
+    const path = nodeId ? manifest.node_history[nodeId] : manifest.history
+    if (!path) return []
+    const response = await axios.get(staticUrl(path))
+    return response.data
+  }
+
   const fetchHistory = async (nodeId = null) => {
     isHistoryLoading.value = true
     try {
-      const url = nodeId ? `${apiBase}/api/history?node_id=${nodeId}` : `${apiBase}/api/history`
-      const response = await axios.get(url)
-      historyData.value = response.data
+      let data = null
+      if (useStaticReads(currentUser)) {
+        try {
+          data = await fetchStaticHistory(nodeId)
+        } catch (error) {
+          console.error('Failed to fetch static history, falling back to the API:', error)
+        }
+      }
+      if (data === null) {
+        const url = nodeId ? `${apiBase}/api/history?node_id=${nodeId}` : `${apiBase}/api/history`
+        const response = await axios.get(url)
+        data = response.data
+      }
+      historyData.value = data
       historyType.value = nodeId ? 'node' : 'global'
     } catch (error) {
       console.error('Failed to fetch history:', error)
@@ -54,7 +54,7 @@ export function useNodeForm(apiBase, currentUser, deps, notify = () => {}) {
       extension: deps.selectedNode.value.extension || [],
       introduction: deps.selectedNode.value.introduction || '',
       imageFile: null,
-      imagePreview: deps.selectedNode.value.image
+      imagePreview: deps.selectedNode.value.fullImage || deps.selectedNode.value.image
     })
   }
 
@@ -163,6 +163,7 @@ export function useNodeForm(apiBase, currentUser, deps, notify = () => {}) {
           id: resultNode.id,
           label: resultNode.name,
           image: finalImageUrl,
+          fullImage: finalImageUrl,
           x: currentPos ? currentPos.x : resultNode.x,
           y: currentPos ? currentPos.y : resultNode.y
         })
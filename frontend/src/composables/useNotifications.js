@@ -4,26 +4,60 @@ import axios from 'axios'
 export function useNotifications(apiBase, currentUser) {
   const notifiedMails = ref([])
   const showNotificationModal = ref(false)
+  let watchingUserId = null
 
-  const triggerNotificationCheck = async () => {
-    if (currentUser.logged_in && currentUser.notifications && currentUser.notifications.length > 0) {
+  // Shows the unread letters and marks every returned id read; resolves to the unread count left afterwards
+  const showUnreadNotifications = async () => {
+    const resp = await axios.get(`${apiBase}/api/notifications`, {
+      params: { user_id: currentUser.user_id }
+    })
+    if (resp.data.ids.length === 0) return resp.data.unread
+
+    if (resp.data.messages.length > 0) {
+      notifiedMails.value = resp.data.messages
+      showNotificationModal.value = true
+    }
+    const formData = new FormData()
+    formData.append('user_id', currentUser.user_id)
+    formData.append('ids', JSON.stringify(resp.data.ids))
+    const readResp = await axios.post(`${apiBase}/api/notifications/read`, formData)
+    return readResp.data.unread
+  }
+
+  // Long-poll: the server answers as soon as one of the user's letters is processed
+  const watchNotifications = async () => {
+    const userId = currentUser.user_id
+    if (!currentUser.logged_in || watchingUserId === userId) return
+    watchingUserId = userId
+
+    let since = 0
+    while (watchingUserId === userId && currentUser.user_id === userId) {
       try {
-        const resp = await axios.get(`${apiBase}/api/mailbox`, {
-          params: { user_id: currentUser.user_id }
+        const resp = await axios.get(`${apiBase}/api/notifications/wait`, {
+          params: { user_id: userId, since }
         })
-        const allMails = resp.data
-        notifiedMails.value = allMails.filter(m => currentUser.notifications.includes(m.id))
-
-        if (notifiedMails.value.length > 0) {
-          showNotificationModal.value = true
-          const formData = new FormData()
-          formData.append('user_id', currentUser.user_id)
-          await axios.post(`${apiBase}/api/user/clear_notifications`, formData)
+        since = resp.data.unread
+        if (since > 0 && currentUser.user_id === userId) {
+          // Wait for the count the server reports after marking read, so a letter that cannot be cleared never makes the next poll return at once
+          since = await showUnreadNotifications()
         }
+      } catch (e) {
+        await new Promise(resolve => setTimeout(resolve, 5000))
+      }
+    }
+    if (watchingUserId === userId) watchingUserId = null
+  }
+
+  const triggerNotificationCheck = async () => {
+    if (!currentUser.logged_in) return
+    if (currentUser.notifications && currentUser.notifications.length > 0) {
+      try {
+        await showUnreadNotifications()
       } catch (e) {
         console.error('Failed to check notifications', e)
       }
     }
+    watchNotifications()
   }
 
   return {
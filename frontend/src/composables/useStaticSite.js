@@ -0,0 +1,24 @@
+import axios from 'axios'
+
+// Base URL of a static export (backend/export_static.py); reads for guests go there instead of the API
+export const staticBase = import.meta.env.VITE_STATIC_BASE || ''
+
+let manifestRequest = null
+
+// The manifest is small and changes after every export, so it is re-fetched whenever the graph is (re)loaded
+export const loadStaticManifest = (refresh = false) => {
+  if (!manifestRequest || refresh) {
+    manifestRequest = axios.get(`${staticBase}/manifest.json`, { headers: { 'Cache-Control': 'no-cache' } })
+      .then(response => response.data)
+      .catch(error => {
+        manifestRequest = null
+        throw error
+      })
+  }
+  return manifestRequest
+}
+
+export const staticUrl = (path) => `${staticBase}/${path}`
+
+// Static files lag behind writes by the export debounce, so logged-in users keep reading from the API
+export const useStaticReads = (currentUser) => Boolean(staticBase) && !currentUser.logged_in
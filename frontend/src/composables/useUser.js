@@ -14,6 +14,17 @@ export function useUser(apiBase) {
 
   const isDropdownOpen = ref(false)
 
+  // Signed session token issued by /api/auth/callback, sent with every request
+  const setSessionToken = (token) => {
+    if (token) {
+      localStorage.setItem('session_token', token)
+      axios.defaults.headers.common['Authorization'] = `Bearer ${token}`
+    } else {
+      localStorage.removeItem('session_token')
+      delete axios.defaults.headers.common['Authorization']
+    }
+  }
+
   const fetchUserInfo = async (userId = 'guest', nickname = '游客') => {
     try {
       const url = `${apiBase}/api/user/info?user_id=${userId}&nickname=${encodeURIComponent(nickname)}`
@@ -22,6 +33,13 @@ export function useUser(apiBase) {
       return response.data
     } catch (error) {
       console.error('Failed to fetch user info:', error)
+      if (error.response?.status === 401 || error.response?.status === 403) {
+        // Expired or revoked session: fall back to guest
+        setSessionToken(null)
+        localStorage.removeItem('user_id')
+        localStorage.removeItem('nickname')
+        if (userId !== 'guest') return fetchUserInfo('guest', '游客')
+      }
       if (userId !== 'guest') {
          currentUser.user_id = userId
          currentUser.nickname = nickname
@@ -45,6 +63,7 @@ export function useUser(apiBase) {
   const logout = () => {
     localStorage.removeItem('user_id')
     localStorage.removeItem('nickname')
+    setSessionToken(null)
     fetchUserInfo('guest', '游客')
     isDropdownOpen.value = false
   }
@@ -58,11 +77,13 @@ export function useUser(apiBase) {
     const params = new URLSearchParams(window.location.search)
     const userIdFromUrl = params.get('user_id')
     const nicknameFromUrl = params.get('nickname')
+    const tokenFromUrl = params.get('token')
 
     if (userIdFromUrl && nicknameFromUrl) {
       console.log("Found auth params in URL, saving to storage:", userIdFromUrl, nicknameFromUrl)
       localStorage.setItem('user_id', userIdFromUrl)
       localStorage.setItem('nickname', nicknameFromUrl)
+      setSessionToken(tokenFromUrl)
 
       currentUser.user_id = userIdFromUrl
       currentUser.nickname = nicknameFromUrl
@@ -74,11 +95,13 @@ export function useUser(apiBase) {
         const url = new URL(window.location.href)
         url.searchParams.delete('user_id')
         url.searchParams.delete('nickname')
+        url.searchParams.delete('token')
         window.history.replaceState({}, '', url.toString())
       } catch (e) {
         console.error("Failed to clean URL params", e)
       }
     } else {
+      setSessionToken(localStorage.getItem('session_token'))
       const savedUserId = localStorage.getItem('user_id') || 'guest'
       const savedNickname = localStorage.getItem('nickname') || '游客'
       await fetchUserInfo(savedUserId, savedNickname)